@@ -29,13 +29,7 @@ class CollisionAvoidanceController(MessageHandler):
         self.__driver = driver
         self.__logger = logging.getLogger(LOGGER_NAME)
 
-    def handle_data_message(self, header, message):
-        if message.HasExtension(collision_avoidance_pb2.setSpeed):
-            self.__handle_set_speed(header, message)
-
-        else:
-            self.__logger.warning('No request in message')
-
+    @MessageHandler.handles(collision_avoidance_pb2.setSpeed, latest_wins=True)
     def __handle_set_speed(self, _, message):
         self.__logger.debug('Set speed')
         motors_speed = message.Extensions[collision_avoidance_pb2.motorsSpeed]
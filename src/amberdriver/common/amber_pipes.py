@@ -1,3 +1,5 @@
+import errno
+import io
 import logging
 import logging.config
 import struct
@@ -9,98 +11,464 @@ from ambercommon.common import runtime
 
 import os
 
-from amberdriver.common import drivermsg_pb2
+from amberdriver.common import drivermsg_pb2, wire
+from amberdriver.common.event_loop import set_non_blocking
+from amberdriver.common.message_pool import MessagePool
+from amberdriver.common.outbound_queue import OutboundQueue, CONTROL, REPLY
+from amberdriver.tools import config
 
 
 __author__ = 'paoolo'
 
-LEN_SIZE = 2
+READ_BUFFER_SIZE = 64 * 1024
 
 LOGGER_NAME = 'AmberPipes'
 pwd = os.path.dirname(os.path.abspath(__file__))
 logging.config.fileConfig('%s/amber.ini' % pwd)
+config.add_config_ini('%s/amber.ini' % pwd)
+
+WRITER_THREAD_ENABLE = config.AMBER_PIPES_WRITER_THREAD_ENABLE == 'True'
+MESSAGE_POOL_SIZE = int(config.AMBER_MESSAGE_POOL_SIZE)
+REPLY_QUEUE_SIZE = int(config.AMBER_PIPES_REPLY_QUEUE_SIZE)
+SUBSCRIPTION_QUEUE_SIZE = int(config.AMBER_PIPES_SUBSCRIPTION_QUEUE_SIZE)
+
+# large frames must be enabled in mediator too
+LARGE_FRAMES_ENABLE = config.AMBER_PIPES_LARGE_FRAMES_ENABLE == 'True'
+if LARGE_FRAMES_ENABLE:
+    LEN_FORMAT = '!i'
+    MAX_LENGTH = int(config.AMBER_PIPES_LARGE_FRAMES_MAX_LENGTH)
+else:
+    LEN_FORMAT = '!h'
+    MAX_LENGTH = 2 ** 15 - 1
+LEN_SIZE = struct.calcsize(LEN_FORMAT)
 
 
 class AmberException(Exception):
     def __init__(self, message=None, cause=None):
-        super(AmberException, self).__init__(message + u', caused by ' + repr(cause))
+        if cause is not None:
+            message = (message or u'') + u', caused by ' + repr(cause)
+        super(AmberException, self).__init__(message)
         self.cause = cause
 
 
+class FrameLengthError(AmberException):
+    def __init__(self, length, max_length):
+        super(FrameLengthError, self).__init__(
+            'length %d of frame out of range 0-%d, see AMBER_PIPES_LARGE_FRAMES_ENABLE' % (length, max_length))
+        self.length, self.max_length = length, max_length
+
+
+class FrameReader(object):
+    """
+    Reader of header and message frames, each prefixed with its length.
+    Data is read from pipe in large chunks into one reusable buffer
+    and whole frames are cut out of it.
+    """
+
+    def __init__(self, read_into, buffer_size=READ_BUFFER_SIZE, length_format=LEN_FORMAT, max_length=MAX_LENGTH):
+        self.__read_into = read_into
+        self.__length = struct.Struct(length_format)
+        self.__max_length = max_length
+
+        self.__buffer = bytearray(buffer_size)
+        self.__view = memoryview(self.__buffer)
+        self.__start, self.__end = 0, 0
+
+    def read_frame(self):
+        """
+        Read next frame, blocking until it is whole in buffer.
+
+        :return: binary strings of header and message
+        """
+        frame = self.next_frame()
+        while frame is None:
+            self.fill()
+            frame = self.next_frame()
+        return frame
+
+    def next_frame(self):
+        """
+        Cut next frame out of buffer, without reading from pipe.
+
+        :return: binary strings of header and message or None if frame is not whole in buffer
+        """
+        header_start = self.__start + self.__length.size
+        if header_start > self.__end:
+            return None
+        header_end = header_start + self.__unpack_length(self.__start)
+
+        message_start = header_end + self.__length.size
+        if message_start > self.__end:
+            return None
+        message_end = message_start + self.__unpack_length(header_end)
+        if message_end > self.__end:
+            return None
+
+        self.__start = message_end
+        return self.__view[header_start:header_end].tobytes(), self.__view[message_start:message_end].tobytes()
+
+    def __unpack_length(self, position):
+        length = self.__length.unpack_from(self.__buffer, position)[0]
+        if not 0 <= length <= self.__max_length:
+            raise FrameLengthError(length, self.__max_length)
+        return length
+
+    def fill(self):
+        """
+        Read next chunk of data from pipe into free space of buffer.
+
+        :return: number of read bytes
+        """
+        if self.__start == self.__end:
+            self.__start, self.__end = 0, 0
+        elif self.__end == len(self.__buffer):
+            self.__compact()
+
+        count = self.__read_into(self.__view[self.__end:])
+        if count is None:
+            # non-blocking pipe without data
+            return 0
+        if count == 0:
+            raise EOFError('pipe closed')
+        self.__end += count
+        return count
+
+    def __compact(self):
+        pending = self.__end - self.__start
+        if self.__start > 0:
+            self.__buffer[:pending] = self.__buffer[self.__start:self.__end]
+        else:
+            # frame is bigger than buffer
+            buffer = bytearray(2 * len(self.__buffer))
+            buffer[:pending] = self.__buffer
+            self.__buffer, self.__view = buffer, memoryview(buffer)
+        self.__start, self.__end = 0, pending
+
+
+class FrameWriter(object):
+    """
+    Writer of frames working in separate thread. Producers only queue frames,
+    frames taken at once from queue (see `OutboundQueue.take`) are written to pipe with one write and flush.
+    """
+
+    def __init__(self, write, outbound_queue=None):
+        self.__write = write
+        self.__outbound_queue = outbound_queue if outbound_queue is not None else OutboundQueue()
+
+        self.__logger = logging.getLogger(LOGGER_NAME)
+
+        self.__writing_thread = threading.Thread(target=self.__writing_loop, name='writing-thread')
+        self.__writing_thread.daemon = True
+        self.__writing_thread.start()
+
+    def put(self, binary_string, message_class=REPLY, block=True):
+        """
+        Queue frame to be written to pipe.
+
+        :param binary_string: binary string of frame
+        :param message_class: class of message, see `outbound_queue`
+        :param block: wait for space in queue of replies, if False reply is dropped when queue is full
+        :return: True if frame is queued, False if it is dropped
+        """
+        return self.__outbound_queue.put(binary_string, message_class, block)
+
+    def __writing_loop(self):
+        while True:
+            frames = self.__outbound_queue.take()
+            if len(frames) == 0:
+                break
+            binary_string = ''.join(frames)
+
+            try:
+                self.__write(binary_string)
+            except BaseException:
+                traceback.print_exc()
+                self.__logger.warning('amber_pipes: cannot write %d bytes to pipe', len(binary_string))
+
+        self.__logger.warning('amber_pipes: writer stop')
+
+    def get_counters(self):
+        return self.__outbound_queue.get_counters()
+
+    def terminate(self):
+        self.__outbound_queue.close()
+
+
+class EventLoopFrameWriter(object):
+    """
+    Writer of frames driven by event loop. Pipe is switched to non-blocking mode,
+    what cannot be written at once is written when event loop finds pipe writable.
+    Frames are queued meanwhile, so stale subscription frames can be superseded.
+    """
+
+    def __init__(self, event_loop, pipe_out, outbound_queue=None):
+        self.__event_loop = event_loop
+        self.__fd = pipe_out.fileno()
+        set_non_blocking(self.__fd)
+
+        self.__outbound_queue = outbound_queue if outbound_queue is not None else OutboundQueue()
+        self.__pending = bytearray()
+
+    def put(self, binary_string, message_class=REPLY, block=True):
+        """
+        Queue frame to be written to pipe. Frames from other threads are written by event loop.
+        Event loop never waits for space in queue of replies.
+
+        :param binary_string: binary string of frame
+        :param message_class: class of message, see `outbound_queue`
+        :param block: wait for space in queue of replies, if False reply is dropped when queue is full
+        :return: True if frame is queued, False if it is dropped
+        """
+        if self.__event_loop.is_loop_thread():
+            queued = self.__outbound_queue.put(binary_string, message_class, block=False)
+            self.__flush()
+        else:
+            queued = self.__outbound_queue.put(binary_string, message_class, block)
+            self.__event_loop.call_soon(self.__flush)
+        return queued
+
+    def __flush(self):
+        if len(self.__pending) > 0:
+            # pipe is not writable, queued frames are written with pending data
+            return
+
+        binary_string = ''.join(self.__outbound_queue.take(block=False))
+        if len(binary_string) > 0:
+            count = self.__write_to_pipe(binary_string)
+            if count < len(binary_string):
+                self.__pending += binary_string[count:]
+                self.__event_loop.add_writer(self.__fd, self.__write_pending)
+
+    def __write_pending(self):
+        count = self.__write_to_pipe(self.__pending)
+        del self.__pending[:count]
+        if len(self.__pending) == 0:
+            self.__pending += ''.join(self.__outbound_queue.take(block=False))
+            if len(self.__pending) == 0:
+                self.__event_loop.remove_writer(self.__fd)
+
+    def __write_to_pipe(self, binary_string):
+        try:
+            return os.write(self.__fd, binary_string)
+        except OSError as e:
+            if e.errno in (errno.EAGAIN, errno.EWOULDBLOCK):
+                return 0
+            raise
+
+    def get_counters(self):
+        return self.__outbound_queue.get_counters()
+
+    def terminate(self):
+        self.__outbound_queue.close()
+
+
 class AmberPipes(object):
-    def __init__(self, message_handler, pipe_in, pipe_out):
+    def __init__(self, message_handler, pipe_in, pipe_out, latest_wins=None):
+        """
+        :param message_handler: object of MessageHandler
+        :param pipe_in: input pipe from mediator
+        :param pipe_out: output pipe to mediator
+        :param latest_wins: dict of handled extension number to flag, if only the latest request
+                            of the same clients is handled, when many are read at once
+        """
         self.__message_handler = message_handler
-        self.__pipe_in, self.__pipe_out = pipe_in, pipe_out
+        self.__pipe_in, self.__pipe_out = AmberPipes.__unbuffered(pipe_in), pipe_out
+        self.__frame_reader = FrameReader(self.__read_from_pipe)
+        self.__message_pool = MessagePool(MESSAGE_POOL_SIZE)
         self.__is_alive = True
 
+        self.__latest_wins = latest_wins if latest_wins is not None and any(latest_wins.values()) else None
+        self.__superseded_count = 0
+
         self.__write_lock = threading.Lock()
+        # thread reading pipes, it never waits for space in queue of replies, so PING is always answered
+        self.__pipes_thread = None
+        self.__frame_writer = FrameWriter(self.__write_to_pipe, AmberPipes.__new_outbound_queue()) \
+            if WRITER_THREAD_ENABLE else None
         self.__logger = logging.getLogger(LOGGER_NAME)
 
         runtime.add_shutdown_hook(self.terminate)
 
     def __call__(self, *args, **kwargs):
         self.__logger.info('Pipes thread started.')
+        self.__pipes_thread = threading.current_thread()
         self.__amber_pipes_loop()
 
     def is_alive(self):
         return self.__is_alive
 
+    def get_message_pool(self):
+        return self.__message_pool
+
+    @staticmethod
+    def __new_outbound_queue():
+        return OutboundQueue(reply_size=REPLY_QUEUE_SIZE, subscription_size=SUBSCRIPTION_QUEUE_SIZE)
+
+    def get_outbound_counters(self):
+        """
+        :return: counters of queued, superseded and dropped frames, empty if frames are written directly
+        """
+        if self.__frame_writer is not None:
+            return self.__frame_writer.get_counters()
+        return {}
+
+    def fileno(self):
+        return self.__pipe_in.fileno()
+
+    def attach(self, event_loop):
+        """
+        Read and write pipes in event loop, instead of running pipes thread.
+
+        :param event_loop: object of EventLoop
+        :return: nothing
+        """
+        if self.__frame_writer is not None:
+            self.__frame_writer.terminate()
+        self.__frame_writer = EventLoopFrameWriter(event_loop, self.__pipe_out, AmberPipes.__new_outbound_queue())
+        event_loop.add_reader(self.fileno(), self.handle_available_frames)
+        self.__logger.info('Pipes attached to event loop.')
+
     def __amber_pipes_loop(self):
         try:
             while self.__is_alive:
-                header, message = self.__read_header_and_message_from_pipe()
-                self.__handle_header_and_message(header, message)
-        except struct.error:
-            self.__logger.warning('amber_pipes: stop due to error on pipe with mediator')
-            self.__is_alive = False
-            os.kill(os.getpid(), signal.SIGTERM)
+                frames = [self.__frame_reader.read_frame()]
+                self.__handle_frames(self.__read_buffered_frames(frames))
+        except (struct.error, EOFError, FrameLengthError) as e:
+            self.__stop_due_to_pipe_error(e)
 
         self.__logger.warning('amber_pipes: stop')
 
-    def __read_header_and_message_from_pipe(self):
+    def handle_available_frames(self):
         """
-        Read and parse header and message from pipe.
+        Read data available in pipe and handle all whole frames, without waiting for more.
 
-        :return: header and message
+        :return: nothing
+        """
+        try:
+            self.__frame_reader.fill()
+            self.__handle_frames(self.__read_buffered_frames([]))
+        except (struct.error, EOFError, FrameLengthError) as e:
+            self.__stop_due_to_pipe_error(e)
+
+    def __read_buffered_frames(self, frames):
+        frame = self.__frame_reader.next_frame()
+        while frame is not None:
+            frames.append(frame)
+            frame = self.__frame_reader.next_frame()
+        return frames
+
+    def __handle_frames(self, frames):
+        # type and synNum of every message are peeked once, both for coalescing and handling
+        frames = [(header_data, message_data, wire.peek_message(message_data)) for header_data, message_data in frames]
+        if self.__latest_wins is not None and len(frames) > 1:
+            frames = self.__coalesce(frames)
+        for header_data, message_data, peeked in frames:
+            try:
+                self.__handle_frame(header_data, message_data, peeked)
+            except FrameLengthError as e:
+                # raised by handler writing too large response, only frames read from mediator stop pipes
+                self.__logger.warning('amber_pipes: response not sent: %s', str(e))
+
+    def __coalesce(self, frames):
         """
-        header = drivermsg_pb2.DriverHdr()
-        message = drivermsg_pb2.DriverMsg()
+        Drop DATA frames with latest-wins request, which are followed by frame with
+        the same request of the same clients. Order of other frames is kept.
 
-        header = self.__read_data_from_pipe(header)
-        message = self.__read_data_from_pipe(message)
+        :param frames: list of binary strings of header and message with their peeked type and synNum
+        :return: list of binary strings of header and message with their peeked type and synNum
+        """
+        keys, last_indexes = [], {}
+        for index, (header_data, message_data, (message_type, _)) in enumerate(frames):
+            key = None
+            if message_type == drivermsg_pb2.DriverMsg.DATA:
+                extension = wire.find_field(message_data, self.__latest_wins)
+                if extension is not None and self.__latest_wins[extension]:
+                    key = (header_data, extension)
+                    last_indexes[key] = index
+            keys.append(key)
+
+        if len(last_indexes) == 0:
+            return frames
+
+        coalesced = [frame for index, frame in enumerate(frames)
+                     if keys[index] is None or last_indexes[keys[index]] == index]
+        superseded = len(frames) - len(coalesced)
+        if superseded > 0:
+            self.__superseded_count += superseded
+            self.__logger.debug('amber_pipes: %d superseded requests dropped', superseded)
+        return coalesced
+
+    def get_superseded_count(self):
+        """
+        :return: number of incoming requests dropped, because later request of the same type superseded them
+        """
+        return self.__superseded_count
 
-        return header, message
+    def __stop_due_to_pipe_error(self, error):
+        self.__logger.warning('amber_pipes: stop due to error on pipe with mediator: %s', str(error))
+        self.__is_alive = False
+        os.kill(os.getpid(), signal.SIGTERM)
 
-    def __read_data_from_pipe(self, container):
-        data = self.__read_and_unpack_data_from_pipe(LEN_SIZE)
-        container.ParseFromString(data)
-        return container
+    def __read_from_pipe(self, buffer_view):
+        """
+        Read available binary data from pipe into buffer.
 
-    def __read_and_unpack_data_from_pipe(self, size):
+        :param buffer_view: memoryview of free space in buffer
+        :return: number of read bytes
         """
-        Read and unpack data from pipe.
+        return self.__pipe_in.readinto(buffer_view)
 
-        :param size: size of length data
-        :return: binary string
+    @staticmethod
+    def __unbuffered(pipe):
         """
-        data = self.__read_from_pipe(size)
-        # FIXME: can generate error, why?
-        size = struct.unpack('!h', data)
-        data = self.__read_from_pipe(size[0])
-        return data
+        Open pipe's file descriptor without buffering, so read returns as soon as any data is available.
+        Pipes without descriptor are used as they are.
 
-    def __read_from_pipe(self, size):
+        :param pipe: file object
+        :return: unbuffered file object
         """
-        Read binary string from pipe.
+        try:
+            return io.open(pipe.fileno(), 'rb', buffering=0, closefd=False)
+        except (AttributeError, TypeError, ValueError, IOError):
+            return pipe
+
+    def __handle_frame(self, header_data, message_data, peeked=None):
+        """
+        Handle binary header and message. Type of message is peeked first,
+        so PING, CLIENT_DIED and unknown messages are handled without parsing.
 
-        :param size: size of read string
-        :return: binary string
+        :param header_data: binary string of DriverHdr
+        :param message_data: binary string of DriverMsg
+        :param peeked: type and synNum of message, if already peeked
+        :return: nothing
         """
-        return self.__pipe_in.read(size)
+        message_type, syn_num = wire.peek_message(message_data) if peeked is None else peeked
+
+        if message_type in (drivermsg_pb2.DriverMsg.DATA,
+                            drivermsg_pb2.DriverMsg.SUBSCRIBE,
+                            drivermsg_pb2.DriverMsg.UNSUBSCRIBE):
+            header, message = self.__message_pool.acquire()
+            try:
+                header.ParseFromString(header_data)
+                message.ParseFromString(message_data)
+                self.__handle_header_and_message(header, message)
+            finally:
+                self.__message_pool.release(header, message)
+
+        elif message_type == drivermsg_pb2.DriverMsg.PING:
+            self.__logger.debug('Received PING message')
+            self.__handle_ping(wire.peek_client_ids(header_data), syn_num)
+
+        elif message_type == drivermsg_pb2.DriverMsg.CLIENT_DIED:
+            self.__logger.debug('Received CLIENT_DIED message')
+            self.__handle_client_died(wire.peek_client_ids(header_data))
+
+        else:
+            self.__logger.warning('Received unknown type message, ignoring.')
 
     def __handle_header_and_message(self, header, message):
         """
-        Handle any message. Not serviced message are PONG and DRIVER_DIED.
+        Handle parsed DATA, SUBSCRIBE or UNSUBSCRIBE message, other types are handled by `__handle_frame`.
 
         :param header: object of DriverHdr
         :param message: object of DriverMsg
@@ -118,81 +486,87 @@ class AmberPipes(object):
             self.__logger.debug('Received UNSUBSCRIBE message')
             self.__message_handler.handle_unsubscribe_message(header, message)
 
-        elif message.type == drivermsg_pb2.DriverMsg.CLIENT_DIED:
-            self.__logger.debug('Received CLIENT_DIED message')
-            self.__handle_client_died_message(header, message)
-
-        elif message.type == drivermsg_pb2.DriverMsg.PING:
-            self.__logger.debug('Received PING message')
-            self.__handle_ping_message(header, message)
-
-        else:
-            self.__logger.warning('Received unknown type message, ignoring.')
-
-    def __handle_client_died_message(self, header, _):
-        """
-        Handle CLIENT_DIED message which came from mediator.
-        Handling message delegated to message handler.
-
-        :param header: object of DriverHdr
-        :return: nothing
-        """
-        if len(header.clientIDs) < 1:
+    def __handle_client_died(self, client_ids):
+        if len(client_ids) < 1:
             self.__logger.warning('CLIENT_DIED\'s clientID not set, ignoring.')
 
         else:
-            self.__message_handler.handle_client_died_message(header.clientIDs[0])
-
-    def __handle_ping_message(self, ping_header, ping_message):
-        """
-        Handle PING message which came from mediator.
+            self.__message_handler.handle_client_died_message(client_ids[0])
 
-        :param ping_header: object of DriverHdr
-        :param ping_message: object of DriverMsg
-        :return: nothing
-        """
-        if not ping_message.HasField('synNum'):
+    def __handle_ping(self, client_ids, syn_num):
+        if syn_num is None:
             self.__logger.warning('PING\'s synNum is not set, ignoring.')
 
         else:
-            pong_message = drivermsg_pb2.DriverMsg()
-            pong_message.type = drivermsg_pb2.DriverMsg.PONG
-            pong_message.ackNum = ping_message.synNum
-
-            pong_header = drivermsg_pb2.DriverHdr()
-            pong_header.clientIDs.extend(ping_header.clientIDs)
-
             self.__logger.debug('Send PONG message')
 
-            self.write_header_and_message_to_pipe(pong_header, pong_message)
+            pong_header_data = wire.encode_header(client_ids)
+            pong_message_data = wire.encode_message(drivermsg_pb2.DriverMsg.PONG, ack_num=syn_num)
+
+            self.write_data_to_pipe(pong_header_data, pong_message_data, CONTROL)
 
-    def write_header_and_message_to_pipe(self, header, message):
+    def write_header_and_message_to_pipe(self, header, message, message_class=REPLY):
         """
         Serialize and write header and message to pipe.
+        If writer thread is enabled, frame is only queued to be written.
 
         :param header: object of DriverHdr
         :param message: object of DriverMsg
+        :param message_class: class of message, see `outbound_queue`
         :return: nothing
         """
         self.__logger.debug('Write header and message to pipe:\nHEADER:\n%s\n---\nMESSAGE:\n%s\n---',
                             str(header).strip(), str(message).strip()[:200])
 
-        self.__write_lock.acquire()
         try:
             header_data = header.SerializeToString()
             message_data = message.SerializeToString()
 
-            header_binary_data = struct.pack('!h', len(header_data)) + header_data
-            message_binary_data = struct.pack('!h', len(message_data)) + message_data
-
-            self.__write_to_pipe(header_binary_data + message_binary_data)
-
         except BaseException as e:
             traceback.print_exc(e)
             raise AmberException(cause=e)
 
-        finally:
-            self.__write_lock.release()
+        self.write_data_to_pipe(header_data, message_data, message_class)
+
+    def write_data_to_pipe(self, header_data, message_data, message_class=REPLY):
+        """
+        Write already serialized header and message to pipe.
+        If writer thread is enabled, frame is only queued to be written. Thread reading pipes
+        does not wait, when queue of replies is full, reply is dropped then.
+        Raise FrameLengthError, if header or message does not fit in frame.
+
+        :param header_data: binary string of DriverHdr
+        :param message_data: binary string of DriverMsg
+        :param message_class: class of message, see `outbound_queue`
+        :return: True if frame is written or queued, False if it is dropped
+        """
+        if len(header_data) > MAX_LENGTH:
+            raise FrameLengthError(len(header_data), MAX_LENGTH)
+        if len(message_data) > MAX_LENGTH:
+            raise FrameLengthError(len(message_data), MAX_LENGTH)
+
+        header_binary_data = struct.pack(LEN_FORMAT, len(header_data)) + header_data
+        message_binary_data = struct.pack(LEN_FORMAT, len(message_data)) + message_data
+
+        if self.__frame_writer is not None:
+            block = threading.current_thread() is not self.__pipes_thread
+            if not self.__frame_writer.put(header_binary_data + message_binary_data, message_class, block):
+                self.__logger.warning('amber_pipes: queue of outbound frames full or closed, frame dropped')
+                return False
+
+        else:
+            self.__write_lock.acquire()
+            try:
+                self.__write_to_pipe(header_binary_data + message_binary_data)
+
+            except BaseException as e:
+                traceback.print_exc(e)
+                raise AmberException(cause=e)
+
+            finally:
+                self.__write_lock.release()
+
+        return True
 
     def __write_to_pipe(self, binary_string):
         """
@@ -205,4 +579,9 @@ class AmberPipes(object):
         self.__pipe_out.flush()
 
     def terminate(self):
-        self.__is_alive = False
\ No newline at end of file
+        self.__is_alive = False
+        if self.__latest_wins is not None:
+            self.__logger.info('amber_pipes: superseded requests %d', self.__superseded_count)
+        if self.__frame_writer is not None:
+            self.__logger.info('amber_pipes: outbound frames %s', str(self.__frame_writer.get_counters()))
+            self.__frame_writer.terminate()
\ No newline at end of file
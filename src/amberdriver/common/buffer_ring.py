@@ -0,0 +1,103 @@
+import collections
+import threading
+
+
+__author__ = 'paoolo'
+
+
+class BufferRing(object):
+    """
+    Ring of preallocated buffers passed from reading stage to decoding stage.
+
+    Reader acquires free buffer, fills it and puts it to ring, decoder takes filled buffer
+    and releases it, when done. When decoder falls behind, reader gets the oldest filled
+    buffer instead of free one, so reader never waits for decoder and stale data is dropped.
+    """
+
+    def __init__(self, count, size):
+        """
+        :param count: number of buffers, at least 2
+        :param size: size of buffer in bytes
+        """
+        self.__free = collections.deque(bytearray(size) for _ in xrange(max(count, 2)))
+        self.__filled = collections.deque()
+        self.__condition = threading.Condition()
+        self.__is_open = True
+        self.__dropped = 0
+
+    def acquire(self):
+        """
+        Get buffer to fill. Free buffer is preferred, otherwise the oldest filled one is dropped and reused.
+
+        :return: bytearray
+        """
+        self.__condition.acquire()
+        try:
+            while len(self.__free) == 0 and len(self.__filled) == 0:
+                self.__condition.wait()
+
+            if len(self.__free) > 0:
+                return self.__free.popleft()
+            self.__dropped += 1
+            return self.__filled.popleft()
+        finally:
+            self.__condition.release()
+
+    def put(self, buffer):
+        """
+        Pass filled buffer to decoder.
+
+        :param buffer: buffer acquired from ring
+        :return: nothing
+        """
+        self.__condition.acquire()
+        try:
+            self.__filled.append(buffer)
+            self.__condition.notify_all()
+        finally:
+            self.__condition.release()
+
+    def take(self):
+        """
+        Take the oldest filled buffer, wait if there is none.
+
+        :return: bytearray, None if ring is closed and nothing is left
+        """
+        self.__condition.acquire()
+        try:
+            while self.__is_open and len(self.__filled) == 0:
+                self.__condition.wait()
+
+            if len(self.__filled) > 0:
+                return self.__filled.popleft()
+            return None
+        finally:
+            self.__condition.release()
+
+    def release(self, buffer):
+        """
+        Hand back buffer taken from ring, so it can be filled again.
+
+        :param buffer: buffer taken from ring
+        :return: nothing
+        """
+        self.__condition.acquire()
+        try:
+            self.__free.append(buffer)
+            self.__condition.notify_all()
+        finally:
+            self.__condition.release()
+
+    def close(self):
+        """
+        Stop decoder, when buffers already filled are taken.
+        """
+        self.__condition.acquire()
+        try:
+            self.__is_open = False
+            self.__condition.notify_all()
+        finally:
+            self.__condition.release()
+
+    def get_dropped_count(self):
+        return self.__dropped
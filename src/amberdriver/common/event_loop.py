@@ -0,0 +1,193 @@
+import collections
+import errno
+import fcntl
+import heapq
+import itertools
+import logging
+import logging.config
+import select
+import threading
+import time
+import traceback
+
+import os
+
+
+__author__ = 'paoolo'
+
+LOGGER_NAME = 'EventLoop'
+pwd = os.path.dirname(os.path.abspath(__file__))
+logging.config.fileConfig('%s/amber.ini' % pwd)
+
+
+def set_non_blocking(fd):
+    flags = fcntl.fcntl(fd, fcntl.F_GETFL)
+    fcntl.fcntl(fd, fcntl.F_SETFL, flags | os.O_NONBLOCK)
+
+
+class EventLoop(object):
+    """
+    Single threaded loop. Waits with select for readable and writable pipes
+    and runs delayed and periodic tasks in between, so driver needs no sleeping threads.
+    """
+
+    def __init__(self):
+        self.__readers, self.__writers = {}, {}
+
+        self.__timers = []
+        self.__timers_sequence = itertools.count()
+
+        self.__callbacks = collections.deque()
+        self.__callbacks_lock = threading.Lock()
+
+        self.__wakeup_in, self.__wakeup_out = os.pipe()
+        set_non_blocking(self.__wakeup_in)
+        set_non_blocking(self.__wakeup_out)
+
+        self.__loop_thread = None
+        self.__is_alive = True
+
+        self.__logger = logging.getLogger(LOGGER_NAME)
+
+    def add_reader(self, fd, callback):
+        self.__readers[fd] = callback
+
+    def remove_reader(self, fd):
+        self.__readers.pop(fd, None)
+
+    def add_writer(self, fd, callback):
+        self.__writers[fd] = callback
+
+    def remove_writer(self, fd):
+        self.__writers.pop(fd, None)
+
+    def is_loop_thread(self):
+        return self.__loop_thread is threading.current_thread()
+
+    def call_soon(self, callback, *args):
+        """
+        Run callback in loop as soon as possible. Can be called from any thread.
+
+        :param callback: function to call
+        :return: nothing
+        """
+        self.__callbacks_lock.acquire()
+        try:
+            self.__callbacks.append((callback, args))
+        finally:
+            self.__callbacks_lock.release()
+        self.__wakeup()
+
+    def call_later(self, delay, callback, *args):
+        """
+        Run callback in loop after delay. Must be called from loop thread or before loop is started.
+
+        :param delay: delay in seconds
+        :param callback: function to call
+        :return: nothing
+        """
+        self.__call_at(time.time() + delay, callback, args)
+
+    def call_periodically(self, interval, callback, *args):
+        """
+        Run callback in loop every interval. Next run is planned from previous deadline,
+        so intervals do not drift; missed runs are skipped.
+
+        :param interval: interval in seconds
+        :param callback: function to call
+        :return: nothing
+        """
+
+        def periodic(deadline):
+            try:
+                callback(*args)
+            finally:
+                deadline += interval
+                current_timestamp = time.time()
+                if deadline < current_timestamp:
+                    deadline = current_timestamp + interval
+                self.__call_at(deadline, periodic, (deadline,))
+
+        deadline = time.time() + interval
+        self.__call_at(deadline, periodic, (deadline,))
+
+    def __call_at(self, deadline, callback, args):
+        heapq.heappush(self.__timers, (deadline, next(self.__timers_sequence), callback, args))
+
+    def run(self):
+        self.__loop_thread = threading.current_thread()
+        self.__logger.info('Event loop started.')
+
+        while self.__is_alive:
+            try:
+                readable, writable, _ = select.select(list(self.__readers) + [self.__wakeup_in],
+                                                      list(self.__writers), [], self.__get_timeout())
+            except (select.error, IOError, OSError) as e:
+                if e.args[0] == errno.EINTR:
+                    continue
+                raise
+
+            for fd in readable:
+                if fd == self.__wakeup_in:
+                    self.__drain_wakeup()
+                else:
+                    self.__run(self.__readers.get(fd))
+
+            for fd in writable:
+                self.__run(self.__writers.get(fd))
+
+            self.__run_callbacks()
+            self.__run_timers()
+
+        self.__logger.warning('event_loop: stop')
+
+    def stop(self):
+        self.__is_alive = False
+        self.__wakeup()
+
+    def __get_timeout(self):
+        if len(self.__callbacks) > 0:
+            return 0.0
+        if len(self.__timers) > 0:
+            return max(0.0, self.__timers[0][0] - time.time())
+        return None
+
+    def __run_callbacks(self):
+        self.__callbacks_lock.acquire()
+        try:
+            callbacks = list(self.__callbacks)
+            self.__callbacks.clear()
+        finally:
+            self.__callbacks_lock.release()
+
+        for callback, args in callbacks:
+            self.__run(callback, *args)
+
+    def __run_timers(self):
+        current_timestamp = time.time()
+        while len(self.__timers) > 0 and self.__timers[0][0] <= current_timestamp:
+            _, _, callback, args = heapq.heappop(self.__timers)
+            self.__run(callback, *args)
+
+    def __run(self, callback, *args):
+        if callback is not None:
+            try:
+                callback(*args)
+            except Exception:
+                traceback.print_exc()
+                self.__logger.warning('event_loop: error in callback %s', str(callback))
+
+    def __wakeup(self):
+        try:
+            os.write(self.__wakeup_out, '\0')
+        except OSError as e:
+            if e.errno not in (errno.EAGAIN, errno.EWOULDBLOCK):
+                raise
+
+    def __drain_wakeup(self):
+        try:
+            while os.read(self.__wakeup_in, 4096):
+                pass
+        except OSError as e:
+            if e.errno not in (errno.EAGAIN, errno.EWOULDBLOCK):
+                raise
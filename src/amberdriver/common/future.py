@@ -0,0 +1,97 @@
+import threading
+
+__author__ = 'paoolo'
+
+
+class Future(object):
+    """
+    Result of operation, which will be available later.
+    Callbacks are called with future, in thread which sets result.
+    """
+
+    def __init__(self):
+        self.__done = False
+        self.__result, self.__exception = None, None
+
+        self.__callbacks = []
+        self.__done_condition = threading.Condition()
+
+    def done(self):
+        return self.__done
+
+    def result(self, timeout=None):
+        """
+        Wait for result.
+
+        :param timeout: timeout in seconds or None to wait forever
+        :return: result of operation, raise exception of operation if failed
+        """
+        self.__done_condition.acquire()
+        try:
+            if not self.__done:
+                self.__done_condition.wait(timeout)
+            if not self.__done:
+                raise RuntimeError('result not available in %s seconds' % str(timeout))
+        finally:
+            self.__done_condition.release()
+
+        if self.__exception is not None:
+            raise self.__exception
+        return self.__result
+
+    def set_result(self, result):
+        self.__set_done(result, None)
+
+    def set_exception(self, exception):
+        self.__set_done(None, exception)
+
+    def add_done_callback(self, callback):
+        self.__done_condition.acquire()
+        try:
+            if not self.__done:
+                self.__callbacks.append(callback)
+                return
+        finally:
+            self.__done_condition.release()
+
+        callback(self)
+
+    def then(self, func):
+        """
+        Chain operation on result.
+
+        :param func: function called with result of this future
+        :return: future of result of func
+        """
+        future = Future()
+
+        def done_callback(_):
+            try:
+                future.set_result(func(self.result()))
+            except Exception as e:
+                future.set_exception(e)
+
+        self.add_done_callback(done_callback)
+        return future
+
+    def __set_done(self, result, exception):
+        self.__done_condition.acquire()
+        try:
+            if self.__done:
+                raise RuntimeError('future already done')
+            self.__result, self.__exception = result, exception
+            self.__done = True
+            self.__done_condition.notify_all()
+
+            callbacks, self.__callbacks = self.__callbacks, []
+        finally:
+            self.__done_condition.release()
+
+        for callback in callbacks:
+            callback(self)
+
+    @staticmethod
+    def of(result):
+        future = Future()
+        future.set_result(result)
+        return future
@@ -1,13 +1,22 @@
 from functools import wraps
+import itertools
 import logging
 import threading
 import logging.config
 import abc
+import traceback
 
+from ambercommon.common import runtime
 import os
 
-from amberdriver.common import drivermsg_pb2
-from amberdriver.common.amber_pipes import AmberPipes
+from amberdriver.common import drivermsg_pb2, wire
+from amberdriver.common.amber_pipes import AmberPipes, FrameLengthError
+from amberdriver.common.event_loop import EventLoop
+from amberdriver.common.future import Future
+from amberdriver.common.outbound_queue import REPLY, SUBSCRIPTION
+from amberdriver.common.token_bucket import TokenBucket
+from amberdriver.common.worker_pool import WorkerPool
+from amberdriver.tools import config
 
 
 __author__ = 'paoolo'
@@ -15,17 +24,48 @@ __author__ = 'paoolo'
 LOGGER_NAME = 'MessageHandler'
 pwd = os.path.dirname(os.path.abspath(__file__))
 logging.config.fileConfig('%s/amber.ini' % pwd)
+config.add_config_ini('%s/amber.ini' % pwd)
+
+HANDLER_WORKERS = int(config.AMBER_HANDLER_WORKERS)
 
 
 class MessageHandler(object):
-    def __init__(self, pipe_in, pipe_out):
-        self.__amber_pipes = AmberPipes(self, pipe_in, pipe_out)
+    __data_handlers_by_class = {}
+
+    def __init__(self, pipe_in, pipe_out, handler_workers=HANDLER_WORKERS):
+        self.__data_handlers, latest_wins, self.__rate_limits = MessageHandler.__get_data_handlers(type(self))
+        self.__amber_pipes = AmberPipes(self, pipe_in, pipe_out, latest_wins)
+        self.__message_pool = self.__amber_pipes.get_message_pool()
 
-        self.__subscribers = []
+        # immutable snapshots, replaced on every change, so publishing takes no lock and makes no copy
+        self.__subscribers = ()
+        self.__rate_classes = ()
+        self.__decimation_by_subscriber = {}
         self.__subscribers_lock = threading.Lock()
+        self.__publish_counter = itertools.count()
+
+        self.__in_flight = {}
+        self.__in_flight_lock = threading.Lock()
+
+        self.__token_buckets = {}
+        self.__cached_responses = {}
+        self.__throttled_counts = dict((extension_number, 0) for extension_number in self.__rate_limits)
+        self.__admission_lock = threading.Lock()
 
         self.__logger = logging.getLogger(LOGGER_NAME)
 
+        self.handle_client_died_message = self.__forgetting_client(self.handle_client_died_message)
+
+        if handler_workers > 0:
+            self.__worker_pool = WorkerPool(handler_workers, name='handler')
+            runtime.add_shutdown_hook(self.__worker_pool.terminate)
+
+            # PING is still handled in pipes thread
+            self.handle_data_message = self.__dispatched(self.handle_data_message)
+            self.handle_subscribe_message = self.__dispatched(self.handle_subscribe_message)
+            self.handle_unsubscribe_message = self.__dispatched(self.handle_unsubscribe_message)
+            self.handle_client_died_message = self.__dispatched_client_died(self.handle_client_died_message)
+
     def __call__(self, *args, **kwargs):
         self.__amber_pipes(*args, **kwargs)
 
@@ -35,9 +75,253 @@ class MessageHandler(object):
     def get_pipes(self):
         return self.__amber_pipes
 
-    @abc.abstractmethod
+    def get_message_pool(self):
+        """
+        Received header and message are handed back to pool after handler returns.
+        Handler, which uses them later, must retain them in pool and release them when done.
+
+        :return: pool of messages
+        """
+        return self.__message_pool
+
+    def __dispatched(self, handle):
+        """
+        Wrap handler to run it in worker pool. Messages of one client are handled by one worker,
+        so they are handled in order of arrival. Header and message are retained until handled.
+
+        :param handle: handler of message
+        :return: wrapped handler
+        """
+
+        @wraps(handle)
+        def dispatch(header, message):
+            client_id = header.clientIDs[0] if len(header.clientIDs) > 0 else None
+            self.__message_pool.retain(header, message)
+            self.__worker_pool.submit(client_id, self.__handle_and_release, handle, header, message)
+
+        return dispatch
+
+    def __dispatched_client_died(self, handle):
+        """
+        Wrap handler of CLIENT_DIED to run it in worker pool, by the same worker as messages of the client,
+        so it is handled after messages of the client received before.
+
+        :param handle: handler of CLIENT_DIED message
+        :return: wrapped handler
+        """
+
+        @wraps(handle)
+        def dispatch(client_id):
+            self.__worker_pool.submit(client_id, handle, client_id)
+
+        return dispatch
+
+    def __forgetting_client(self, handle):
+        """
+        Wrap handler of CLIENT_DIED to drop token buckets and cached responses of the client as well.
+
+        :param handle: handler of CLIENT_DIED message
+        :return: wrapped handler
+        """
+
+        @wraps(handle)
+        def handle_client_died(client_id):
+            try:
+                handle(client_id)
+            finally:
+                self.__remove_admission_state(client_id)
+
+        return handle_client_died
+
+    def __handle_and_release(self, handle, header, message):
+        try:
+            handle(header, message)
+        finally:
+            self.__message_pool.release(header, message)
+
+    @staticmethod
+    def handles(extension, latest_wins=False, rate_limit=0.0, burst=1):
+        """
+        Decorate handler of DATA message, which contains given request extension.
+
+        :param extension: extension of DriverMsg, e.g. dummy_pb2.get_status
+        :param latest_wins: if many requests of the same clients are read at once,
+                            only the latest one is handled, e.g. for setting speed
+        :param rate_limit: requests per second allowed for each client, 0 if unlimited;
+                           requests over limit are answered with the latest response or rejected
+        :param burst: requests allowed at once for each client
+        :return: decorator
+        """
+
+        def decorator(func):
+            func.handled_extension = extension
+            func.latest_wins = latest_wins
+            func.rate_limit = (rate_limit, burst) if rate_limit > 0 else None
+            return func
+
+        return decorator
+
+    @staticmethod
+    def __get_data_handlers(cls):
+        """
+        Collect handlers decorated with `handles` in class and its bases.
+
+        :param cls: class of message handler
+        :return: dict of extension number to handler's attribute name,
+                 dict of extension number to latest-wins flag
+                 and dict of extension number to rate limit and burst of limited handlers
+        """
+        data_handlers = MessageHandler.__data_handlers_by_class.get(cls)
+        if data_handlers is None:
+            names, latest_wins, rate_limits = {}, {}, {}
+            for klass in reversed(cls.__mro__):
+                for name, value in klass.__dict__.items():
+                    extension = getattr(value, 'handled_extension', None)
+                    if extension is not None:
+                        names[extension.number] = name
+                        latest_wins[extension.number] = getattr(value, 'latest_wins', False)
+                        rate_limits.pop(extension.number, None)
+                        if getattr(value, 'rate_limit', None) is not None:
+                            rate_limits[extension.number] = value.rate_limit
+            data_handlers = MessageHandler.__data_handlers_by_class[cls] = (names, latest_wins, rate_limits)
+        return data_handlers
+
     def handle_data_message(self, header, message):
-        pass
+        """
+        Handle DATA message by handler of first request extension set in message.
+
+        :param header: object of DriverHdr
+        :param message: object of DriverMsg
+        :return: nothing
+        """
+        for field, _ in message.ListFields():
+            name = self.__data_handlers.get(field.number)
+            if name is not None:
+                if field.number in self.__rate_limits and not self.__admit(header, field.number):
+                    self.__answer_throttled(header, message, field.number)
+                else:
+                    getattr(self, name)(header, message)
+                return
+
+        self.__logger.warning('No recognizable request in message')
+
+    def __admit(self, header, extension_number):
+        client_id = header.clientIDs[0] if len(header.clientIDs) > 0 else None
+        self.__admission_lock.acquire()
+        try:
+            token_bucket = self.__token_buckets.get((client_id, extension_number))
+            if token_bucket is None:
+                rate_limit, burst = self.__rate_limits[extension_number]
+                token_bucket = self.__token_buckets[(client_id, extension_number)] = TokenBucket(rate_limit, burst)
+            if token_bucket.try_take():
+                return True
+            self.__throttled_counts[extension_number] += 1
+            return False
+        finally:
+            self.__admission_lock.release()
+
+    def __remove_admission_state(self, client_id):
+        self.__admission_lock.acquire()
+        try:
+            for key in [key for key in self.__token_buckets if key[0] == client_id]:
+                del self.__token_buckets[key]
+            removed = [self.__cached_responses.pop(key) for key in self.__cached_responses.keys()
+                       if key[0] == client_id]
+        finally:
+            self.__admission_lock.release()
+
+        for cached_response in removed:
+            if cached_response[1] is not None:
+                self.__message_pool.release(cached_response[0], cached_response[1])
+
+    def __answer_throttled(self, header, message, extension_number):
+        """
+        Answer request over rate limit with the latest response to the same request of the same client,
+        reject it if there is none. Request is rejected with response without extensions,
+        if client waits for response to it.
+        """
+        client_id = header.clientIDs[0] if len(header.clientIDs) > 0 else None
+        self.__admission_lock.acquire()
+        try:
+            cached_response = self.__cached_responses.get((client_id, extension_number))
+            if cached_response is not None and cached_response[2] is None:
+                # serialized once, only when needed; extensions are the same in every answer
+                response_message_data = cached_response[1].SerializeToString()
+                cached_response[2] = response_message_data[wire.extensions_position(response_message_data):]
+        finally:
+            self.__admission_lock.release()
+
+        if cached_response is None:
+            self.__logger.warning('Request %d of clients %s over rate limit, rejected',
+                                  extension_number, str(header.clientIDs))
+            if message.HasField('synNum'):
+                self.__write_extensions(header.clientIDs, message.synNum, '')
+            return
+
+        self.__logger.debug('Request %d of clients %s over rate limit, answered with cached response',
+                            extension_number, str(header.clientIDs))
+        self.__write_extensions(header.clientIDs, message.synNum, cached_response[2])
+
+    def __write_extensions(self, client_ids, ack_num, extensions_data, message_class=REPLY):
+        """
+        Write DATA message made of already serialized extensions.
+        """
+        response_header_data = wire.encode_header(client_ids)
+        response_message_data = wire.encode_message(drivermsg_pb2.DriverMsg.DATA, ack_num=ack_num)
+        self.get_pipes().write_data_to_pipe(response_header_data, response_message_data + extensions_data,
+                                            message_class)
+
+    def __send_response(self, rate_limited_request, ack_num, response_header, response_message):
+        """
+        Write response to pipe. Response, which does not fit in frame, is replaced with response
+        without extensions, so client waiting for it is answered anyway.
+        """
+        try:
+            if isinstance(response_message, str):
+                self.__write_extensions(response_header.clientIDs, ack_num, response_message)
+            else:
+                self.get_pipes().write_header_and_message_to_pipe(response_header, response_message)
+        except FrameLengthError as e:
+            self.__logger.warning('Response %d to clients %s too large, rejected: %s',
+                                  ack_num, str(response_header.clientIDs), str(e))
+            self.__write_extensions(response_header.clientIDs, ack_num, '')
+            return
+
+        if rate_limited_request is not None:
+            self.__cache_response(rate_limited_request, response_header, response_message)
+
+    def __cache_response(self, request_key, response_header, response_message):
+        """
+        Keep response to rate limited request of client. It is retained in pool, until next response
+        to the same client replaces it or client dies. Serialized extensions are kept as they are.
+
+        :param request_key: client id and request extension number
+        """
+        if isinstance(response_message, str):
+            cached_response = [None, None, response_message]
+        else:
+            self.__message_pool.retain(response_header, response_message)
+            cached_response = [response_header, response_message, None]
+
+        self.__admission_lock.acquire()
+        try:
+            replaced = self.__cached_responses.get(request_key)
+            self.__cached_responses[request_key] = cached_response
+        finally:
+            self.__admission_lock.release()
+
+        if replaced is not None and replaced[1] is not None:
+            self.__message_pool.release(replaced[0], replaced[1])
+
+    def get_throttled_counts(self):
+        """
+        :return: dict of request extension number to number of requests over rate limit
+        """
+        self.__admission_lock.acquire()
+        try:
+            return dict(self.__throttled_counts)
+        finally:
+            self.__admission_lock.release()
 
     @abc.abstractmethod
     def handle_subscribe_message(self, header, message):
@@ -51,68 +335,231 @@ class MessageHandler(object):
     def handle_client_died_message(self, client_id):
         pass
 
-    def fill_subscription_response(self, response_message):
+    def fill_subscription_response(self, response_message, *args):
+        """
+        Fill subscription message.
+
+        :param response_message: object of DriverMsg
+        :param args: arguments given to `send_subscribers_message`, e.g. data to publish
+        :return: filled message, or binary string of already serialized extensions
+        """
         pass
 
-    def send_subscribers_message(self):
-        subscribers = self.__get_subscribers()
-        if len(subscribers) > 0:
-            response_header = drivermsg_pb2.DriverHdr()
-            response_message = drivermsg_pb2.DriverMsg()
+    def send_subscribers_message(self, *args):
+        """
+        Send subscription message to subscribers, which are due in this round according to their decimation.
+        Message is filled and serialized once for all of them.
 
-            response_message.type = drivermsg_pb2.DriverMsg.DATA
-            response_message.ackNum = 0
+        :param args: arguments passed to `fill_subscription_response`, e.g. data to publish
+        :return: nothing
+        """
+        rate_classes = self.__rate_classes
+        if len(rate_classes) > 0:
+            count = next(self.__publish_counter)
+            subscribers = []
+            for decimation, client_ids in rate_classes:
+                if count % decimation == 0:
+                    subscribers.extend(client_ids)
 
-            response_header.clientIDs.extend(subscribers)
-            response_message = self.fill_subscription_response(response_message)
+            if len(subscribers) > 0:
+                response_header, response_message = self.__message_pool.acquire()
+                try:
+                    response_message.type = drivermsg_pb2.DriverMsg.DATA
+                    response_message.ackNum = 0
 
-            self.get_pipes().write_header_and_message_to_pipe(response_header, response_message)
+                    response_header.clientIDs.extend(subscribers)
+                    response = self.fill_subscription_response(response_message, *args)
 
-    def __get_subscribers(self):
-        self.__subscribers_lock.acquire()
-        try:
-            return list(self.__subscribers)
-        finally:
-            self.__subscribers_lock.release()
+                    if isinstance(response, str):
+                        self.__write_extensions(subscribers, 0, response, SUBSCRIPTION)
+                    else:
+                        self.get_pipes().write_header_and_message_to_pipe(response_header, response, SUBSCRIPTION)
+                except FrameLengthError as e:
+                    self.__logger.warning('Subscription message too large, not sent: %s', str(e))
+                finally:
+                    self.__message_pool.release(response_header, response_message)
+
+    @staticmethod
+    def get_decimation(message):
+        """
+        Get decimation requested in SUBSCRIBE message.
+
+        :param message: object of DriverMsg
+        :return: decimation, 1 if not set
+        """
+        if message.HasField('decimation') and message.decimation > 1:
+            return message.decimation
+        return 1
 
-    def add_subscribers(self, client_ids):
+    def get_subscribers(self):
+        return self.__subscribers
+
+    def add_subscribers(self, client_ids, decimation=1):
+        """
+        Register clients as subscribers. Already registered clients only get new decimation.
+
+        :param client_ids: list of client ids
+        :param decimation: send every n-th subscription message to clients
+        :return: nothing
+        """
         self.__subscribers_lock.acquire()
         try:
-            self.__subscribers.extend(client_ids)
+            for client_id in client_ids:
+                if self.__decimation_by_subscriber.get(client_id) == decimation:
+                    self.__logger.warning('Client %d already registered as subscriber, ignoring.', client_id)
+                    continue
+                if client_id not in self.__decimation_by_subscriber:
+                    self.__subscribers += (client_id,)
+                self.__decimation_by_subscriber[client_id] = decimation
+            self.__update_rate_classes()
         finally:
             self.__subscribers_lock.release()
 
     def remove_subscriber(self, client_id):
         self.__subscribers_lock.acquire()
         try:
-            self.__subscribers.remove(client_id)
-        except ValueError:
-            self.__logger.warning('Client %d does not registered as subscriber', client_id)
+            if client_id in self.__decimation_by_subscriber:
+                del self.__decimation_by_subscriber[client_id]
+                self.__subscribers = tuple(subscriber for subscriber in self.__subscribers
+                                           if subscriber != client_id)
+                self.__update_rate_classes()
+            else:
+                self.__logger.warning('Client %d does not registered as subscriber', client_id)
         finally:
             self.__subscribers_lock.release()
 
+    def __update_rate_classes(self):
+        client_ids_by_decimation = {}
+        for client_id in self.__subscribers:
+            decimation = self.__decimation_by_subscriber[client_id]
+            client_ids_by_decimation.setdefault(decimation, []).append(client_id)
+        self.__rate_classes = tuple((decimation, tuple(client_ids))
+                                    for decimation, client_ids in sorted(client_ids_by_decimation.items()))
+
     def is_any_subscriber(self):
-        self.__subscribers_lock.acquire()
+        return len(self.__subscribers) > 0
+
+    def single_flight(self, key, func, *args):
+        """
+        Run operation, unless operation with the same key is already in flight.
+        Then future of running operation is returned, so concurrent requests share one operation.
+
+        :param key: key of operation, e.g. request extension
+        :param func: function returning result or future of result
+        :return: future of result
+        """
+        self.__in_flight_lock.acquire()
         try:
-            return len(self.__subscribers) > 0
+            future = self.__in_flight.get(key)
+            if future is not None:
+                return future
+            future = Future()
+            self.__in_flight[key] = future
         finally:
-            self.__subscribers_lock.release()
+            self.__in_flight_lock.release()
+
+        future.add_done_callback(lambda _: self.__remove_in_flight(key))
+
+        try:
+            result = func(*args)
+        except Exception as e:
+            future.set_exception(e)
+        else:
+            if isinstance(result, Future):
+                result.add_done_callback(lambda done: MessageHandler.__pass_result(done, future))
+            else:
+                future.set_result(result)
+
+        return future
+
+    def __remove_in_flight(self, key):
+        self.__in_flight_lock.acquire()
+        try:
+            del self.__in_flight[key]
+        finally:
+            self.__in_flight_lock.release()
+
+    @staticmethod
+    def __pass_result(done, future):
+        try:
+            future.set_result(done.result())
+        except Exception as e:
+            future.set_exception(e)
+
+    def __write_response(self, response, rate_limited_request, pooled_header, pooled_message):
+        try:
+            response_header, response_message = response.result()
+        except Exception:
+            traceback.print_exc()
+            self.__logger.warning('Response not sent, request failed')
+        else:
+            self.__send_response(rate_limited_request, pooled_message.ackNum, response_header, response_message)
+        finally:
+            self.__message_pool.release(pooled_header, pooled_message)
 
     @staticmethod
     def handle_and_response(func):
+        """
+        Decorate handler, which fills response for request.
+        Handler returns response header and message, or future of them, if response is not ready yet.
+        Instead of message, handler may return binary string of serialized extensions,
+        which are sent after type and ackNum of response, e.g. when the same data is sent many times.
+        Response is written to pipe when it is ready, then response objects are handed back to pool.
+        """
+
         @wraps(func)
         def wrapped(inst, received_header, received_message):
-            response_header = drivermsg_pb2.DriverHdr()
-            response_message = drivermsg_pb2.DriverMsg()
+            pooled_header, pooled_message = inst.__message_pool.acquire()
+
+            pooled_message.type = drivermsg_pb2.DriverMsg.DATA
+            pooled_message.ackNum = received_message.synNum
+
+            pooled_header.clientIDs.extend(received_header.clientIDs)
+
+            # set by `handles`, when it decorates this handler; responses are cached for each client
+            rate_limited_request = None
+            if getattr(wrapped, 'rate_limit', None) is not None:
+                client_id = received_header.clientIDs[0] if len(received_header.clientIDs) > 0 else None
+                rate_limited_request = (client_id, wrapped.handled_extension.number)
 
-            response_message.type = drivermsg_pb2.DriverMsg.DATA
-            response_message.ackNum = received_message.synNum
+            try:
+                response = func(inst, received_header, received_message, pooled_header, pooled_message)
+            except BaseException:
+                inst.__message_pool.release(pooled_header, pooled_message)
+                raise
 
-            response_header.clientIDs.extend(received_header.clientIDs)
+            if isinstance(response, Future):
+                response.add_done_callback(
+                    lambda done: inst.__write_response(done, rate_limited_request, pooled_header, pooled_message))
+            else:
+                try:
+                    response_header, response_message = response
+                    inst.__send_response(rate_limited_request, pooled_message.ackNum, response_header,
+                                         response_message)
+                finally:
+                    inst.__message_pool.release(pooled_header, pooled_message)
 
-            response_header, response_message = func(inst, received_header, received_message,
-                                                     response_header, response_message)
+        return wrapped
+
+
+class AsyncMessageHandler(MessageHandler):
+    """
+    Message handler, which handles pipes and runs periodic tasks in one event loop,
+    instead of pipes thread and sleeping threads.
+    """
+
+    def __init__(self, pipe_in, pipe_out, handler_workers=HANDLER_WORKERS):
+        super(AsyncMessageHandler, self).__init__(pipe_in, pipe_out, handler_workers)
+        self.__event_loop = EventLoop()
+
+        runtime.add_shutdown_hook(self.__event_loop.stop)
+
+    def __call__(self, *args, **kwargs):
+        self.get_pipes().attach(self.__event_loop)
+        self.__event_loop.run()
 
-            inst.get_pipes().write_header_and_message_to_pipe(response_header, response_message)
+    def get_event_loop(self):
+        return self.__event_loop
 
-        return wrapped
\ No newline at end of file
+    def call_periodically(self, interval, func, *args):
+        self.__event_loop.call_periodically(interval, func, *args)
@@ -0,0 +1,102 @@
+import collections
+import threading
+
+from amberdriver.common import drivermsg_pb2
+
+
+__author__ = 'paoolo'
+
+
+class PooledPair(object):
+    """
+    Header and message owned by pool, with number of their owners.
+    """
+    __slots__ = ('header', 'message', 'references')
+
+    def __init__(self):
+        self.header, self.message = drivermsg_pb2.DriverHdr(), drivermsg_pb2.DriverMsg()
+        self.references = 0
+
+
+class MessagePool(object):
+    """
+    Pool of DriverHdr and DriverMsg pairs, which are cleared and reused instead of
+    allocating new objects for every frame. At most `size` pairs are pooled, when all of them
+    are in use, new objects are allocated and left to garbage collector after use.
+
+    Pair is owned by code, which acquired it, until it is released. Code, which keeps
+    header or message after handing it back (e.g. handler running later in worker),
+    must retain it first and release it when done. Released pair must not be used anymore.
+    Pair may be released in other thread than the one, which acquired it.
+    """
+
+    def __init__(self, size=8):
+        self.__size = size
+        self.__free = collections.deque()
+        # pooled pairs by id of message, pair keeps message alive, so id is not reused
+        self.__pairs = {}
+        self.__lock = threading.Lock()
+
+    def __get_pair(self, message):
+        pair = self.__pairs.get(id(message))
+        if pair is not None and pair.message is message and pair.references > 0:
+            return pair
+        return None
+
+    def acquire(self):
+        """
+        Get cleared header and message.
+
+        :return: objects of DriverHdr and DriverMsg
+        """
+        self.__lock.acquire()
+        try:
+            if len(self.__free) > 0:
+                pair = self.__free.pop()
+            elif len(self.__pairs) < self.__size:
+                pair = PooledPair()
+                self.__pairs[id(pair.message)] = pair
+            else:
+                return drivermsg_pb2.DriverHdr(), drivermsg_pb2.DriverMsg()
+            pair.references = 1
+            return pair.header, pair.message
+        finally:
+            self.__lock.release()
+
+    def retain(self, header, message):
+        """
+        Keep acquired header and message, until they are released once more.
+        Objects not acquired from pool are ignored.
+        """
+        self.__lock.acquire()
+        try:
+            pair = self.__get_pair(message)
+            if pair is not None:
+                pair.references += 1
+        finally:
+            self.__lock.release()
+
+    def release(self, header, message):
+        """
+        Hand back header and message. They are cleared and reused, when last owner released them.
+        Objects not acquired from pool are ignored.
+        """
+        self.__lock.acquire()
+        try:
+            pair = self.__get_pair(message)
+            if pair is None:
+                return
+            pair.references -= 1
+            if pair.references > 0:
+                return
+        finally:
+            self.__lock.release()
+
+        header.Clear()
+        message.Clear()
+
+        self.__lock.acquire()
+        try:
+            self.__free.append(pair)
+        finally:
+            self.__lock.release()
@@ -0,0 +1,133 @@
+import collections
+import threading
+
+
+__author__ = 'paoolo'
+
+# classes of outbound messages, in order of priority
+CONTROL, REPLY, SUBSCRIPTION = 0, 1, 2
+MESSAGE_CLASSES = (CONTROL, REPLY, SUBSCRIPTION)
+MESSAGE_CLASS_NAMES = ('control', 'reply', 'subscription')
+
+
+class OutboundQueue(object):
+    """
+    Frames waiting to be written to pipe, in bounded queue for each class of message.
+
+    CONTROL frames (e.g. PONG) are never limited, so answering PING never waits.
+    REPLY frames are not dropped, producer waits when queue of replies is full, unless it must not wait
+    (e.g. thread reading pipes, which answers PING), then reply is dropped.
+    SUBSCRIPTION frames are superseded, when queue is full the oldest one is dropped,
+    so stalled pipe costs stale data only.
+
+    Queues are lanes of priority, frames of higher class are always taken first
+    and never wait behind more than one SUBSCRIPTION frame.
+    """
+
+    def __init__(self, reply_size=0, subscription_size=0):
+        """
+        :param reply_size: maximal number of queued replies, 0 if unlimited
+        :param subscription_size: maximal number of queued subscription frames, 0 if unlimited
+        """
+        self.__sizes = (0, reply_size, subscription_size)
+        self.__frames = tuple(collections.deque() for _ in MESSAGE_CLASSES)
+        self.__condition = threading.Condition()
+        self.__is_open = True
+
+        self.__queued = [0] * len(MESSAGE_CLASSES)
+        self.__superseded = [0] * len(MESSAGE_CLASSES)
+        self.__dropped = [0] * len(MESSAGE_CLASSES)
+
+    def put(self, binary_string, message_class, block=True):
+        """
+        Queue frame.
+
+        :param binary_string: binary string of frame
+        :param message_class: CONTROL, REPLY or SUBSCRIPTION
+        :param block: wait for space in queue of replies, if False reply is dropped when queue is full
+        :return: True if frame is queued, False if it is dropped
+        """
+        self.__condition.acquire()
+        try:
+            if not self.__is_open:
+                self.__dropped[message_class] += 1
+                return False
+
+            frames, size = self.__frames[message_class], self.__sizes[message_class]
+            if size > 0 and len(frames) >= size:
+                if message_class == SUBSCRIPTION:
+                    frames.popleft()
+                    self.__superseded[message_class] += 1
+
+                elif not block:
+                    self.__dropped[message_class] += 1
+                    return False
+
+                else:
+                    while self.__is_open and len(frames) >= size:
+                        self.__condition.wait()
+
+            frames.append(binary_string)
+            self.__queued[message_class] += 1
+            self.__condition.notify_all()
+            return True
+        finally:
+            self.__condition.release()
+
+    def take(self, block=True):
+        """
+        Take queued frames, all of CONTROL and REPLY class first, then one of SUBSCRIPTION class.
+        Bulk frames are taken one by one, so frames of higher classes queued meanwhile
+        are written before the next bulk frame.
+
+        :param block: wait for frames
+        :return: list of binary strings, empty if nothing is queued or queue is closed
+        """
+        self.__condition.acquire()
+        try:
+            while block and self.__is_open and self.__is_empty():
+                self.__condition.wait()
+
+            taken = []
+            for frames in self.__frames[:SUBSCRIPTION]:
+                taken.extend(frames)
+                frames.clear()
+            if len(self.__frames[SUBSCRIPTION]) > 0:
+                taken.append(self.__frames[SUBSCRIPTION].popleft())
+
+            self.__condition.notify_all()
+            return taken
+        finally:
+            self.__condition.release()
+
+    def __is_empty(self):
+        for frames in self.__frames:
+            if len(frames) > 0:
+                return False
+        return True
+
+    def close(self):
+        """
+        Stop accepting frames and wake up waiting producers and consumer.
+        Frames already queued can still be taken.
+        """
+        self.__condition.acquire()
+        try:
+            self.__is_open = False
+            self.__condition.notify_all()
+        finally:
+            self.__condition.release()
+
+    def get_counters(self):
+        """
+        :return: dict of message class name to dict of queued, superseded and dropped frames count
+        """
+        self.__condition.acquire()
+        try:
+            return dict((MESSAGE_CLASS_NAMES[message_class],
+                         {'queued': self.__queued[message_class],
+                          'superseded': self.__superseded[message_class],
+                          'dropped': self.__dropped[message_class]})
+                        for message_class in MESSAGE_CLASSES)
+        finally:
+            self.__condition.release()
@@ -0,0 +1,39 @@
+import time
+
+
+__author__ = 'paoolo'
+
+
+class TokenBucket(object):
+    """
+    Token bucket limiting rate of operations. Bucket is refilled with `rate` tokens per second,
+    up to `burst` tokens, and every operation takes one token. Not thread-safe.
+    """
+
+    def __init__(self, rate, burst=1, clock=time.time):
+        """
+        :param rate: tokens per second
+        :param burst: maximal number of tokens, so operations allowed at once
+        :param clock: function returning current time in seconds
+        """
+        self.__rate = float(rate)
+        self.__burst = float(max(burst, 1))
+        self.__clock = clock
+
+        self.__tokens = self.__burst
+        self.__last_refill = clock()
+
+    def try_take(self):
+        """
+        Take token, if available.
+
+        :return: True if operation is allowed
+        """
+        now = self.__clock()
+        self.__tokens = min(self.__burst, self.__tokens + (now - self.__last_refill) * self.__rate)
+        self.__last_refill = now
+
+        if self.__tokens >= 1.0:
+            self.__tokens -= 1.0
+            return True
+        return False
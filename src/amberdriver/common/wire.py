@@ -0,0 +1,265 @@
+import array
+import sys
+
+
+__author__ = 'paoolo'
+
+WIRE_TYPE_VARINT = 0
+WIRE_TYPE_FIXED64 = 1
+WIRE_TYPE_LENGTH_DELIMITED = 2
+WIRE_TYPE_FIXED32 = 5
+
+# field numbers from drivermsg.proto
+HEADER_CLIENT_IDS_FIELD = 3
+MESSAGE_TYPE_FIELD = 2
+MESSAGE_SYN_NUM_FIELD = 3
+MESSAGE_ACK_NUM_FIELD = 4
+MESSAGE_FIRST_EXTENSION_FIELD = 10
+
+
+def decode_varint(data, position):
+    """
+    Decode varint from data.
+
+    :param data: bytearray
+    :param position: position of varint
+    :return: value and position after varint
+    """
+    value, shift = 0, 0
+    while True:
+        byte = data[position]
+        position += 1
+        value |= (byte & 0x7f) << shift
+        if byte < 0x80:
+            return value, position
+        shift += 7
+
+
+def decode_int32(value):
+    return value - (1 << 64) if value > 0x7fffffff else value
+
+
+def decode_tag(data, position):
+    tag, position = decode_varint(data, position)
+    return tag >> 3, tag & 0x07, position
+
+
+def skip_field(data, position, wire_type):
+    """
+    Skip value of field.
+
+    :param data: bytearray
+    :param position: position of value
+    :param wire_type: wire type of field
+    :return: position after value
+    """
+    if wire_type == WIRE_TYPE_VARINT:
+        _, position = decode_varint(data, position)
+    elif wire_type == WIRE_TYPE_FIXED64:
+        position += 8
+    elif wire_type == WIRE_TYPE_LENGTH_DELIMITED:
+        length, position = decode_varint(data, position)
+        position += length
+    elif wire_type == WIRE_TYPE_FIXED32:
+        position += 4
+    else:
+        raise ValueError('unsupported wire type %d' % wire_type)
+    return position
+
+
+def peek_message(message_data):
+    """
+    Get type and synNum of DriverMsg without parsing it.
+    Fields are serialized in order of numbers, so extensions are not scanned.
+
+    :param message_data: binary string of DriverMsg
+    :return: type and synNum, None if not set
+    """
+    data = bytearray(message_data)
+    message_type, syn_num = None, None
+    position = 0
+    while position < len(data):
+        field_number, wire_type, position = decode_tag(data, position)
+        if field_number > MESSAGE_SYN_NUM_FIELD:
+            break
+        if field_number == MESSAGE_TYPE_FIELD and wire_type == WIRE_TYPE_VARINT:
+            message_type, position = decode_varint(data, position)
+        elif field_number == MESSAGE_SYN_NUM_FIELD and wire_type == WIRE_TYPE_VARINT:
+            syn_num, position = decode_varint(data, position)
+        else:
+            position = skip_field(data, position, wire_type)
+    return message_type, syn_num
+
+
+def find_field(message_data, field_numbers):
+    """
+    Find first field, which number is one of given, without parsing message.
+
+    :param message_data: binary string of message
+    :param field_numbers: collection of field numbers
+    :return: number of field or None if not found
+    """
+    data = bytearray(message_data)
+    position = 0
+    while position < len(data):
+        field_number, wire_type, position = decode_tag(data, position)
+        if field_number in field_numbers:
+            return field_number
+        position = skip_field(data, position, wire_type)
+    return None
+
+
+def extensions_position(message_data):
+    """
+    Find where extensions of DriverMsg start. Fields are serialized in order of numbers,
+    so everything from this position are extensions.
+
+    :param message_data: binary string of DriverMsg
+    :return: position of first extension, length of data if there is no extension
+    """
+    data = bytearray(message_data)
+    position = 0
+    while position < len(data):
+        field_number, wire_type, value_position = decode_tag(data, position)
+        if field_number >= MESSAGE_FIRST_EXTENSION_FIELD:
+            return position
+        position = skip_field(data, value_position, wire_type)
+    return position
+
+
+def peek_client_ids(header_data):
+    """
+    Get clientIDs of DriverHdr without parsing it.
+
+    :param header_data: binary string of DriverHdr
+    :return: list of client ids
+    """
+    data = bytearray(header_data)
+    client_ids = []
+    position = 0
+    while position < len(data):
+        field_number, wire_type, position = decode_tag(data, position)
+        if field_number == HEADER_CLIENT_IDS_FIELD and wire_type == WIRE_TYPE_LENGTH_DELIMITED:
+            length, position = decode_varint(data, position)
+            end = position + length
+            while position < end:
+                client_id, position = decode_varint(data, position)
+                client_ids.append(decode_int32(client_id))
+        elif field_number == HEADER_CLIENT_IDS_FIELD and wire_type == WIRE_TYPE_VARINT:
+            client_id, position = decode_varint(data, position)
+            client_ids.append(decode_int32(client_id))
+        else:
+            position = skip_field(data, position, wire_type)
+    return client_ids
+
+
+def encode_varint(value, data=None):
+    """
+    Encode varint, negative values as 64-bit two's complement.
+
+    :param value: integer
+    :param data: bytearray to append to
+    :return: bytearray
+    """
+    if data is None:
+        data = bytearray()
+    if value < 0:
+        value += 1 << 64
+    while value > 0x7f:
+        data.append(0x80 | (value & 0x7f))
+        value >>= 7
+    data.append(value)
+    return data
+
+
+def encode_tag(field_number, wire_type, data=None):
+    return encode_varint(field_number << 3 | wire_type, data)
+
+
+def encode_header(client_ids):
+    """
+    Encode DriverHdr with clientIDs only, as SerializeToString does.
+
+    :param client_ids: list of client ids
+    :return: binary string
+    """
+    data = bytearray()
+    if len(client_ids) > 0:
+        payload = bytearray()
+        for client_id in client_ids:
+            encode_varint(client_id, payload)
+        encode_tag(HEADER_CLIENT_IDS_FIELD, WIRE_TYPE_LENGTH_DELIMITED, data)
+        encode_varint(len(payload), data)
+        data += payload
+    return bytes(data)
+
+
+def encode_message(message_type, ack_num=None):
+    """
+    Encode DriverMsg with type and ackNum only, as SerializeToString does.
+
+    :param message_type: type of message
+    :param ack_num: ackNum or None
+    :return: binary string
+    """
+    data = encode_tag(MESSAGE_TYPE_FIELD, WIRE_TYPE_VARINT)
+    encode_varint(message_type, data)
+    if ack_num is not None:
+        encode_tag(MESSAGE_ACK_NUM_FIELD, WIRE_TYPE_VARINT, data)
+        encode_varint(ack_num, data)
+    return bytes(data)
+
+
+def encode_length_delimited(field_number, payload, data):
+    """
+    Encode field of bytes, string or embedded message.
+
+    :param field_number: number of field
+    :param payload: binary string or bytearray of value
+    :param data: bytearray to append to
+    :return: bytearray
+    """
+    encode_tag(field_number, WIRE_TYPE_LENGTH_DELIMITED, data)
+    encode_varint(len(payload), data)
+    data += payload
+    return data
+
+
+def encode_packed_doubles(field_number, values, data):
+    """
+    Encode packed repeated double field. Empty field is not encoded, as SerializeToString does.
+
+    :param field_number: number of field
+    :param values: array('d') of values
+    :param data: bytearray to append to
+    :return: bytearray
+    """
+    if len(values) > 0:
+        if sys.byteorder != 'little':
+            values = array.array('d', values)
+            values.byteswap()
+        encode_length_delimited(field_number, values.tostring(), data)
+    return data
+
+
+def encode_packed_varints(field_number, values, data):
+    """
+    Encode packed repeated int32, int64 or uint field. Empty field is not encoded, as SerializeToString does.
+
+    :param field_number: number of field
+    :param values: iterable of integers
+    :param data: bytearray to append to
+    :return: bytearray
+    """
+    if len(values) > 0:
+        payload = bytearray()
+        append = payload.append
+        for value in values:
+            if value < 0:
+                value += 1 << 64
+            while value > 0x7f:
+                append(0x80 | (value & 0x7f))
+                value >>= 7
+            append(value)
+        encode_length_delimited(field_number, payload, data)
+    return data
@@ -0,0 +1,58 @@
+import Queue
+import logging
+import logging.config
+import threading
+import traceback
+
+import os
+
+
+__author__ = 'paoolo'
+
+LOGGER_NAME = 'MessageHandler'
+pwd = os.path.dirname(os.path.abspath(__file__))
+logging.config.fileConfig('%s/amber.ini' % pwd)
+
+
+class WorkerPool(object):
+    """
+    Pool of worker threads, each with its own queue of tasks.
+    Tasks submitted with the same key are run by the same worker, in order of submission.
+    """
+
+    def __init__(self, size, name='worker'):
+        self.__queues = [Queue.Queue() for _ in range(size)]
+        self.__logger = logging.getLogger(LOGGER_NAME)
+
+        for index, tasks in enumerate(self.__queues):
+            worker_thread = threading.Thread(target=self.__working_loop, args=(tasks,),
+                                             name='%s-thread-%d' % (name, index))
+            worker_thread.daemon = True
+            worker_thread.start()
+
+    def submit(self, key, func, *args):
+        """
+        Queue task to be run by worker assigned to key.
+
+        :param key: hashable key, e.g. client id
+        :param func: function to call
+        :return: nothing
+        """
+        self.__queues[hash(key) % len(self.__queues)].put((func, args))
+
+    def __working_loop(self, tasks):
+        while True:
+            task = tasks.get()
+            if task is None:
+                break
+
+            func, args = task
+            try:
+                func(*args)
+            except Exception:
+                traceback.print_exc()
+                self.__logger.warning('worker_pool: error in task %s', str(func))
+
+    def terminate(self):
+        for tasks in self.__queues:
+            tasks.put(None)
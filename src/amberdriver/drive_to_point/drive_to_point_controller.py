@@ -23,6 +23,8 @@ config.add_config_ini('%s/drive_to_point.ini' % pwd)
 
 LOGGER_NAME = 'DriveToPointController'
 USE_COLLISION_AVOIDANCE = config.DRIVE_TO_POINT_USE_COLLISION_AVOIDANCE == 'True'
+GET_TARGETS_RATE_LIMIT = float(config.DRIVE_TO_POINT_GET_TARGETS_RATE_LIMIT)
+GET_TARGETS_BURST = int(config.DRIVE_TO_POINT_GET_TARGETS_BURST)
 
 
 class DriveToPointController(MessageHandler):
@@ -31,34 +33,14 @@ class DriveToPointController(MessageHandler):
         self.__drive_to_point = driver
         self.__logger = logging.getLogger(LOGGER_NAME)
 
-    def handle_data_message(self, header, message):
-        if message.HasExtension(drive_to_point_pb2.setTargets):
-            self.__handle_set_targets(header, message)
-
-        elif message.HasExtension(drive_to_point_pb2.getNextTarget):
-            self.__handle_get_next_target(header, message)
-
-        elif message.HasExtension(drive_to_point_pb2.getNextTargets):
-            self.__handle_get_next_targets(header, message)
-
-        elif message.HasExtension(drive_to_point_pb2.getVisitedTarget):
-            self.__handle_get_visited_target(header, message)
-
-        elif message.HasExtension(drive_to_point_pb2.getVisitedTargets):
-            self.__handle_get_visited_targets(header, message)
-
-        elif message.HasExtension(drive_to_point_pb2.getConfiguration):
-            self.__handle_get_configuration(header, message)
-
-        else:
-            self.__logger.warning('No request in message')
-
+    @MessageHandler.handles(drive_to_point_pb2.setTargets)
     def __handle_set_targets(self, header, message):
         self.__logger.debug('Set targets')
         targets = message.Extensions[drive_to_point_pb2.targets]
         targets = zip(targets.longitudes, targets.latitudes, targets.radiuses)
         self.__drive_to_point.set_targets(targets)
 
+    @MessageHandler.handles(drive_to_point_pb2.getNextTarget)
     @MessageHandler.handle_and_response
     def __handle_get_next_target(self, received_header, received_message, response_header, response_message):
         self.__logger.debug('Get next target')
@@ -76,6 +58,8 @@ class DriveToPointController(MessageHandler):
 
         return response_header, response_message
 
+    @MessageHandler.handles(drive_to_point_pb2.getNextTargets,
+                            rate_limit=GET_TARGETS_RATE_LIMIT, burst=GET_TARGETS_BURST)
     @MessageHandler.handle_and_response
     def __handle_get_next_targets(self, received_header, received_message, response_header, response_message):
         self.__logger.debug('Get next targets')
@@ -93,6 +77,7 @@ class DriveToPointController(MessageHandler):
 
         return response_header, response_message
 
+    @MessageHandler.handles(drive_to_point_pb2.getVisitedTarget)
     @MessageHandler.handle_and_response
     def __handle_get_visited_target(self, received_header, received_message, response_header, response_message):
         self.__logger.debug('Get visited target')
@@ -110,6 +95,8 @@ class DriveToPointController(MessageHandler):
 
         return response_header, response_message
 
+    @MessageHandler.handles(drive_to_point_pb2.getVisitedTargets,
+                            rate_limit=GET_TARGETS_RATE_LIMIT, burst=GET_TARGETS_BURST)
     @MessageHandler.handle_and_response
     def __handle_get_visited_targets(self, received_header, received_message, response_header, response_message):
         self.__logger.debug('Get visited targets')
@@ -127,6 +114,7 @@ class DriveToPointController(MessageHandler):
 
         return response_header, response_message
 
+    @MessageHandler.handles(drive_to_point_pb2.getConfiguration)
     @MessageHandler.handle_and_response
     def __handle_get_configuration(self, received_header, received_message, response_header, response_message):
         self.__logger.debug('Get configuration')
@@ -1,13 +1,11 @@
 import logging
 import logging.config
 import sys
-import threading
 import traceback
-import time
 
 import os
 
-from amberdriver.common.message_handler import MessageHandler
+from amberdriver.common.message_handler import MessageHandler, AsyncMessageHandler
 from amberdriver.dummy import dummy_pb2
 from amberdriver.dummy.dummy import Dummy
 from amberdriver.null.null import NullController
@@ -21,12 +19,14 @@ logging.config.fileConfig('%s/dummy.ini' % pwd)
 config.add_config_ini('%s/dummy.ini' % pwd)
 
 LOGGER_NAME = 'DummyController'
+SENDING_INTERVAL = 0.1
 
 
-class DummyController(MessageHandler):
+class DummyController(AsyncMessageHandler):
     """
     Example implementation of driver.
     Need to extends `MessageHandler` from `amber.driver.common.amber_pipes`.
+    Extending `AsyncMessageHandler` runs whole driver in one event loop.
     """
 
     def __init__(self, pipe_in, pipe_out, driver):
@@ -35,28 +35,7 @@ class DummyController(MessageHandler):
         self.__value = 0
         self.__logger = logging.getLogger(LOGGER_NAME)
 
-    def handle_data_message(self, header, message):
-        """
-        Handling DATA message type. Must be implemented.
-        Use extensions and checking if extension exists in message,
-        to determine what to do with message.
-
-        :param header:
-        :param message:
-        :return:
-        """
-        if message.HasExtension(dummy_pb2.enable):
-            self.__handle_set_enable(header, message)
-
-        elif message.HasExtension(dummy_pb2.message):
-            self.__handle_set_message(header, message)
-
-        elif message.HasExtension(dummy_pb2.get_status):
-            self.__handle_get_status(header, message)
-
-        else:
-            self.__logger.warning('No recognizable request in message')
-
+    @MessageHandler.handles(dummy_pb2.enable)
     def __handle_set_enable(self, header, message):
         """
         Example operation, setting enable flag.
@@ -69,6 +48,7 @@ class DummyController(MessageHandler):
         self.__logger.debug('Set enable to %s' % value)
         self.__dummy.enable = value
 
+    @MessageHandler.handles(dummy_pb2.message)
     def __handle_set_message(self, header, message):
         """
         Example operation, setting message.
@@ -81,6 +61,7 @@ class DummyController(MessageHandler):
         self.__logger.debug('Set message to %s' % value)
         self.__dummy.message = value
 
+    @MessageHandler.handles(dummy_pb2.get_status)
     @MessageHandler.handle_and_response
     def __handle_get_status(self, received_header, received_message, response_header, response_message):
         """
@@ -110,7 +91,7 @@ class DummyController(MessageHandler):
         :return:
         """
         self.__logger.debug('Subscribe action')
-        self.add_subscribers(header.clientIDs)
+        self.add_subscribers(header.clientIDs, MessageHandler.get_decimation(message))
 
     def handle_unsubscribe_message(self, header, message):
         """
@@ -143,21 +124,14 @@ class DummyController(MessageHandler):
         return response_message
 
 
-def sending_loop(_controller):
-    while _controller.is_alive():
-        _controller.send_subscribers_message()
-        time.sleep(0.1)
-
-
 if __name__ == '__main__':
     try:
         # Create dummy.
         dummy = Dummy()
         # Create controller and run it.
         controller = DummyController(sys.stdin, sys.stdout, dummy)
-        # Create and start sending thread
-        sending_thread = threading.Thread(target=sending_loop, args=(controller,))
-        sending_thread.start()
+        # Send subscribers message periodically in controller's event loop.
+        controller.call_periodically(SENDING_INTERVAL, controller.send_subscribers_message)
         # It's running in infinite loop.
         controller()
 
@@ -1,3 +1,6 @@
+import array
+import collections
+import operator
 import threading
 import traceback
 import sys
@@ -6,6 +9,9 @@ import time
 import os
 from ambercommon.common import runtime
 
+from amberdriver.common.buffer_ring import BufferRing
+from amberdriver.common.future import Future
+from amberdriver.hokuyo.scip import ScipParser
 from amberdriver.tools import config
 
 
@@ -15,24 +21,44 @@ pwd = os.path.dirname(os.path.abspath(__file__))
 config.add_config_ini('%s/hokuyo.ini' % pwd)
 
 MAX_MULTI_SCAN_IDLE_TIMEOUT = float(config.HOKUYO_MAX_MULTI_SCAN_IDLE_TIMEOUT)
+NEXT_SCAN_TIMEOUT = float(config.HOKUYO_NEXT_SCAN_TIMEOUT)
+SCAN_HISTORY_SIZE = int(config.HOKUYO_SCAN_HISTORY_SIZE)
+SCAN_BUFFERS = int(config.HOKUYO_SCAN_BUFFERS)
 
 
-def chunks(l, n):
-    for i in xrange(0, len(l), n):
-        yield l[i:i + n]
+# lookup tables of SCIP 3-character encoding, character carries 6 bits of value with offset of 0x30
+HIGH_BITS = [((char - 0x30) & 0x3f) << 12 for char in xrange(256)]
+MIDDLE_BITS = [((char - 0x30) & 0x3f) << 6 for char in xrange(256)]
+LOW_BITS = [(char - 0x30) & 0x3f for char in xrange(256)]
 
 
 def decode(val):
-    bin_str = '0b'
+    value = 0
     for char in val:
-        val = ord(char) - 0x30
-        bin_str += '%06d' % int(bin(val)[2:])
-    return int(bin_str, 2)
+        value = (value << 6) | ((ord(char) - 0x30) & 0x3f)
+    return value
+
+
+def decode_values(data):
+    """
+    Decode whole block of SCIP 3-character values at once. Characters of each position
+    are sliced out and mapped through lookup tables, no string is built per value.
+
+    :param data: bytearray of values, without sums and line terminators
+    :return: array of decoded values
+    """
+    end = len(data) - len(data) % 3
+    values = map(operator.or_,
+                 map(HIGH_BITS.__getitem__, data[0:end:3]),
+                 map(MIDDLE_BITS.__getitem__, data[1:end:3]))
+    return array.array('i', map(operator.or_, values, map(LOW_BITS.__getitem__, data[2:end:3])))
 
 
 class Hokuyo(object):
     SHORT_COMMAND_LEN = 5
-    MD_COMMAND_REPLY_LEN = 20
+    STATUS_LINE_LEN = 4
+    MAX_LINE_LEN = 1024
+    TIMESTAMP_LINE_LEN = 6
 
     LASER_ON = 'BM\n'
     LASER_OFF = 'QT\n'
@@ -42,9 +68,8 @@ class Hokuyo(object):
     SENSOR_STATE = 'II\n'
     SENSOR_SPECS = 'PP\n'
 
-    CHARS_PER_VALUE = 3.0
-    CHARS_PER_LINE = 66.0
-    CHARS_PER_BLOCK = 64.0
+    CHARS_PER_VALUE = 3
+    CHARS_PER_BLOCK = 64
 
     START_DEG = 119.885
     STEP_DEG = 0.35208516886930985
@@ -56,45 +81,69 @@ class Hokuyo(object):
     SENSOR_STATE_LINES = 8
     SENSOR_SPECS_LINES = 9
 
+    # tables of angles for (start_step, stop_step, cluster_count), shared by scans, never modified
+    __angles = {}
+
     def __init__(self, port):
         self.__port = port
         self.__port_lock = threading.RLock()
+        self.__parser = ScipParser()
+        self.__resync_count = 0
+        self.__skipped_bytes = 0
 
-        self.__scan = (0, [], [])
+        self.__scan = (array.array('d'), array.array('i'), 0)
+        self.__scans = collections.deque(maxlen=SCAN_HISTORY_SIZE)
         self.__last_get_scan = 0.0
 
+        self.__scan_futures = []
+        self.__scan_futures_lock = threading.Lock()
+        self.__scan_listeners = []
+
         self.__is_active = True
         self.__scanning_enabled = False
 
         runtime.add_shutdown_hook(self.terminate)
 
-    def __offset(self):
-        count = 2
-        result = ''
+    def __offset(self, skip_response=False):
+        """
+        Resynchronize with stream of responses: skip the rest of response up to its end (empty line)
+        or until nothing more is received. Bytes read ahead after the end are kept by parser and port.
 
+        :param skip_response: skip up to the next end of response, also if parser is not in response,
+                              e.g. after command, which reads its response from port directly
+        """
         self.__port_lock.acquire()
         try:
-            a = self.__port.read(1)
-            b = self.__port.read(1)
-
-            while not ((a == '\n' and b == '\n') or (a == '' and b == '')):
-                result += a
-                a = b
-                b = self.__port.read(1)
-                count += 1
+            skipped_count, lost = self.__parser.get_skipped_count(), 0
+            self.__parser.resync(skip_response)
+            while self.__parser.is_resyncing():
+                data = self.__port.read_until('\n', Hokuyo.MAX_LINE_LEN)
+                if len(data) == 0:
+                    # the rest of response is not received
+                    lost = self.__parser.get_pending_size()
+                    self.__parser.reset()
+                    break
+                self.__parser.feed(data)
+            skipped = self.__parser.get_skipped_count() - skipped_count + lost
+
+            self.__resync_count += 1
+            self.__skipped_bytes += skipped
         finally:
             self.__port_lock.release()
 
-        result += a
-        result += b
+        sys.stderr.write('RESYNC %d: SKIPPED %d BYTES\n' % (self.__resync_count, skipped))
 
-        sys.stderr.write('READ %d EXTRA BYTES: "%s"\n' % (count, str(result)))
+    def get_resync_counters(self):
+        """
+        :return: dict of number of resynchronizations and number of bytes skipped by them
+        """
+        return {'resyncs': self.__resync_count, 'skipped_bytes': self.__skipped_bytes}
 
     def __execute_command(self, command):
         self.__port_lock.acquire()
         try:
             self.__port.write(command)
-            result = self.__port.read(len(command))
+            result = self.__port.read_exact(len(command))
             assert result == command
             return result
         finally:
@@ -106,7 +155,7 @@ class Hokuyo(object):
         try:
             try:
                 result += self.__execute_command(command)
-                result += self.__port.read(Hokuyo.SHORT_COMMAND_LEN)
+                result += self.__port.read_exact(Hokuyo.SHORT_COMMAND_LEN)
 
                 if check_response:
                     assert result[-5:-2] == '00P'
@@ -116,7 +165,7 @@ class Hokuyo(object):
             except BaseException:
                 sys.stderr.write('RESULT: "%s"' % result)
                 traceback.print_exc()
-                self.__offset()
+                self.__offset(skip_response=True)
         finally:
             self.__port_lock.release()
 
@@ -127,21 +176,14 @@ class Hokuyo(object):
             try:
                 result += self.__execute_command(cmd)
 
-                result += self.__port.read(4)
+                result += self.__port.read_exact(Hokuyo.STATUS_LINE_LEN)
                 if check_response:
                     assert result[-4:-1] == '00P'
                 assert result[-1:] == '\n'
 
-                line = 0
-                while line < lines:
-                    char = self.__port.read_byte()
-                    if char is not None:
-                        char = chr(char)
-                        result += char
-                        if char == '\n':
-                            line += 1
-                    else:  # char is None
-                        line += 1
+                # line not received until timeout is counted as well
+                for _ in xrange(lines):
+                    result += self.__port.read_until('\n', Hokuyo.MAX_LINE_LEN)
 
                 assert result[-2:] == '\n\n'
 
@@ -149,7 +191,7 @@ class Hokuyo(object):
             except BaseException:
                 sys.stderr.write('RESULT: "%s"' % result)
                 traceback.print_exc()
-                self.__offset()
+                self.__offset(skip_response=True)
         finally:
             self.__port_lock.release()
 
@@ -157,6 +199,9 @@ class Hokuyo(object):
         self.reset()
 
         self.__is_active = False
+        for future in self.__take_scan_futures(float('inf')):
+            future.set_exception(IOError('Hokuyo terminated'))
+
         self.__port_lock.acquire()
         try:
             self.__port.close()
@@ -187,53 +232,74 @@ class Hokuyo(object):
     def get_sensor_specs(self):
         return self.__long_command(Hokuyo.SENSOR_SPECS, Hokuyo.SENSOR_SPECS_LINES)
 
-    def __get_and_parse_scan(self, cluster_count, start_step, stop_step):
-        distances = {}
-        result = ''
+    @staticmethod
+    def __get_angles(cluster_count, start_step, stop_step):
+        key = (start_step, stop_step, cluster_count)
+        angles = Hokuyo.__angles.get(key)
+        if angles is None:
+            step = Hokuyo.STEP_DEG * cluster_count
+            start = -Hokuyo.START_DEG + step * (start_step - Hokuyo.START_STEP)
+            count = (stop_step - start_step) // cluster_count + 1
+            angles = array.array('d', [-((step * i) + start) for i in reversed(xrange(count))])
+            Hokuyo.__angles[key] = angles
+        return angles
 
-        count = ((stop_step - start_step) * Hokuyo.CHARS_PER_VALUE * Hokuyo.CHARS_PER_LINE)
-        count /= (Hokuyo.CHARS_PER_BLOCK * cluster_count)
-        count += 5.0  # magic number
-        count = int(count)
+    @staticmethod
+    def __get_scan_data_size(cluster_count, start_step, stop_step):
+        return len(Hokuyo.__get_angles(cluster_count, start_step, stop_step)) * Hokuyo.CHARS_PER_VALUE
+
+    @staticmethod
+    def __get_scan_response_size(command, cluster_count, start_step, stop_step):
+        data_size = Hokuyo.__get_scan_data_size(cluster_count, start_step, stop_step)
+        lines = (data_size + Hokuyo.CHARS_PER_BLOCK - 1) // Hokuyo.CHARS_PER_BLOCK
+        # echo, status, timestamp, lines of data with sums and empty line
+        return len(command) + Hokuyo.STATUS_LINE_LEN + Hokuyo.TIMESTAMP_LINE_LEN + data_size + 2 * lines + 1
 
+    @staticmethod
+    def __parse_scan_data(data, cluster_count, start_step, stop_step):
+        angles = Hokuyo.__get_angles(cluster_count, start_step, stop_step)
+        distances = decode_values(data)
+        assert len(distances) == len(angles)
+
+        # values are sent from the highest angle, table of angles is ascending
+        distances.reverse()
+        return angles, distances
+
+    def __read_response(self, size):
+        """
+        Read next SCIP response. Only bytes missing from expected size are taken from port,
+        bytes of the next response read ahead stay in port buffer.
+
+        :param size: expected size of response
+        :return: echo, status and list of data lines
+        """
         self.__port_lock.acquire()
         try:
-            result += self.__port.read(count)
+            response = self.__parser.next_response()
+            while response is None:
+                data = self.__port.read_exact(max(size - self.__parser.get_pending_size(), 1))
+                if len(data) == 0:
+                    raise IOError('SCIP response not received')
+                self.__parser.feed(data)
+                response = self.__parser.next_response()
+            return response
         finally:
             self.__port_lock.release()
 
-        assert result[-2:] == '\n\n'
-
-        result = result.split('\n')
-        result = map(lambda line: line[:-1], result)
-        result = ''.join(result)
-
-        i = 0
-        start = (-Hokuyo.START_DEG + Hokuyo.STEP_DEG * cluster_count * (start_step - Hokuyo.START_STEP))
-        for chunk in chunks(result, 3):
-            distances[- ((Hokuyo.STEP_DEG * cluster_count * i) + start)] = decode(chunk)
-            i += 1
-
-        return distances
-
     def __get_single_scan(self, start_step=START_STEP, stop_step=STOP_STEP, cluster_count=1):
         self.__port_lock.acquire()
         try:
             cmd = 'GD%04d%04d%02d\n' % (start_step, stop_step, cluster_count)
             self.__port.write(cmd)
 
-            result = self.__port.read(len(cmd))
-            assert result == cmd
-
-            result += self.__port.read(4)
-            assert result[-4:-1] == '00P'
-            assert result[-1] == '\n'
+            echo, status, lines = self.__read_response(
+                Hokuyo.__get_scan_response_size(cmd, cluster_count, start_step, stop_step))
+            assert echo == cmd[:-1]
+            assert status == '00'
 
-            result = self.__port.read(6)
-            assert result[-1] == '\n'
-
-            scan = self.__get_and_parse_scan(cluster_count, start_step, stop_step)
-            return scan
+            # the first line is timestamp
+            data = bytearray().join(lines[1:])
+            return Hokuyo.__parse_scan_data(data, cluster_count, start_step, stop_step)
 
         except BaseException:
             traceback.print_exc()
@@ -242,31 +308,39 @@ class Hokuyo(object):
         finally:
             self.__port_lock.release()
 
-    def __get_multiple_scans(self, start_step=START_STEP, stop_step=STOP_STEP, cluster_count=1,
+    def __get_multiple_scans(self, scan_buffers, start_step=START_STEP, stop_step=STOP_STEP, cluster_count=1,
                              scan_interval=0, number_of_scans=0):
+        """
+        Read scans into buffers of ring, they are decoded in decoding thread. Yields after each scan.
+        """
         self.__port_lock.acquire()
         try:
             cmd = 'MD%04d%04d%02d%01d%02d\n' % (start_step, stop_step, cluster_count, scan_interval, number_of_scans)
             self.__port.write(cmd)
 
-            result = self.__port.read(len(cmd))
-            assert result == cmd
-
-            result += self.__port.read(Hokuyo.SHORT_COMMAND_LEN)
-            assert result[-2:] == '\n\n'
+            echo, status, _ = self.__read_response(len(cmd) + Hokuyo.SHORT_COMMAND_LEN)
+            assert echo == cmd[:-1]
+            assert status == '00'
 
+            scan_size = Hokuyo.__get_scan_response_size(cmd, cluster_count, start_step, stop_step)
             index = 0
             while number_of_scans == 0 or index > 0:
                 index -= 1
 
-                result = self.__port.read(Hokuyo.MD_COMMAND_REPLY_LEN)
-                assert result[:13] == cmd[:13]
+                echo, status, lines = self.__read_response(scan_size)
+                assert echo[:13] == cmd[:13]
+                assert status == '99'
 
-                result = self.__port.read(6)
-                assert result[-1] == '\n'
+                # the first line is timestamp, data is copied to buffer line by line
+                scan_buffer = scan_buffers.acquire()
+                assert sum(map(len, lines[1:])) == len(scan_buffer)
+                position = 0
+                for line in lines[1:]:
+                    scan_buffer[position:position + len(line)] = line
+                    position += len(line)
 
-                scan = self.__get_and_parse_scan(cluster_count, start_step, stop_step)
-                yield scan
+                scan_buffers.put(scan_buffer)
+                yield
 
         except BaseException:
             traceback.print_exc()
@@ -278,45 +352,145 @@ class Hokuyo(object):
     def enable_scanning(self, flag):
         self.__scanning_enabled = flag
 
-    def get_single_scan(self):
+    def get_next_scan(self):
+        """
+        Get scan without waiting for serial port. If scanning is running, current scan is returned,
+        otherwise scanning is started and future is completed with first scan. If scanning fails,
+        single scan is taken instead. Future not completed in `NEXT_SCAN_TIMEOUT` gets current scan,
+        or IOError, if there is no scan yet.
+
+        :return: future of scan
+        """
         timestamp = time.time()
-        if not (timestamp - self.__last_get_scan < MAX_MULTI_SCAN_IDLE_TIMEOUT or self.__scanning_enabled):
-            scan = self.__get_single_scan()
-            self.__set_scan(scan)
-        scan = self.__scan
+        if timestamp - self.__last_get_scan < MAX_MULTI_SCAN_IDLE_TIMEOUT or self.__scanning_enabled:
+            future = Future.of(self.__scan)
+        else:
+            future = Future()
+            self.__scan_futures_lock.acquire()
+            try:
+                self.__scan_futures.append((timestamp, future))
+            finally:
+                self.__scan_futures_lock.release()
         self.__last_get_scan = timestamp
-        return scan
+        return future
+
+    def __take_scan_futures(self, requested_before):
+        """
+        Take pending futures of scan, requested before given time.
+        """
+        self.__scan_futures_lock.acquire()
+        try:
+            scan_futures = [future for timestamp, future in self.__scan_futures if timestamp < requested_before]
+            self.__scan_futures = [(timestamp, future) for timestamp, future in self.__scan_futures
+                                   if timestamp >= requested_before]
+            return scan_futures
+        finally:
+            self.__scan_futures_lock.release()
+
+    def __expire_scan_futures(self):
+        scan = self.__scan
+        for future in self.__take_scan_futures(time.time() - NEXT_SCAN_TIMEOUT):
+            if scan[2] > 0:
+                future.set_result(scan)
+            else:
+                future.set_exception(IOError('Scan not received'))
+
+    def __get_pending_scan(self):
+        """
+        Take single scan for futures still pending, when scanning stopped without completing them.
+        """
+        self.__scan_futures_lock.acquire()
+        try:
+            is_pending = len(self.__scan_futures) > 0
+        finally:
+            self.__scan_futures_lock.release()
+
+        if is_pending:
+            self.__set_scan(self.__get_single_scan())
 
     def get_scan(self):
         return self.__scan
 
+    def add_scan_listener(self, listener):
+        """
+        Register function called with every new scan, as soon as it is parsed.
+        Listener runs in thread, which decodes scans, so it should not block.
+
+        :param listener: function taking scan
+        :return: nothing
+        """
+        self.__scan_listeners.append(listener)
+
+    def get_scans(self):
+        """
+        Get recent scans, oldest first. Scanning is kept running as for single scan.
+
+        :return: list of scans
+        """
+        self.__last_get_scan = time.time()
+        return list(self.__scans)
+
     def scanning_loop(self):
         while self.__is_active:
             if time.time() - self.__last_get_scan < MAX_MULTI_SCAN_IDLE_TIMEOUT or self.__scanning_enabled:
                 self.__multi_scanning_loop()
+                self.__get_pending_scan()
+            self.__expire_scan_futures()
             time.sleep(0.1)
 
     def __multi_scanning_loop(self):
+        scan_buffers = BufferRing(SCAN_BUFFERS, Hokuyo.__get_scan_data_size(1, Hokuyo.START_STEP, Hokuyo.STOP_STEP))
+        decoding_thread = threading.Thread(target=self.__decoding_loop,
+                                           args=(scan_buffers, 1, Hokuyo.START_STEP, Hokuyo.STOP_STEP),
+                                           name='decoding-thread')
+        decoding_thread.start()
+
         self.__port_lock.acquire()
         try:
-            for scan in self.__get_multiple_scans():
-                self.__set_scan(scan)
+            for _ in self.__get_multiple_scans(scan_buffers):
                 if not (time.time() - self.__last_get_scan < MAX_MULTI_SCAN_IDLE_TIMEOUT or self.__scanning_enabled) \
                         or not self.__is_active:
                     break
+                self.__expire_scan_futures()
         finally:
+            scan_buffers.close()
             self.laser_off()
             self.laser_on()
             self.__port_lock.release()
 
+        decoding_thread.join()
+        if scan_buffers.get_dropped_count() > 0:
+            sys.stderr.write('DROPPED %d SCANS NOT DECODED IN TIME\n' % scan_buffers.get_dropped_count())
+        if self.__parser.get_invalid_count() > 0:
+            sys.stderr.write('DROPPED %d RESPONSES WITH INVALID SUM SO FAR\n' % self.__parser.get_invalid_count())
+
+    def __decoding_loop(self, scan_buffers, cluster_count, start_step, stop_step):
+        """
+        Decode scans read by scanning loop and publish them, until ring of buffers is closed.
+        Serial port is not locked, so next scan is read meanwhile.
+        """
+        scan_buffer = scan_buffers.take()
+        while scan_buffer is not None:
+            try:
+                self.__set_scan(Hokuyo.__parse_scan_data(scan_buffer, cluster_count, start_step, stop_step))
+            except BaseException:
+                traceback.print_exc()
+            finally:
+                scan_buffers.release(scan_buffer)
+            scan_buffer = scan_buffers.take()
+
     def __set_scan(self, scan):
         if scan is not None:
             timestamp = int(time.time() * 1000.0)
-            angles, distances = Hokuyo.__parse_scan(scan)
+            angles, distances = scan
             self.__scan = (angles, distances, timestamp)
+            self.__scans.append(self.__scan)
 
-    @staticmethod
-    def __parse_scan(scan):
-        angles = sorted(scan.keys())
-        distances = map(scan.get, angles)
-        return angles, distances
\ No newline at end of file
+            for future in self.__take_scan_futures(float('inf')):
+                future.set_result(self.__scan)
+
+            for listener in self.__scan_listeners:
+                try:
+                    listener(self.__scan)
+                except BaseException:
+                    traceback.print_exc()
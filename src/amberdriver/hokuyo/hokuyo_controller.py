@@ -7,6 +7,8 @@ import traceback
 import os
 import serial
 
+from amberdriver.common import wire
+from amberdriver.common.amber_pipes import MAX_LENGTH
 from amberdriver.common.message_handler import MessageHandler
 from amberdriver.hokuyo import hokuyo_pb2
 from amberdriver.hokuyo.hokuyo import Hokuyo
@@ -25,32 +27,67 @@ HIGH_SENSITIVE = config.HOKUYO_HIGH_SENSITIVE_ENABLE == 'True'
 SPEED_MOTOR = int(config.HOKUYO_SPEED_MOTOR)
 SERIAL_PORT = config.HOKUYO_SERIAL_PORT
 BAUD_RATE = config.HOKUYO_BAUD_RATE
+HANDLER_WORKERS = int(config.HOKUYO_HANDLER_WORKERS)
+GET_SINGLE_SCAN_RATE_LIMIT = float(config.HOKUYO_GET_SINGLE_SCAN_RATE_LIMIT)
+GET_SINGLE_SCAN_BURST = int(config.HOKUYO_GET_SINGLE_SCAN_BURST)
 TIMEOUT = 0.3
 
 
 class HokuyoController(MessageHandler):
     def __init__(self, pipe_in, pipe_out, driver):
-        super(HokuyoController, self).__init__(pipe_in, pipe_out)
+        super(HokuyoController, self).__init__(pipe_in, pipe_out, handler_workers=HANDLER_WORKERS)
         self.__hokuyo = driver
         self.__logger = logging.getLogger(LOGGER_NAME)
 
-    def handle_data_message(self, header, message):
-        if message.HasExtension(hokuyo_pb2.get_single_scan):
-            self.__handle_get_single_scan(header, message)
+        self.__serialized_scan = (None, None)
+        self.__serialized_scan_lock = threading.Lock()
 
-        else:
-            self.__logger.warning('No recognizable request in message')
+        self.__hokuyo.add_scan_listener(self.__publish_scan)
 
+    @MessageHandler.handles(hokuyo_pb2.get_single_scan, rate_limit=GET_SINGLE_SCAN_RATE_LIMIT,
+                            burst=GET_SINGLE_SCAN_BURST)
     @MessageHandler.handle_and_response
     def __handle_get_single_scan(self, _received_header, _received_message, response_header, response_message):
         self.__logger.debug('Get single scan')
-        angles, distances, timestamp = self.__hokuyo.get_single_scan()
-        response_message = HokuyoController.__fill_scan(response_message, angles, distances, timestamp)
+        scan = self.single_flight(hokuyo_pb2.get_single_scan, self.__hokuyo.get_next_scan)
+
+        def fill_response(_scan):
+            return response_header, self.__serialize_scan(_scan)
+
+        return scan.then(fill_response)
+
+    @MessageHandler.handles(hokuyo_pb2.get_scans)
+    @MessageHandler.handle_and_response
+    def __handle_get_scans(self, _received_header, _received_message, response_header, response_message):
+        self.__logger.debug('Get scans')
+        history = self.__hokuyo.get_scans()
+
+        # the newest scans, which fit in one frame together
+        size, batch = response_message.ByteSize(), []
+        for angles, distances, timestamp in reversed(history):
+            scan = hokuyo_pb2.Scan()
+            scan.angles.extend(angles)
+            scan.distances.extend(distances)
+            scan.timestamp = timestamp
+
+            scan_size = scan.ByteSize()
+            size += len(wire.encode_tag(hokuyo_pb2.scans.number, wire.WIRE_TYPE_LENGTH_DELIMITED)) + \
+                len(wire.encode_varint(scan_size)) + scan_size
+            if size > MAX_LENGTH:
+                break
+            batch.append(scan)
+
+        if len(batch) < len(history):
+            self.__logger.warning('Get scans: only %d of %d scans fit in frame', len(batch), len(history))
+
+        scans = response_message.Extensions[hokuyo_pb2.scans]
+        for scan in reversed(batch):
+            scans.add().CopyFrom(scan)
         return response_header, response_message
 
     def handle_subscribe_message(self, header, message):
         self.__logger.debug('Subscribe action')
-        self.add_subscribers(header.clientIDs)
+        self.add_subscribers(header.clientIDs, MessageHandler.get_decimation(message))
         self.__hokuyo.enable_scanning(True)
 
     def handle_unsubscribe_message(self, header, message):
@@ -65,16 +102,54 @@ class HokuyoController(MessageHandler):
         if not self.is_any_subscriber():
             self.__hokuyo.enable_scanning(False)
 
-    def fill_subscription_response(self, response_message):
-        angles, distances, timestamp = self.__hokuyo.get_scan()
-        return HokuyoController.__fill_scan(response_message, angles, distances, timestamp)
+    def __publish_scan(self, scan):
+        if self.is_any_subscriber():
+            self.send_subscribers_message(scan)
+
+    def fill_subscription_response(self, response_message, scan=None):
+        """
+        :param scan: scan to publish, the current one if not given
+        """
+        return self.__serialize_scan(scan if scan is not None else self.__hokuyo.get_scan())
+
+    def __serialize_scan(self, scan):
+        """
+        Serialize extensions of scan response. Scan is serialized once,
+        all replies and subscription messages get the same binary string until next scan.
+
+        :param scan: angles, distances and timestamp
+        :return: binary string of serialized extensions
+        """
+        self.__serialized_scan_lock.acquire()
+        try:
+            serialized_scan, extensions_data = self.__serialized_scan
+            if serialized_scan is not scan:
+                angles, distances, timestamp = scan
+                extensions_data = HokuyoController.encode_scan(angles, distances, timestamp)
+                self.__serialized_scan = (scan, extensions_data)
+            return extensions_data
+        finally:
+            self.__serialized_scan_lock.release()
 
     @staticmethod
-    def __fill_scan(response_message, angles, distances, timestamp):
-        response_message.Extensions[hokuyo_pb2.scan].angles.extend(angles)
-        response_message.Extensions[hokuyo_pb2.scan].distances.extend(distances)
-        response_message.Extensions[hokuyo_pb2.timestamp] = timestamp
-        return response_message
+    def encode_scan(angles, distances, timestamp):
+        """
+        Encode scan and timestamp extensions of DriverMsg straight from arrays,
+        the same way as SerializeToString of message filled with them.
+
+        :param angles: array('d') of angles
+        :param distances: array of distances
+        :param timestamp: timestamp of scan
+        :return: binary string of serialized extensions
+        """
+        scan_data = bytearray()
+        wire.encode_packed_doubles(hokuyo_pb2.Scan.ANGLES_FIELD_NUMBER, angles, scan_data)
+        wire.encode_packed_varints(hokuyo_pb2.Scan.DISTANCES_FIELD_NUMBER, distances, scan_data)
+
+        data = wire.encode_length_delimited(hokuyo_pb2.scan.number, scan_data, bytearray())
+        wire.encode_tag(hokuyo_pb2.timestamp.number, wire.WIRE_TYPE_VARINT, data)
+        wire.encode_varint(timestamp, data)
+        return bytes(data)
 
 
 if __name__ == '__main__':
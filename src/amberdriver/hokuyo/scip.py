@@ -0,0 +1,166 @@
+import collections
+
+
+__author__ = 'paoolo'
+
+
+def checksum(data):
+    """
+    Compute SCIP sum of line: lower 6 bits of sum of characters, with offset of 0x30.
+
+    :param data: bytearray of line without sum
+    :return: code of sum character
+    """
+    return (sum(data) & 0x3f) + 0x30
+
+
+class ScipParser(object):
+    """
+    Incremental parser of SCIP 2.0 responses. Data read from serial port is fed in chunks
+    of any size, complete responses are taken one by one, bytes of incomplete response are kept.
+
+    Response is echo of command, status line and lines of data, ended with empty line.
+    Every line but echo ends with sum of its characters. Response with invalid sum is dropped
+    as a whole, parsing continues with the next response, which starts with echo of command.
+
+    After protocol error, parser is resynchronized: the rest of response is skipped up to
+    its empty line, bytes fed after it are parsed as the next response.
+    """
+
+    def __init__(self):
+        self.__buffer = bytearray()
+        self.__lines = []
+        self.__response_size = 0
+        self.__is_valid = True
+
+        self.__responses = collections.deque()
+        self.__invalid_count = 0
+
+        self.__is_resyncing = False
+        self.__skipped_count = 0
+
+    def feed(self, data):
+        """
+        Parse data read from serial port.
+
+        :param data: binary string or bytearray
+        :return: nothing
+        """
+        buffer = self.__buffer
+        buffer += data
+
+        if self.__is_resyncing:
+            self.__skip()
+            if self.__is_resyncing:
+                return
+
+        position = 0
+        end = buffer.find('\n')
+        while end >= 0:
+            line = buffer[position:end]
+            self.__response_size += end + 1 - position
+            position = end + 1
+
+            if len(line) == 0:
+                self.__end_response()
+            elif len(self.__lines) == 0:
+                self.__lines.append(line)
+            elif self.__is_valid:
+                if checksum(line[:-1]) != line[-1]:
+                    self.__is_valid = False
+                self.__lines.append(line[:-1])
+
+            end = buffer.find('\n', position)
+
+        del buffer[:position]
+
+    def __end_response(self):
+        if len(self.__lines) > 0:
+            if self.__is_valid and len(self.__lines) > 1:
+                self.__responses.append((self.__lines[0], self.__lines[1], self.__lines[2:]))
+            else:
+                self.__invalid_count += 1
+
+        self.__lines = []
+        self.__response_size = 0
+        self.__is_valid = True
+
+    def next_response(self):
+        """
+        Take the oldest complete response.
+
+        :return: echo, status and list of data lines without sums, or None if there is no complete response
+        """
+        if len(self.__responses) > 0:
+            return self.__responses.popleft()
+        return None
+
+    def get_pending_size(self):
+        """
+        :return: number of bytes of incomplete response already fed
+        """
+        return self.__response_size + len(self.__buffer)
+
+    def get_invalid_count(self):
+        return self.__invalid_count
+
+    def resync(self, skip_response=False):
+        """
+        Skip the rest of response being parsed, up to its empty line. Complete responses
+        and bytes fed after the empty line are kept. Response is skipped in bytes fed later,
+        if its empty line is not fed yet, see `is_resyncing`.
+
+        :param skip_response: skip up to the next empty line, even if no response is being parsed,
+                              e.g. when response was read from port without parser
+        :return: nothing
+        """
+        if skip_response or len(self.__lines) > 0 or len(self.__buffer) > 0:
+            self.__skipped_count += self.__response_size
+            self.__lines = []
+            self.__response_size = 0
+            self.__is_valid = True
+
+            self.__is_resyncing = True
+            self.__skip()
+
+    def __skip(self):
+        # buffer always starts at the beginning of line, so empty line is either the first one or follows line feed
+        buffer = self.__buffer
+        if buffer[:1] == '\n':
+            end = 1
+        else:
+            end = buffer.find('\n\n')
+            if end >= 0:
+                end += 2
+
+        if end < 0:
+            # incomplete line is kept, empty line may follow it
+            end = buffer.rfind('\n') + 1
+        else:
+            self.__is_resyncing = False
+
+        self.__skipped_count += end
+        del buffer[:end]
+
+    def is_resyncing(self):
+        """
+        :return: True if rest of response is being skipped, until its empty line is fed
+        """
+        return self.__is_resyncing
+
+    def get_skipped_count(self):
+        """
+        :return: number of bytes skipped by resynchronizations
+        """
+        return self.__skipped_count
+
+    def reset(self):
+        """
+        Drop everything fed and not taken yet.
+        """
+        del self.__buffer[:]
+        self.__responses.clear()
+        self.__lines = []
+        self.__response_size = 0
+        self.__is_valid = True
+        self.__is_resyncing = False
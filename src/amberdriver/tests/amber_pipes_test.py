@@ -1,7 +1,9 @@
 import struct
+import threading
 
-from amberdriver.common import drivermsg_pb2
-from amberdriver.common.amber_pipes import AmberPipes, LEN_SIZE
+from amberdriver.common import drivermsg_pb2, wire
+from amberdriver.common.amber_pipes import AmberPipes, FrameReader, FrameWriter, FrameLengthError
+from amberdriver.common.outbound_queue import CONTROL
 
 
 __author__ = 'paoolo'
@@ -17,106 +19,238 @@ class AmberPipesTestCase(unittest.TestCase):
         self.amber_pipes = AmberPipes(self.mocked_message_handler, self.mocked_stdin, self.mocked_stdout)
 
 
+def pack_frame(header_data, message_data):
+    return struct.pack('!h', len(header_data)) + header_data + struct.pack('!h', len(message_data)) + message_data
+
+
+def chunked_read_into(data, chunk_size):
+    chunks = [data[i:i + chunk_size] for i in range(0, len(data), chunk_size)]
+
+    def read_into(buffer_view):
+        if len(chunks) == 0:
+            return 0
+        chunk = chunks.pop(0)
+        if len(chunk) > len(buffer_view):
+            chunk, rest = chunk[:len(buffer_view)], chunk[len(buffer_view):]
+            chunks.insert(0, rest)
+        buffer_view[:len(chunk)] = chunk
+        return len(chunk)
+
+    return read_into
+
+
 class ReadFromPipeTestCase(AmberPipesTestCase):
     def runTest(self):
-        size, result = mock.Mock(), mock.Mock()
-        self.mocked_stdin.read = mock.Mock(return_value=result)
-        self.assertEqual(self.amber_pipes._AmberPipes__read_from_pipe(size), result)
-        self.mocked_stdin.read.assert_called_once_with(size)
+        buffer_view, result = mock.Mock(), mock.Mock()
+        self.mocked_stdin.readinto = mock.Mock(return_value=result)
+        self.assertEqual(self.amber_pipes._AmberPipes__read_from_pipe(buffer_view), result)
+        self.mocked_stdin.readinto.assert_called_once_with(buffer_view)
+
+
+class FrameReaderTestCase(unittest.TestCase):
+    def runTest(self):
+        frames = [('\x01\x02', '\x03\x04\x05'), ('', '\x06'), ('\x07' * 100, '\x08' * 300)]
+        data = ''.join([pack_frame(header_data, message_data) for header_data, message_data in frames])
+
+        frame_reader = FrameReader(chunked_read_into(data, 7), buffer_size=16)
+        for frame in frames:
+            self.assertEqual(frame_reader.read_frame(), frame)
+        self.assertRaises(EOFError, frame_reader.read_frame)
 
 
-class ReadAndUnpackDataFromPipeTestCase(AmberPipesTestCase):
+class FrameReaderNextFrameTestCase(unittest.TestCase):
     def runTest(self):
-        data = '\x01\x02\x03\x04'
+        data = pack_frame('\x01', '\x02') + pack_frame('\x03', '\x04')
+
+        frame_reader = FrameReader(chunked_read_into(data, len(data) - 1))
+        self.assertIsNone(frame_reader.next_frame())
+        frame_reader.fill()
+        self.assertEqual(frame_reader.next_frame(), ('\x01', '\x02'))
+        self.assertIsNone(frame_reader.next_frame())
+        frame_reader.fill()
+        self.assertEqual(frame_reader.next_frame(), ('\x03', '\x04'))
+
 
-        def pipe_in(size):
-            if size is LEN_SIZE:
-                return struct.pack('>h', len(data))
-            return data
+class FrameReaderLargeFramesTestCase(unittest.TestCase):
+    def runTest(self):
+        message_data = '\x05' * 70000
+        data = struct.pack('!i', 1) + '\x01' + struct.pack('!i', len(message_data)) + message_data
 
-        self.amber_pipes._AmberPipes__read_from_pipe = mock.Mock(side_effect=pipe_in)
-        result = self.amber_pipes._AmberPipes__read_and_unpack_data_from_pipe(LEN_SIZE)
-        self.assertEqual(result, data)
+        frame_reader = FrameReader(chunked_read_into(data, 4096), buffer_size=1024,
+                                   length_format='!i', max_length=2 ** 20)
+        self.assertEqual(frame_reader.read_frame(), ('\x01', message_data))
 
 
-class ReadDataFromPipeTestCase(AmberPipesTestCase):
+class FrameReaderLengthErrorTestCase(unittest.TestCase):
     def runTest(self):
-        data = mock.Mock()
-        container = mock.Mock()
-        self.amber_pipes._AmberPipes__read_and_unpack_data_from_pipe = mock.Mock(return_value=data)
-        self.amber_pipes._AmberPipes__read_data_from_pipe(container)
-        container.ParseFromString.assert_called_once_with(data)
+        data = struct.pack('!h', -1) + struct.pack('!h', 0)
+        frame_reader = FrameReader(chunked_read_into(data, len(data)))
+        self.assertRaises(FrameLengthError, frame_reader.read_frame)
 
 
-class ReadHeaderAndMessageFromPipe(AmberPipesTestCase):
+class WriteTooLargeDataToPipeTestCase(AmberPipesTestCase):
     def runTest(self):
-        def read_data_from_pipe(container):
-            return container
+        mocked_write_to_pipe = mock.Mock()
+        self.amber_pipes._AmberPipes__write_to_pipe = mocked_write_to_pipe
 
-        mocked_read_data_from_pipe = mock.Mock(side_effect=read_data_from_pipe)
-        self.amber_pipes._AmberPipes__read_data_from_pipe = mocked_read_data_from_pipe
+        self.assertRaises(FrameLengthError, self.amber_pipes.write_data_to_pipe, '', '\x00' * 2 ** 15)
+        self.assertEqual(mocked_write_to_pipe.call_count, 0)
 
-        header, message = self.amber_pipes._AmberPipes__read_header_and_message_from_pipe()
-        self.assertIsInstance(header, drivermsg_pb2.DriverHdr)
-        self.assertIsInstance(message, drivermsg_pb2.DriverMsg)
-        self.assertEqual(mocked_read_data_from_pipe.call_count, 2)
+        self.assertTrue(self.amber_pipes.write_data_to_pipe('', '\x00'))
+        self.assertEqual(mocked_write_to_pipe.call_count, 1)
 
 
-class HandleHeaderAndMessageTestCase(AmberPipesTestCase):
+class HandleFrameTestCase(AmberPipesTestCase):
     def runTest(self):
-        header, message = mock.Mock(), mock.Mock()
-        self.amber_pipes._AmberPipes__handle_header_and_message(header, message)
+        header, message = drivermsg_pb2.DriverHdr(), drivermsg_pb2.DriverMsg()
+        header.clientIDs.extend([1, 2])
+        message.type = drivermsg_pb2.DriverMsg.DATA
+        message.synNum = 3
+
+        def handle_data_message(received_header, received_message):
+            self.assertEqual(received_header, header)
+            self.assertEqual(received_message, message)
+
+        self.mocked_message_handler.handle_data_message = mock.Mock(side_effect=handle_data_message)
+
+        self.amber_pipes._AmberPipes__handle_frame(header.SerializeToString(), message.SerializeToString())
+        self.assertEqual(self.mocked_message_handler.handle_data_message.call_count, 1)
 
+
+class HandlePingFrameTestCase(AmberPipesTestCase):
+    def runTest(self):
+        header, message = drivermsg_pb2.DriverHdr(), drivermsg_pb2.DriverMsg()
+        header.clientIDs.extend([1, -2])
         message.type = drivermsg_pb2.DriverMsg.PING
-        self.amber_pipes._AmberPipes__handle_ping_message = mock.Mock()
-        self.amber_pipes._AmberPipes__handle_header_and_message(header, message)
-        self.amber_pipes._AmberPipes__handle_ping_message.assert_called_once_with(header, message)
+        message.synNum = 300
+
+        self.amber_pipes._AmberPipes__handle_header_and_message = mock.Mock()
+        self.amber_pipes.write_data_to_pipe = mock.Mock()
+        self.amber_pipes._AmberPipes__handle_frame(header.SerializeToString(), message.SerializeToString())
+
+        self.assertFalse(self.amber_pipes._AmberPipes__handle_header_and_message.called)
+        pong_header_data, pong_message_data, message_class = self.amber_pipes.write_data_to_pipe.call_args[0]
+        self.assertEqual(message_class, CONTROL)
 
+        pong_header, pong_message = drivermsg_pb2.DriverHdr(), drivermsg_pb2.DriverMsg()
+        pong_header.ParseFromString(pong_header_data)
+        pong_message.ParseFromString(pong_message_data)
+        self.assertEqual(list(pong_header.clientIDs), [1, -2])
+        self.assertEqual(pong_message.type, drivermsg_pb2.DriverMsg.PONG)
+        self.assertEqual(pong_message.ackNum, 300)
+
+
+class HandleClientDiedFrameTestCase(AmberPipesTestCase):
+    def runTest(self):
+        header, message = drivermsg_pb2.DriverHdr(), drivermsg_pb2.DriverMsg()
+        header.clientIDs.extend([5])
         message.type = drivermsg_pb2.DriverMsg.CLIENT_DIED
-        self.amber_pipes._AmberPipes__handle_client_died_message = mock.Mock()
-        self.amber_pipes._AmberPipes__handle_header_and_message(header, message)
-        self.amber_pipes._AmberPipes__handle_client_died_message.assert_called_once_with(header, message)
 
-        message.type = drivermsg_pb2.DriverMsg.UNSUBSCRIBE
-        self.amber_pipes._AmberPipes__handle_header_and_message(header, message)
-        self.mocked_message_handler.handle_unsubscribe_message.assert_called_once_with(header, message)
+        self.amber_pipes._AmberPipes__handle_frame(header.SerializeToString(), message.SerializeToString())
+        self.mocked_message_handler.handle_client_died_message.assert_called_once_with(5)
+
+
+class HandleUnknownFrameTestCase(AmberPipesTestCase):
+    def runTest(self):
+        message = drivermsg_pb2.DriverMsg()
+        message.type = drivermsg_pb2.DriverMsg.PONG
+
+        self.amber_pipes._AmberPipes__handle_frame('', message.SerializeToString())
+        self.assertEqual(self.mocked_message_handler.method_calls, [])
+
 
-        message.type = drivermsg_pb2.DriverMsg.SUBSCRIBE
-        self.amber_pipes._AmberPipes__handle_header_and_message(header, message)
-        self.mocked_message_handler.handle_subscribe_message.assert_called_once_with(header, message)
+class HandleAvailableFramesTestCase(AmberPipesTestCase):
+    def runTest(self):
+        header, message = drivermsg_pb2.DriverHdr(), drivermsg_pb2.DriverMsg()
+        message.type = drivermsg_pb2.DriverMsg.DATA
+
+        frame = pack_frame(header.SerializeToString(), message.SerializeToString())
+        data = frame + frame + frame[:3]
+        self.mocked_stdin.readinto = mock.Mock(side_effect=chunked_read_into(data, len(data)))
+
+        self.amber_pipes.handle_available_frames()
+        self.assertEqual(self.mocked_stdin.readinto.call_count, 1)
+        self.assertEqual(self.mocked_message_handler.handle_data_message.call_count, 2)
+
+
+class HandleAvailableFramesLatestWinsTestCase(unittest.TestCase):
+    def runTest(self):
+        mocked_message_handler = mock.Mock()
+        amber_pipes = AmberPipes(mocked_message_handler, mock.Mock(), mock.Mock(), latest_wins={90: True, 91: False})
+
+        def data_frame(client_id, extension, syn_num):
+            header, message = drivermsg_pb2.DriverHdr(), drivermsg_pb2.DriverMsg()
+            header.clientIDs.extend([client_id])
+            message.type = drivermsg_pb2.DriverMsg.DATA
+            message.synNum = syn_num
+            message_data = message.SerializeToString()
+            message_data += str(wire.encode_tag(extension, wire.WIRE_TYPE_VARINT) + wire.encode_varint(1))
+            return pack_frame(header.SerializeToString(), message_data)
 
+        data = data_frame(1, 90, 1) + data_frame(2, 90, 2) + data_frame(1, 91, 3) + \
+               data_frame(1, 90, 4) + data_frame(1, 91, 5)
+        amber_pipes._AmberPipes__pipe_in.readinto = mock.Mock(side_effect=chunked_read_into(data, len(data)))
+
+        handled = []
+        mocked_message_handler.handle_data_message = mock.Mock(
+            side_effect=lambda header, message: handled.append(message.synNum))
+
+        amber_pipes.handle_available_frames()
+        self.assertEqual(handled, [2, 3, 4, 5])
+        self.assertEqual(amber_pipes.get_superseded_count(), 1)
+
+
+class HandleAvailableFramesPeekedOnceTestCase(unittest.TestCase):
+    def runTest(self):
+        amber_pipes = AmberPipes(mock.Mock(), mock.Mock(), mock.Mock(), latest_wins={90: True})
+
+        header, message = drivermsg_pb2.DriverHdr(), drivermsg_pb2.DriverMsg()
         message.type = drivermsg_pb2.DriverMsg.DATA
-        self.amber_pipes._AmberPipes__handle_header_and_message(header, message)
-        self.mocked_message_handler.handle_data_message.assert_called_once_with(header, message)
+        frame = pack_frame(header.SerializeToString(), message.SerializeToString())
+        data = frame + frame
+        amber_pipes._AmberPipes__pipe_in.readinto = mock.Mock(side_effect=chunked_read_into(data, len(data)))
 
+        with mock.patch('amberdriver.common.amber_pipes.wire.peek_message', wraps=wire.peek_message) as peek_message:
+            amber_pipes.handle_available_frames()
+        self.assertEqual(peek_message.call_count, 2)
 
-class HandleClientDiedTestCase(AmberPipesTestCase):
+
+class HandleSubscribeFramesTestCase(AmberPipesTestCase):
     def runTest(self):
-        header, message = mock.Mock(), mock.Mock()
+        header, message = drivermsg_pb2.DriverHdr(), drivermsg_pb2.DriverMsg()
+        header.clientIDs.extend([4])
 
-        value = mock.Mock()
-        header.clientIDs = [value, ]
+        handled = []
+        for message_type, handle in [(drivermsg_pb2.DriverMsg.SUBSCRIBE, 'handle_subscribe_message'),
+                                     (drivermsg_pb2.DriverMsg.UNSUBSCRIBE, 'handle_unsubscribe_message')]:
+            setattr(self.mocked_message_handler, handle, mock.Mock(
+                side_effect=lambda received_header, received_message: handled.append(
+                    (list(received_header.clientIDs), received_message.type))))
+            message.type = message_type
+            self.amber_pipes._AmberPipes__handle_frame(header.SerializeToString(), message.SerializeToString())
 
-        self.amber_pipes._AmberPipes__handle_client_died_message(header, message)
-        self.mocked_message_handler.handle_client_died_message.assert_called_once_with(value)
+        self.assertEqual(handled, [([4], drivermsg_pb2.DriverMsg.SUBSCRIBE),
+                                   ([4], drivermsg_pb2.DriverMsg.UNSUBSCRIBE)])
 
 
-class HandlePingMessage(AmberPipesTestCase):
+class HandleClientDiedFrameWithoutClientTestCase(AmberPipesTestCase):
     def runTest(self):
-        ping_header, ping_message = mock.Mock(), mock.Mock()
+        message = drivermsg_pb2.DriverMsg()
+        message.type = drivermsg_pb2.DriverMsg.CLIENT_DIED
 
-        ping_message.synNum = 0
-        value = int()
-        ping_header.clientIDs = [value, ]
+        self.amber_pipes._AmberPipes__handle_frame('', message.SerializeToString())
+        self.assertFalse(self.mocked_message_handler.handle_client_died_message.called)
 
-        def write_header_and_message_to_pipe(pong_header, pong_message):
-            self.assertEqual(pong_message.type, drivermsg_pb2.DriverMsg.PONG)
-            self.assertEqual(pong_message.ackNum, ping_message.synNum)
-            self.assertTrue(value in pong_header.clientIDs)
 
-        self.amber_pipes.write_header_and_message_to_pipe = write_header_and_message_to_pipe
+class HandlePingFrameWithoutSynNumTestCase(AmberPipesTestCase):
+    def runTest(self):
+        header, message = drivermsg_pb2.DriverHdr(), drivermsg_pb2.DriverMsg()
+        header.clientIDs.extend([1])
+        message.type = drivermsg_pb2.DriverMsg.PING
 
-        self.amber_pipes._AmberPipes__handle_ping_message(ping_header, ping_message)
+        self.amber_pipes.write_data_to_pipe = mock.Mock()
+        self.amber_pipes._AmberPipes__handle_frame(header.SerializeToString(), message.SerializeToString())
+        self.assertFalse(self.amber_pipes.write_data_to_pipe.called)
 
 
 class WriteHeaderAndMessageToPipeTestCase(AmberPipesTestCase):
@@ -144,4 +278,89 @@ class WriteToPipeTestCase(AmberPipesTestCase):
         self.amber_pipes._AmberPipes__write_to_pipe(binary_string)
 
         self.mocked_stdout.write.assert_called_once_with(binary_string)
-        self.mocked_stdout.flush.assert_called_once_with()
\ No newline at end of file
+        self.mocked_stdout.flush.assert_called_once_with()
+
+
+class WriteByWriterThreadTestCase(unittest.TestCase):
+    def runTest(self):
+        mocked_stdout = mock.Mock()
+        with mock.patch('amberdriver.common.amber_pipes.WRITER_THREAD_ENABLE', True):
+            amber_pipes = AmberPipes(mock.Mock(), mock.Mock(), mocked_stdout)
+        frame_writer = amber_pipes._AmberPipes__frame_writer
+        self.assertIsNotNone(frame_writer)
+
+        amber_pipes.write_data_to_pipe('\x01', '\x02')
+        frame_writer.terminate()
+        frame_writer._FrameWriter__writing_thread.join()
+
+        mocked_stdout.write.assert_called_once_with(pack_frame('\x01', '\x02'))
+
+
+class PingAnsweredWhenRepliesQueuedTestCase(unittest.TestCase):
+    def runTest(self):
+        written, write_allowed = [], threading.Event()
+
+        def write(binary_string):
+            write_allowed.wait()
+            written.append(binary_string)
+
+        mocked_stdout = mock.Mock()
+        mocked_stdout.write = mock.Mock(side_effect=write)
+        with mock.patch('amberdriver.common.amber_pipes.WRITER_THREAD_ENABLE', True), \
+                mock.patch('amberdriver.common.amber_pipes.REPLY_QUEUE_SIZE', 1):
+            amber_pipes = AmberPipes(mock.Mock(), mock.Mock(), mocked_stdout)
+        frame_writer = amber_pipes._AmberPipes__frame_writer
+
+        header, message = drivermsg_pb2.DriverHdr(), drivermsg_pb2.DriverMsg()
+        header.clientIDs.append(1)
+        message.type = drivermsg_pb2.DriverMsg.PING
+        message.synNum = 7
+
+        def read_frames():
+            # mediator is stalled, replies written by thread reading pipes fill queue of replies
+            amber_pipes._AmberPipes__pipes_thread = threading.current_thread()
+            for syn_num in range(3):
+                amber_pipes.write_data_to_pipe(wire.encode_header([1]),
+                                               wire.encode_message(drivermsg_pb2.DriverMsg.DATA, ack_num=syn_num))
+            amber_pipes._AmberPipes__handle_frame(header.SerializeToString(), message.SerializeToString())
+
+        thread = threading.Thread(target=read_frames)
+        thread.daemon = True
+        thread.start()
+        thread.join(1.0)
+        self.assertFalse(thread.is_alive())
+        self.assertGreater(frame_writer.get_counters()['reply']['dropped'], 0)
+
+        write_allowed.set()
+        frame_writer.terminate()
+        frame_writer._FrameWriter__writing_thread.join()
+
+        frame_reader = FrameReader(chunked_read_into(''.join(written), 4096))
+        pong_message = drivermsg_pb2.DriverMsg.FromString(frame_reader.read_frame()[1])
+        while pong_message.type != drivermsg_pb2.DriverMsg.PONG:
+            pong_message = drivermsg_pb2.DriverMsg.FromString(frame_reader.read_frame()[1])
+        self.assertEqual(pong_message.ackNum, 7)
+
+
+class FrameWriterTestCase(unittest.TestCase):
+    def runTest(self):
+        written = []
+        first_write_started, first_write_allowed = threading.Event(), threading.Event()
+
+        def write(binary_string):
+            written.append(binary_string)
+            if len(written) == 1:
+                first_write_started.set()
+                first_write_allowed.wait()
+
+        frame_writer = FrameWriter(write)
+        frame_writer.put('\x01')
+        first_write_started.wait()
+
+        frame_writer.put('\x02')
+        frame_writer.put('\x03')
+        first_write_allowed.set()
+        frame_writer.terminate()
+        frame_writer._FrameWriter__writing_thread.join()
+
+        self.assertEqual(written, ['\x01', '\x02\x03'])
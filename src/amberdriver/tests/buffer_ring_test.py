@@ -0,0 +1,59 @@
+import threading
+
+from amberdriver.common.buffer_ring import BufferRing
+
+
+__author__ = 'paoolo'
+
+import unittest
+
+
+class PassBuffersTestCase(unittest.TestCase):
+    def runTest(self):
+        buffer_ring = BufferRing(2, 4)
+        first = buffer_ring.acquire()
+        self.assertEqual(first, bytearray(4))
+        first[:] = 'abcd'
+        buffer_ring.put(first)
+
+        self.assertIs(buffer_ring.take(), first)
+        second = buffer_ring.acquire()
+        self.assertIsNot(second, first)
+        buffer_ring.release(first)
+
+        self.assertIs(buffer_ring.acquire(), first)
+        self.assertEqual(buffer_ring.get_dropped_count(), 0)
+
+
+class DropOldestTestCase(unittest.TestCase):
+    def runTest(self):
+        buffer_ring = BufferRing(2, 4)
+        first, second = buffer_ring.acquire(), buffer_ring.acquire()
+        buffer_ring.put(first)
+        buffer_ring.put(second)
+
+        # decoder is behind, the oldest scan is dropped
+        self.assertIs(buffer_ring.acquire(), first)
+        self.assertEqual(buffer_ring.get_dropped_count(), 1)
+        self.assertIs(buffer_ring.take(), second)
+
+
+class CloseTestCase(unittest.TestCase):
+    def runTest(self):
+        buffer_ring = BufferRing(2, 4)
+        buffer_ring.put(buffer_ring.acquire())
+        taken = []
+
+        def take():
+            scan_buffer = buffer_ring.take()
+            while scan_buffer is not None:
+                taken.append(scan_buffer)
+                scan_buffer = buffer_ring.take()
+
+        thread = threading.Thread(target=take)
+        thread.start()
+        buffer_ring.close()
+        thread.join(1.0)
+
+        self.assertFalse(thread.is_alive())
+        self.assertEqual(len(taken), 1)
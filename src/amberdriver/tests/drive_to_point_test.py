@@ -1,5 +1,6 @@
 import mock
 
+from amberdriver.common import drivermsg_pb2
 from amberdriver.drive_to_point import drive_to_point_pb2
 from amberdriver.drive_to_point.drive_to_point import DriveToPoint
 from amberdriver.drive_to_point.drive_to_point_controller import DriveToPointController
@@ -26,53 +27,27 @@ class DriveToPointControllerTestCase(unittest.TestCase):
 
 class HandleDataMessageTestCase(DriveToPointControllerTestCase):
     def runTest(self):
-        header, message = mock.Mock(), mock.Mock()
-
-        message.HasExtension = mock.Mock(side_effect=lambda ext: ext is drive_to_point_pb2.setTargets)
-        mocked_handle_set_targets = mock.Mock()
-        self.controller._DriveToPointController__handle_set_targets = mocked_handle_set_targets
-        self.controller.handle_data_message(header, message)
-        mocked_handle_set_targets.assert_called_once_with(header, message)
-        self.assertEqual(message.HasExtension.call_count, 1)
-
-        message.HasExtension = mock.Mock(side_effect=lambda ext: ext is drive_to_point_pb2.getNextTarget)
-        mocked_handle_get_next_target = mock.Mock()
-        self.controller._DriveToPointController__handle_get_next_target = mocked_handle_get_next_target
-        self.controller.handle_data_message(header, message)
-        mocked_handle_get_next_target.assert_called_once_with(header, message)
-        self.assertEqual(message.HasExtension.call_count, 2)
-
-        message.HasExtension = mock.Mock(side_effect=lambda ext: ext is drive_to_point_pb2.getNextTargets)
-        mocked_handle_get_next_targets = mock.Mock()
-        self.controller._DriveToPointController__handle_get_next_targets = mocked_handle_get_next_targets
-        self.controller.handle_data_message(header, message)
-        mocked_handle_get_next_targets.assert_called_once_with(header, message)
-        self.assertEqual(message.HasExtension.call_count, 3)
-
-        message.HasExtension = mock.Mock(side_effect=lambda ext: ext is drive_to_point_pb2.getVisitedTarget)
-        mocked_handle_get_visited_target = mock.Mock()
-        self.controller._DriveToPointController__handle_get_visited_target = mocked_handle_get_visited_target
-        self.controller.handle_data_message(header, message)
-        mocked_handle_get_visited_target.assert_called_once_with(header, message)
-        self.assertEqual(message.HasExtension.call_count, 4)
-
-        message.HasExtension = mock.Mock(side_effect=lambda ext: ext is drive_to_point_pb2.getVisitedTargets)
-        mocked_handle_get_visited_targets = mock.Mock()
-        self.controller._DriveToPointController__handle_get_visited_targets = mocked_handle_get_visited_targets
-        self.controller.handle_data_message(header, message)
-        mocked_handle_get_visited_targets.assert_called_once_with(header, message)
-        self.assertEqual(message.HasExtension.call_count, 5)
-
-        message.HasExtension = mock.Mock(side_effect=lambda ext: ext is drive_to_point_pb2.getConfiguration)
-        mocked_handle_get_configuration = mock.Mock()
-        self.controller._DriveToPointController__handle_get_configuration = mocked_handle_get_configuration
-        self.controller.handle_data_message(header, message)
-        mocked_handle_get_configuration.assert_called_once_with(header, message)
-        self.assertEqual(message.HasExtension.call_count, 6)
-
-        message.HasExtension = mock.Mock(side_effect=lambda ext: False)
+        header = drivermsg_pb2.DriverHdr()
+
+        for extension, name in [(drive_to_point_pb2.setTargets, '__handle_set_targets'),
+                                (drive_to_point_pb2.getNextTarget, '__handle_get_next_target'),
+                                (drive_to_point_pb2.getNextTargets, '__handle_get_next_targets'),
+                                (drive_to_point_pb2.getVisitedTarget, '__handle_get_visited_target'),
+                                (drive_to_point_pb2.getVisitedTargets, '__handle_get_visited_targets'),
+                                (drive_to_point_pb2.getConfiguration, '__handle_get_configuration')]:
+            message = drivermsg_pb2.DriverMsg()
+            message.type = drivermsg_pb2.DriverMsg.DATA
+            message.Extensions[extension] = True
+
+            mocked_handle = mock.Mock()
+            setattr(self.controller, '_DriveToPointController' + name, mocked_handle)
+            self.controller.handle_data_message(header, message)
+            mocked_handle.assert_called_once_with(header, message)
+
+        message = drivermsg_pb2.DriverMsg()
+        message.type = drivermsg_pb2.DriverMsg.DATA
         self.controller.handle_data_message(header, message)
-        self.assertEqual(message.HasExtension.call_count, 6)
+        self.assertEqual(mocked_handle.call_count, 1)
 
 
 class HandleSetTargetsTestCase(DriveToPointControllerTestCase):
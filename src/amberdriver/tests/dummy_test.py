@@ -1,3 +1,4 @@
+from amberdriver.common import drivermsg_pb2
 from amberdriver.dummy import dummy_pb2
 from amberdriver.dummy.dummy_controller import DummyController
 
@@ -28,82 +29,56 @@ class HandleDataMessageTestCase(DummyControllerTestCase):
 
 class HandleNoRequestTestCase(HandleDataMessageTestCase):
     def runTest(self):
-        header, message = mock.Mock(), mock.Mock()
+        header, message = drivermsg_pb2.DriverHdr(), drivermsg_pb2.DriverMsg()
+        message.type = drivermsg_pb2.DriverMsg.DATA
 
-        message.HasExtension = mock.Mock(return_value=False)
-        calls = [mock.call(dummy_pb2.enable),
-                 mock.call(dummy_pb2.message),
-                 mock.call(dummy_pb2.get_status)]
         self.controller.handle_data_message(header, message)
-        message.HasExtension.assert_has_calls(calls)
+        self.assertEqual(self.mocked_amber_pipes.write_header_and_message_to_pipe.call_count, 0)
 
 
 class HandleSetEnableTestCase(HandleDataMessageTestCase):
     def runTest(self):
-        header, message = mock.Mock(), mock.Mock()
-
-        def has_set_enable(arg):
-            return arg is dummy_pb2.enable
-
-        message.HasExtension = mock.Mock(side_effect=has_set_enable)
+        header, message = drivermsg_pb2.DriverHdr(), drivermsg_pb2.DriverMsg()
+        message.type = drivermsg_pb2.DriverMsg.DATA
+        message.Extensions[dummy_pb2.enable] = True
 
-        value = object()
-
-        message.Extensions = {dummy_pb2.enable: value}
-
-        calls = [mock.call(dummy_pb2.enable)]
         self.controller.handle_data_message(header, message)
-        message.HasExtension.assert_has_calls(calls)
 
-        self.assertEqual(self.mocked_dummy.enable, value)
+        self.assertEqual(self.mocked_dummy.enable, True)
 
 
 class HandleSetMessageTestCase(HandleDataMessageTestCase):
     def runTest(self):
-        header, message = mock.Mock(), mock.Mock()
-
-        def has_set_message(arg):
-            return arg is dummy_pb2.message
+        header, message = drivermsg_pb2.DriverHdr(), drivermsg_pb2.DriverMsg()
+        message.type = drivermsg_pb2.DriverMsg.DATA
+        message.Extensions[dummy_pb2.message] = 'value'
 
-        message.HasExtension = mock.Mock(side_effect=has_set_message)
-
-        value = object()
-
-        message.Extensions = {dummy_pb2.message: value}
-
-        calls = [mock.call(dummy_pb2.enable),
-                 mock.call(dummy_pb2.message)]
         self.controller.handle_data_message(header, message)
-        message.HasExtension.assert_has_calls(calls)
 
-        self.assertEqual(self.mocked_dummy.message, value)
+        self.assertEqual(self.mocked_dummy.message, 'value')
 
 
 class HandleGetStatusTestCase(HandleDataMessageTestCase):
     def runTest(self):
-        header, message = mock.Mock(), mock.Mock()
-
-        message.synNum = int()
-        header.clientIDs = list()
+        header, message = drivermsg_pb2.DriverHdr(), drivermsg_pb2.DriverMsg()
+        header.clientIDs.extend([1])
+        message.type = drivermsg_pb2.DriverMsg.DATA
+        message.synNum = 2
+        message.Extensions[dummy_pb2.get_status] = True
 
         self.mocked_dummy.enable = True
-        self.mocked_dummy.message = str()
-
-        def has_get_status(arg):
-            return arg is dummy_pb2.get_status
-
-        message.HasExtension = mock.Mock(side_effect=has_get_status)
+        self.mocked_dummy.message = 'value'
 
-        value = mock.Mock()
+        def write_to_pipe(response_header, response_message):
+            self.assertEqual(list(response_header.clientIDs), [1])
+            self.assertEqual(response_message.ackNum, 2)
+            self.assertEqual(response_message.Extensions[dummy_pb2.enable], True)
+            self.assertEqual(response_message.Extensions[dummy_pb2.message], 'value')
 
-        message.Extensions = mock.Mock()
-        message.Extensions.__getitem__ = lambda *args, **kw: value
+        self.mocked_amber_pipes.write_header_and_message_to_pipe = mock.Mock(side_effect=write_to_pipe)
 
-        calls = [mock.call(dummy_pb2.enable),
-                 mock.call(dummy_pb2.message),
-                 mock.call(dummy_pb2.get_status)]
         self.controller.handle_data_message(header, message)
-        message.HasExtension.assert_has_calls(calls)
+        self.assertEqual(self.mocked_amber_pipes.write_header_and_message_to_pipe.call_count, 1)
 
 
 class HandleSubscribeTestCase(DummyControllerTestCase):
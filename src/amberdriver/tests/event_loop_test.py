@@ -0,0 +1,66 @@
+import os
+import threading
+import time
+
+from amberdriver.common.event_loop import EventLoop
+
+
+__author__ = 'paoolo'
+
+import unittest
+
+
+class EventLoopTestCase(unittest.TestCase):
+    def setUp(self):
+        self.event_loop = EventLoop()
+        self.calls = []
+
+    def run_loop(self, timeout):
+        self.event_loop.call_later(timeout, self.event_loop.stop)
+        self.event_loop.run()
+
+
+class CallLaterTestCase(EventLoopTestCase):
+    def runTest(self):
+        self.event_loop.call_later(0.02, self.calls.append, 2)
+        self.event_loop.call_later(0.01, self.calls.append, 1)
+        self.run_loop(0.05)
+        self.assertEqual(self.calls, [1, 2])
+
+
+class CallPeriodicallyTestCase(EventLoopTestCase):
+    def runTest(self):
+        self.event_loop.call_periodically(0.01, self.calls.append, None)
+        self.run_loop(0.055)
+        self.assertTrue(4 <= len(self.calls) <= 6)
+
+
+class CallSoonFromOtherThreadTestCase(EventLoopTestCase):
+    def runTest(self):
+        def call_soon():
+            time.sleep(0.01)
+            self.event_loop.call_soon(self.calls.append, threading.current_thread())
+            self.event_loop.stop()
+
+        thread = threading.Thread(target=call_soon)
+        thread.start()
+        self.event_loop.run()
+        thread.join()
+        self.assertEqual(self.calls, [thread])
+
+
+class AddReaderTestCase(EventLoopTestCase):
+    def runTest(self):
+        pipe_in, pipe_out = os.pipe()
+
+        def read():
+            self.calls.append(os.read(pipe_in, 16))
+            self.event_loop.remove_reader(pipe_in)
+
+        self.event_loop.add_reader(pipe_in, read)
+        self.event_loop.call_later(0.01, os.write, pipe_out, '\x01\x02')
+        self.run_loop(0.05)
+        self.assertEqual(self.calls, ['\x01\x02'])
+
+        os.close(pipe_in)
+        os.close(pipe_out)
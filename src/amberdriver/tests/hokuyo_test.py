@@ -1,3 +1,15 @@
+import StringIO
+import array
+
+import mock
+
+from amberdriver.common import drivermsg_pb2
+from amberdriver.common.future import Future
+from amberdriver.hokuyo import hokuyo, hokuyo_pb2, scip
+from amberdriver.hokuyo.hokuyo_controller import HokuyoController
+from amberdriver.tools import serial_port
+
+
 __author__ = 'paoolo'
 
 import unittest
@@ -5,4 +17,241 @@ import unittest
 
 class HokuyoControllerTestCase(unittest.TestCase):
     def setUp(self):
-        pass
+        self.scan = (array.array('d', [-1.5, 0.0, 1.5]), array.array('i', [100, 200, 300]), 1234567)
+        self.driver = mock.Mock()
+        self.driver.get_next_scan = mock.Mock(side_effect=lambda: Future.of(self.scan))
+        self.driver.get_scan = mock.Mock(side_effect=lambda: self.scan)
+
+        self.controller = HokuyoController(mock.Mock(), mock.Mock(), self.driver)
+        self.frames = []
+        amber_pipes = mock.Mock()
+        amber_pipes.write_data_to_pipe = mock.Mock(
+            side_effect=lambda header_data, message_data, message_class: self.frames.append(
+                (drivermsg_pb2.DriverHdr.FromString(header_data), drivermsg_pb2.DriverMsg.FromString(message_data))))
+        self.controller._MessageHandler__amber_pipes = amber_pipes
+
+    def assertScan(self, message, ack_num):
+        expected = drivermsg_pb2.DriverMsg()
+        expected.type = drivermsg_pb2.DriverMsg.DATA
+        expected.ackNum = ack_num
+        expected.Extensions[hokuyo_pb2.scan].angles.extend(self.scan[0])
+        expected.Extensions[hokuyo_pb2.scan].distances.extend(self.scan[1])
+        expected.Extensions[hokuyo_pb2.timestamp] = self.scan[2]
+        self.assertEqual(message.SerializeToString(), expected.SerializeToString())
+
+    def runTest(self):
+        for client_id, syn_num in [(1, 10), (2, 20)]:
+            header, message = drivermsg_pb2.DriverHdr(), drivermsg_pb2.DriverMsg()
+            header.clientIDs.append(client_id)
+            message.type = drivermsg_pb2.DriverMsg.DATA
+            message.synNum = syn_num
+            message.Extensions[hokuyo_pb2.get_single_scan] = True
+            self.controller._HokuyoController__handle_get_single_scan(header, message)
+
+        # new scan is published to subscribers by listener registered in driver
+        publish_scan = self.driver.add_scan_listener.call_args[0][0]
+        publish_scan(self.scan)
+        self.assertEqual(len(self.frames), 2)
+        self.controller.add_subscribers([3])
+        publish_scan(self.scan)
+
+        self.assertEqual([list(header.clientIDs) for header, _ in self.frames], [[1], [2], [3]])
+        for (_, message), ack_num in zip(self.frames, [10, 20, 0]):
+            self.assertScan(message, ack_num)
+
+        # scan is serialized once, until next scan
+        serialized_scan = self.controller._HokuyoController__serialize_scan(self.scan)
+        self.assertIs(self.controller._HokuyoController__serialize_scan(self.scan), serialized_scan)
+        self.scan = (self.scan[0], self.scan[1], 1234568)
+        self.assertIsNot(self.controller._HokuyoController__serialize_scan(self.scan), serialized_scan)
+
+
+class PublishScanTestCase(HokuyoControllerTestCase):
+    def runTest(self):
+        self.controller.add_subscribers([3])
+        published_scan = self.scan
+        # newer scan replaced notified one meanwhile
+        self.scan = (self.scan[0], self.scan[1], 1234568)
+
+        publish_scan = self.driver.add_scan_listener.call_args[0][0]
+        publish_scan(published_scan)
+
+        self.scan = published_scan
+        self.assertEqual(len(self.frames), 1)
+        self.assertScan(self.frames[0][1], 0)
+
+
+class GetScansTestCase(HokuyoControllerTestCase):
+    def runTest(self):
+        # about 7 KB of angles and distances, as full scan of URG
+        scan = (array.array('d', [0.5] * 682), array.array('i', [4000] * 682), 0)
+        self.driver.get_scans = mock.Mock(return_value=[scan[:2] + (timestamp,) for timestamp in range(10)])
+
+        header, message = drivermsg_pb2.DriverHdr(), drivermsg_pb2.DriverMsg()
+        header.clientIDs.append(1)
+        message.type = drivermsg_pb2.DriverMsg.DATA
+        message.synNum = 5
+        message.Extensions[hokuyo_pb2.get_scans] = True
+        amber_pipes = self.controller._MessageHandler__amber_pipes
+        amber_pipes.write_header_and_message_to_pipe = mock.Mock(
+            side_effect=lambda response_header, response_message: self.frames.append(
+                (list(response_header.clientIDs), response_message.SerializeToString())))
+        self.controller._HokuyoController__handle_get_scans(header, message)
+
+        # only the newest scans, which fit in frame, oldest first
+        _, response = self.frames[0]
+        response = drivermsg_pb2.DriverMsg.FromString(response)
+        self.assertEqual(response.ackNum, 5)
+        self.assertFalse(response.HasExtension(hokuyo_pb2.get_scans))
+        self.assertEqual([scan.timestamp for scan in response.Extensions[hokuyo_pb2.scans]], [6, 7, 8, 9])
+        self.assertLessEqual(response.ByteSize(), 2 ** 15 - 1)
+
+
+def encode(value):
+    return ''.join(chr(((value >> shift) & 0x3f) + 0x30) for shift in (12, 6, 0))
+
+
+def encode_line(data):
+    return data + chr(scip.checksum(bytearray(data))) + '\n'
+
+
+def mock_port(data):
+    reply = StringIO.StringIO(data)
+    serial = mock.Mock()
+    serial.read.side_effect = reply.read
+    serial.inWaiting.side_effect = lambda: len(data) - reply.tell()
+    return serial_port.SerialPort(serial), serial
+
+
+def encode_scan(echo, status, values):
+    data = ''.join(map(encode, values))
+    return echo + '\n' + encode_line(status) + encode_line('0000') + \
+        ''.join(encode_line(data[i:i + 64]) for i in xrange(0, len(data), 64)) + '\n'
+
+
+class EncodeScanTestCase(unittest.TestCase):
+    def runTest(self):
+        angles = hokuyo.Hokuyo._Hokuyo__get_angles(1, 44, 725)
+        distances = array.array('i', [(i * 37) % 262144 for i in xrange(len(angles))])
+        for scan in [(angles, distances, 1416000000000), (array.array('d', [0.5]), array.array('i', [-1]), 0)]:
+            message = drivermsg_pb2.DriverMsg()
+            message.Extensions[hokuyo_pb2.scan].angles.extend(scan[0])
+            message.Extensions[hokuyo_pb2.scan].distances.extend(scan[1])
+            message.Extensions[hokuyo_pb2.timestamp] = scan[2]
+            self.assertEqual(HokuyoController.encode_scan(*scan), message.SerializePartialToString())
+
+
+class MultiScanningTestCase(unittest.TestCase):
+    def runTest(self):
+        scans = [[(i * step) % 4096 for i in xrange(682)] for step in (3, 5, 7)]
+        responses = [encode_scan('MD0044072501000', '99', values) for values in scans]
+        # scan with invalid sum is dropped, the next one is read
+        corrupted = responses[0][:100] + chr(ord(responses[0][100]) ^ 0x01) + responses[0][101:]
+        responses.insert(2, corrupted)
+        port, _ = mock_port('MD0044072501000\n' + '00P\n\n' + ''.join(responses))
+        with mock.patch('amberdriver.hokuyo.hokuyo.runtime'):
+            driver = hokuyo.Hokuyo(port)
+        published = []
+        driver.add_scan_listener(lambda scan: published.append(list(scan[1])))
+        driver.enable_scanning(True)
+
+        # scanning stops, when port runs out of data
+        with mock.patch('amberdriver.hokuyo.hokuyo.traceback'), mock.patch('amberdriver.hokuyo.hokuyo.sys'):
+            driver._Hokuyo__multi_scanning_loop()
+
+        self.assertEqual(published, [list(reversed(values)) for values in scans])
+
+
+class DecodeValuesTestCase(unittest.TestCase):
+    def runTest(self):
+        values = [0, 1, 63, 64, 4095, 4096, 262143] * 100
+        data = ''.join(map(encode, values))
+        self.assertEqual(hokuyo.decode_values(bytearray(data)).tolist(), values)
+        self.assertEqual(map(hokuyo.decode, [data[i:i + 3] for i in xrange(0, len(data), 3)]), values)
+
+
+class GetSingleScanTestCase(unittest.TestCase):
+    def runTest(self):
+        values = [(i * 37) % 4096 for i in xrange(682)]
+        port, serial = mock_port(encode_scan('GD0044072501', '00', values))
+        with mock.patch('amberdriver.hokuyo.hokuyo.runtime'):
+            driver = hokuyo.Hokuyo(port)
+        listener = mock.Mock()
+        driver.add_scan_listener(listener)
+
+        # scanning stopped without scan for pending future, single scan is taken instead
+        future = driver.get_next_scan()
+        driver._Hokuyo__get_pending_scan()
+        angles, distances, _ = future.result(0)
+        listener.assert_called_once_with(driver.get_scan())
+        # response is read exactly, without reading ahead
+        self.assertEqual(serial.read.call_count, 1)
+
+        step = hokuyo.Hokuyo.STEP_DEG
+        scan = dict((-((step * i) - hokuyo.Hokuyo.START_DEG), value) for i, value in enumerate(values))
+        self.assertEqual(list(angles), sorted(scan.keys()))
+        self.assertEqual(list(distances), map(scan.get, sorted(scan.keys())))
+
+        # table of angles is shared by scans of the same range
+        self.assertIs(hokuyo.Hokuyo._Hokuyo__get_angles(1, 44, 725), angles)
+
+
+class ResyncTestCase(unittest.TestCase):
+    def runTest(self):
+        # parser is in the middle of response, when protocol error is found
+        read, garbage = 'GD0044072501\n' + encode_line('00') + '00', '00\n1111\n\n'
+        port, serial = mock_port(garbage + encode_scan('GD0044072501', '00', [5] * 682))
+        with mock.patch('amberdriver.hokuyo.hokuyo.runtime'):
+            driver = hokuyo.Hokuyo(port)
+        driver._Hokuyo__parser.feed(read)
+
+        with mock.patch('amberdriver.hokuyo.hokuyo.sys'):
+            driver._Hokuyo__offset()
+        self.assertEqual(driver.get_resync_counters(), {'resyncs': 1, 'skipped_bytes': len(read + garbage)})
+
+        # bytes read after the end of response are kept for the next one
+        self.assertEqual(list(driver._Hokuyo__get_single_scan()[1]), [5] * 682)
+        self.assertEqual(serial.read.call_count, 1)
+
+
+class NextScanTimeoutTestCase(unittest.TestCase):
+    def runTest(self):
+        port, _ = mock_port('')
+        with mock.patch('amberdriver.hokuyo.hokuyo.runtime'):
+            driver = hokuyo.Hokuyo(port)
+
+        # single scan fails as well, future is pending until timeout
+        future = driver.get_next_scan()
+        with mock.patch('amberdriver.hokuyo.hokuyo.traceback'), mock.patch('amberdriver.hokuyo.hokuyo.sys'):
+            driver._Hokuyo__get_pending_scan()
+        driver._Hokuyo__expire_scan_futures()
+        self.assertFalse(future.done())
+
+        with mock.patch('amberdriver.hokuyo.hokuyo.NEXT_SCAN_TIMEOUT', -1.0):
+            driver._Hokuyo__expire_scan_futures()
+        self.assertRaises(IOError, future.result, 0)
+
+
+class NextScanTerminateTestCase(unittest.TestCase):
+    def runTest(self):
+        port, _ = mock_port('')
+        with mock.patch('amberdriver.hokuyo.hokuyo.runtime'):
+            driver = hokuyo.Hokuyo(port)
+
+        # pending futures fail, when driver is terminated
+        future = driver.get_next_scan()
+        with mock.patch('amberdriver.hokuyo.hokuyo.traceback'), mock.patch('amberdriver.hokuyo.hokuyo.sys'):
+            driver.terminate()
+        self.assertRaises(IOError, future.result, 0)
+
+
+class LongCommandTestCase(unittest.TestCase):
+    def runTest(self):
+        reply = 'VV\n00P\n' + ''.join(encode_line(line) for line in ['VEND:Hokuyo;', 'PROD:URG-04LX;', 'FIRM:3.4;',
+                                                                     'PROT:SCIP 2.0;', 'SERI:H0000000;']) + '\n'
+        port, serial = mock_port(reply)
+        with mock.patch('amberdriver.hokuyo.hokuyo.runtime'):
+            driver = hokuyo.Hokuyo(port)
+
+        self.assertEqual(driver.get_version_info(), reply)
+        self.assertEqual(serial.read.call_count, 1)
@@ -1,5 +1,10 @@
+import struct
+import threading
+
 from amberdriver.common import drivermsg_pb2
+from amberdriver.common.future import Future
 from amberdriver.common.message_handler import MessageHandler
+from amberdriver.dummy import dummy_pb2
 
 __author__ = 'paoolo'
 
@@ -8,6 +13,15 @@ import unittest
 import mock
 
 
+def data_message(client_id, syn_num, extension):
+    header, message = drivermsg_pb2.DriverHdr(), drivermsg_pb2.DriverMsg()
+    header.clientIDs.extend([client_id])
+    message.type = drivermsg_pb2.DriverMsg.DATA
+    message.synNum = syn_num
+    message.Extensions[extension] = True
+    return header, message
+
+
 class MessageHandlerTestCase(unittest.TestCase):
     class TestMessageHandler(MessageHandler):
         def handle_subscribe_message(self, header, message):
@@ -48,3 +62,317 @@ class MessageHandlerTestCase(unittest.TestCase):
                                                                              self.response_message)
 
         amber_pipes.is_alive = mock.Mock(return_value=False)
+
+
+class OversizeResponseTestCase(unittest.TestCase):
+    class TestMessageHandler(MessageHandlerTestCase.TestMessageHandler):
+        @MessageHandler.handle_and_response
+        def handle_message(self, received_header, received_message, response_header, response_message):
+            response_message.Extensions[dummy_pb2.message] = 'x' * 2 ** 15
+            return response_header, response_message
+
+    def runTest(self):
+        mocked_stdout = mock.Mock()
+        message_handler = OversizeResponseTestCase.TestMessageHandler(mock.Mock(), mocked_stdout)
+
+        header, message = drivermsg_pb2.DriverHdr(), drivermsg_pb2.DriverMsg()
+        header.clientIDs.append(1)
+        message.type = drivermsg_pb2.DriverMsg.DATA
+        message.synNum = 5
+        message_handler.handle_message(header, message)
+
+        # response, which does not fit in frame, is replaced with response without extensions
+        frame = mocked_stdout.write.call_args[0][0]
+        header_length = struct.unpack('!h', frame[:2])[0]
+        response_message = drivermsg_pb2.DriverMsg.FromString(frame[2 + header_length + 2:])
+        self.assertEqual(mocked_stdout.write.call_count, 1)
+        self.assertEqual(response_message.ackNum, 5)
+        self.assertFalse(response_message.HasExtension(dummy_pb2.message))
+
+
+class DispatchedMessageHandlerTestCase(unittest.TestCase):
+    class TestMessageHandler(MessageHandlerTestCase.TestMessageHandler):
+        def __init__(self, pipe_in, pipe_out):
+            super(DispatchedMessageHandlerTestCase.TestMessageHandler, self).__init__(pipe_in, pipe_out,
+                                                                                      handler_workers=2)
+            self.handled = threading.Event()
+            self.handling_thread = None
+
+        def handle_data_message(self, header, message):
+            self.handling_thread = threading.current_thread()
+            self.handled.set()
+
+    def runTest(self):
+        message_handler = DispatchedMessageHandlerTestCase.TestMessageHandler(mock.Mock(), mock.Mock())
+        header, message = mock.Mock(), mock.Mock()
+        header.clientIDs = [1]
+
+        message_handler.handle_data_message(header, message)
+        message_handler.handled.wait(1.0)
+
+        self.assertTrue(message_handler.handled.is_set())
+        self.assertIsNot(message_handler.handling_thread, threading.current_thread())
+
+
+class DispatchedClientDiedTestCase(unittest.TestCase):
+    class TestMessageHandler(MessageHandlerTestCase.TestMessageHandler):
+        def __init__(self, pipe_in, pipe_out):
+            super(DispatchedClientDiedTestCase.TestMessageHandler, self).__init__(pipe_in, pipe_out,
+                                                                                  handler_workers=2)
+            self.handled = []
+            self.released = threading.Event()
+            self.client_died = threading.Event()
+
+        def handle_data_message(self, header, message):
+            self.released.wait(1.0)
+            self.handled.append(('data', header.clientIDs[0]))
+
+        def handle_client_died_message(self, client_id):
+            self.handled.append(('client_died', client_id))
+            self.client_died.set()
+
+    def runTest(self):
+        message_handler = DispatchedClientDiedTestCase.TestMessageHandler(mock.Mock(), mock.Mock())
+        header, message = mock.Mock(), mock.Mock()
+        header.clientIDs = [1]
+
+        # CLIENT_DIED waits for DATA of the same client, which is still handled
+        message_handler.handle_data_message(header, message)
+        message_handler.handle_client_died_message(1)
+        self.assertFalse(message_handler.client_died.is_set())
+
+        message_handler.released.set()
+        message_handler.client_died.wait(1.0)
+        self.assertEqual(message_handler.handled, [('data', 1), ('client_died', 1)])
+
+
+class DeferredResponseTestCase(unittest.TestCase):
+    class TestMessageHandler(MessageHandlerTestCase.TestMessageHandler):
+        @MessageHandler.handle_and_response
+        def handle_deferred_message(self, received_header, received_message, response_header, response_message):
+            return self.single_flight('key', lambda: self.result).then(
+                lambda result: (response_header, response_message))
+
+    def runTest(self):
+        message_handler = DeferredResponseTestCase.TestMessageHandler(mock.Mock(), mock.Mock())
+        amber_pipes = mock.Mock()
+        responses = []
+        amber_pipes.write_header_and_message_to_pipe = mock.Mock(
+            side_effect=lambda header, message: responses.append((list(header.clientIDs), message.ackNum)))
+        message_handler._MessageHandler__amber_pipes = amber_pipes
+        message_handler.result = Future()
+
+        for client_id, syn_num in [(1, 10), (2, 20)]:
+            header, message = mock.Mock(), mock.Mock()
+            header.clientIDs, message.synNum = [client_id], syn_num
+            message_handler.handle_deferred_message(header, message)
+
+        self.assertEqual(amber_pipes.write_header_and_message_to_pipe.call_count, 0)
+        message_handler.result.set_result(None)
+        self.assertEqual(amber_pipes.write_header_and_message_to_pipe.call_count, 2)
+
+        self.assertEqual(responses, [([1], 10), ([2], 20)])
+
+
+class DeferredResponseAfterFinishedTestCase(unittest.TestCase):
+    def runTest(self):
+        message_handler = DeferredResponseTestCase.TestMessageHandler(mock.Mock(), mock.Mock())
+        amber_pipes = mock.Mock()
+        message_handler._MessageHandler__amber_pipes = amber_pipes
+        header, message = mock.Mock(), mock.Mock()
+        header.clientIDs, message.synNum = [1], 10
+
+        message_handler.result = Future.of(None)
+        message_handler.handle_deferred_message(header, message)
+
+        # operation is finished, so next request runs new one
+        message_handler.result = Future()
+        message_handler.handle_deferred_message(header, message)
+        self.assertEqual(amber_pipes.write_header_and_message_to_pipe.call_count, 1)
+
+
+class SubscribersTestCase(unittest.TestCase):
+    def runTest(self):
+        message_handler = MessageHandlerTestCase.TestMessageHandler(mock.Mock(), mock.Mock())
+        self.assertFalse(message_handler.is_any_subscriber())
+
+        message_handler.add_subscribers([1, 2])
+        snapshot = message_handler.get_subscribers()
+        message_handler.add_subscribers([2, 3])
+        self.assertEqual(message_handler.get_subscribers(), (1, 2, 3))
+        self.assertEqual(snapshot, (1, 2))
+
+        message_handler.remove_subscriber(2)
+        message_handler.remove_subscriber(4)
+        self.assertEqual(message_handler.get_subscribers(), (1, 3))
+        self.assertTrue(message_handler.is_any_subscriber())
+
+
+class SendSubscribersMessageTestCase(unittest.TestCase):
+    def runTest(self):
+        message_handler = MessageHandlerTestCase.TestMessageHandler(mock.Mock(), mock.Mock())
+        amber_pipes = mock.Mock()
+        message_handler._MessageHandler__amber_pipes = amber_pipes
+
+        message_handler.send_subscribers_message()
+        self.assertEqual(amber_pipes.write_header_and_message_to_pipe.call_count, 0)
+
+        client_ids = []
+        amber_pipes.write_header_and_message_to_pipe = mock.Mock(
+            side_effect=lambda header, message, message_class: client_ids.append(list(header.clientIDs)))
+        message_handler.fill_subscription_response = lambda response_message: response_message
+        message_handler.add_subscribers([1, 1, 2])
+
+        message_handler.send_subscribers_message()
+        self.assertEqual(client_ids, [[1, 2]])
+
+
+class SendSubscribersMessageWithDecimationTestCase(unittest.TestCase):
+    def runTest(self):
+        message_handler = MessageHandlerTestCase.TestMessageHandler(mock.Mock(), mock.Mock())
+        amber_pipes = mock.Mock()
+        message_handler._MessageHandler__amber_pipes = amber_pipes
+
+        client_ids = []
+        amber_pipes.write_header_and_message_to_pipe = mock.Mock(
+            side_effect=lambda header, message, message_class: client_ids.append(list(header.clientIDs)))
+        message_handler.fill_subscription_response = mock.Mock(side_effect=lambda response_message: response_message)
+
+        subscribe_message = drivermsg_pb2.DriverMsg()
+        subscribe_message.type = drivermsg_pb2.DriverMsg.SUBSCRIBE
+        subscribe_message.decimation = 3
+
+        message_handler.add_subscribers([1])
+        message_handler.add_subscribers([2, 3], MessageHandler.get_decimation(subscribe_message))
+        message_handler.add_subscribers([4], 2)
+
+        for _ in range(4):
+            message_handler.send_subscribers_message()
+
+        self.assertEqual(client_ids, [[1, 4, 2, 3], [1], [1, 4], [1, 2, 3]])
+        self.assertEqual(message_handler.fill_subscription_response.call_count, 4)
+
+        message_handler.remove_subscriber(1)
+        message_handler.send_subscribers_message()
+        message_handler.send_subscribers_message()
+        self.assertEqual(client_ids[4:], [[4]])
+        self.assertEqual(message_handler.fill_subscription_response.call_count, 5)
+
+
+class RateLimitTestCase(unittest.TestCase):
+    class TestMessageHandler(MessageHandlerTestCase.TestMessageHandler):
+        def handle_data_message(self, header, message):
+            MessageHandler.handle_data_message(self, header, message)
+
+        @MessageHandler.handles(dummy_pb2.get_status, rate_limit=0.001, burst=1)
+        @MessageHandler.handle_and_response
+        def handle_get_status(self, received_header, received_message, response_header, response_message):
+            self.handled += 1
+            response_message.Extensions[dummy_pb2.message] = 'status %d' % self.handled
+            return response_header, response_message
+
+        @MessageHandler.handles(dummy_pb2.enable, rate_limit=0.001, burst=1)
+        def handle_enable(self, received_header, received_message):
+            self.handled += 1
+
+    def runTest(self):
+        message_handler = RateLimitTestCase.TestMessageHandler(mock.Mock(), mock.Mock())
+        message_handler.handled = 0
+        amber_pipes = mock.Mock()
+        message_handler._MessageHandler__amber_pipes = amber_pipes
+
+        for client_id in [1, 1, 2]:
+            message_handler.handle_data_message(*data_message(client_id, 10 + client_id, dummy_pb2.get_status))
+
+        # second request of client 1 is answered with its last response, client 2 has own limit
+        self.assertEqual(message_handler.handled, 2)
+        self.assertEqual(amber_pipes.write_header_and_message_to_pipe.call_count, 2)
+
+        response_header_data, response_message_data, _ = amber_pipes.write_data_to_pipe.call_args[0]
+        response_header = drivermsg_pb2.DriverHdr.FromString(response_header_data)
+        response_message = drivermsg_pb2.DriverMsg.FromString(response_message_data)
+        self.assertEqual(list(response_header.clientIDs), [1])
+        self.assertEqual(response_message.ackNum, 11)
+        self.assertEqual(response_message.Extensions[dummy_pb2.message], 'status 1')
+
+
+class RateLimitThrottledCountsTestCase(unittest.TestCase):
+    def runTest(self):
+        message_handler = RateLimitTestCase.TestMessageHandler(mock.Mock(), mock.Mock())
+        message_handler.handled = 0
+        message_handler._MessageHandler__amber_pipes = mock.Mock()
+
+        for extension in [dummy_pb2.get_status, dummy_pb2.get_status, dummy_pb2.enable, dummy_pb2.enable]:
+            message_handler.handle_data_message(*data_message(1, 10, extension))
+
+        self.assertEqual(message_handler.handled, 2)
+        self.assertEqual(message_handler.get_throttled_counts(),
+                         {dummy_pb2.get_status.number: 1, dummy_pb2.enable.number: 1})
+
+
+class RateLimitCachePerClientTestCase(unittest.TestCase):
+    def runTest(self):
+        message_handler = RateLimitTestCase.TestMessageHandler(mock.Mock(), mock.Mock())
+        message_handler.handled = 0
+        amber_pipes = mock.Mock()
+        message_handler._MessageHandler__amber_pipes = amber_pipes
+
+        message_handler.handle_data_message(*data_message(1, 20, dummy_pb2.get_status))
+        # client 2 is over limit before it got any response
+        header, message = data_message(2, 20, dummy_pb2.get_status)
+        message_handler._MessageHandler__admit(header, dummy_pb2.get_status.number)
+        message_handler.handle_data_message(header, message)
+
+        # response cached for client 1 is not sent to client 2
+        self.assertEqual(message_handler.handled, 1)
+        response_header_data, response_message_data, _ = amber_pipes.write_data_to_pipe.call_args[0]
+        self.assertEqual(list(drivermsg_pb2.DriverHdr.FromString(response_header_data).clientIDs), [2])
+        self.assertFalse(drivermsg_pb2.DriverMsg.FromString(response_message_data).HasExtension(dummy_pb2.message))
+
+
+class RateLimitCacheDroppedOnClientDiedTestCase(unittest.TestCase):
+    def runTest(self):
+        message_handler = RateLimitTestCase.TestMessageHandler(mock.Mock(), mock.Mock())
+        message_handler.handled = 0
+        message_handler._MessageHandler__amber_pipes = mock.Mock()
+
+        message_handler.handle_data_message(*data_message(1, 20, dummy_pb2.get_status))
+        self.assertNotEqual(message_handler._MessageHandler__cached_responses, {})
+
+        message_handler.handle_client_died_message(1)
+        self.assertEqual(message_handler._MessageHandler__cached_responses, {})
+
+
+class RateLimitRejectionTestCase(unittest.TestCase):
+    def runTest(self):
+        message_handler = RateLimitTestCase.TestMessageHandler(mock.Mock(), mock.Mock())
+        message_handler.handled = 0
+        amber_pipes = mock.Mock()
+        message_handler._MessageHandler__amber_pipes = amber_pipes
+
+        message_handler.handle_data_message(*data_message(1, 7, dummy_pb2.enable))
+        message_handler.handle_data_message(*data_message(1, 7, dummy_pb2.enable))
+
+        # there is no response to answer with, request is rejected with empty response
+        self.assertEqual(message_handler.handled, 1)
+        response_header_data, response_message_data, _ = amber_pipes.write_data_to_pipe.call_args[0]
+        response_header = drivermsg_pb2.DriverHdr.FromString(response_header_data)
+        response_message = drivermsg_pb2.DriverMsg.FromString(response_message_data)
+        self.assertEqual(list(response_header.clientIDs), [1])
+        self.assertEqual(response_message.ackNum, 7)
+        self.assertEqual(response_message.ListFields()[-1][0].name, 'ackNum')
+
+
+class RateLimitBucketsDroppedOnClientDiedTestCase(unittest.TestCase):
+    def runTest(self):
+        message_handler = RateLimitTestCase.TestMessageHandler(mock.Mock(), mock.Mock())
+        message_handler.handled = 0
+        message_handler._MessageHandler__amber_pipes = mock.Mock()
+
+        message_handler.handle_data_message(*data_message(1, 7, dummy_pb2.enable))
+        message_handler.handle_client_died_message(1)
+        self.assertEqual(message_handler._MessageHandler__token_buckets, {})
+
+        # client with the same id starts with full bucket
+        message_handler.handle_data_message(*data_message(1, 7, dummy_pb2.enable))
+        self.assertEqual(message_handler.handled, 2)
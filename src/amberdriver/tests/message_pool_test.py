@@ -0,0 +1,87 @@
+import threading
+
+from amberdriver.common import drivermsg_pb2
+from amberdriver.common.message_pool import MessagePool
+
+
+__author__ = 'paoolo'
+
+import unittest
+
+
+class AcquireReleaseTestCase(unittest.TestCase):
+    def runTest(self):
+        message_pool = MessagePool(1)
+
+        header, message = message_pool.acquire()
+        header.clientIDs.extend([1, 2])
+        message.type = drivermsg_pb2.DriverMsg.DATA
+        message_pool.release(header, message)
+
+        reused_header, reused_message = message_pool.acquire()
+        self.assertIs(reused_header, header)
+        self.assertIs(reused_message, message)
+        self.assertEqual(len(reused_header.clientIDs), 0)
+        self.assertFalse(reused_message.HasField('type'))
+
+        other_header, other_message = message_pool.acquire()
+        self.assertIsNot(other_message, message)
+
+
+class RetainTestCase(unittest.TestCase):
+    def runTest(self):
+        message_pool = MessagePool(1)
+
+        header, message = message_pool.acquire()
+        message.synNum = 1
+        message_pool.retain(header, message)
+
+        message_pool.release(header, message)
+        self.assertEqual(message.synNum, 1)
+        self.assertIsNot(message_pool.acquire()[1], message)
+
+        message_pool.release(header, message)
+        self.assertFalse(message.HasField('synNum'))
+
+
+class ReleaseNotPooledTestCase(unittest.TestCase):
+    def runTest(self):
+        message_pool = MessagePool(1)
+
+        header, message = drivermsg_pb2.DriverHdr(), drivermsg_pb2.DriverMsg()
+        message.synNum = 1
+        message_pool.release(header, message)
+
+        self.assertEqual(message.synNum, 1)
+        self.assertIsNot(message_pool.acquire()[1], message)
+
+
+class ReleaseInOtherThreadTestCase(unittest.TestCase):
+    def runTest(self):
+        message_pool = MessagePool(1)
+        header, message = message_pool.acquire()
+
+        thread = threading.Thread(target=message_pool.release, args=(header, message))
+        thread.start()
+        thread.join()
+
+        # pair released by worker is reused by thread, which acquires pairs
+        self.assertIs(message_pool.acquire()[1], message)
+
+
+class PoolSizeTestCase(unittest.TestCase):
+    def runTest(self):
+        message_pool = MessagePool(1)
+        header, message = message_pool.acquire()
+        other_header, other_message = message_pool.acquire()
+
+        # pair allocated over size of pool is not pooled
+        other_message.synNum = 1
+        message_pool.retain(other_header, other_message)
+        message_pool.release(other_header, other_message)
+        self.assertEqual(other_message.synNum, 1)
+
+        message_pool.release(header, message)
+        message_pool.release(header, message)
+        self.assertIs(message_pool.acquire()[1], message)
+        self.assertIsNot(message_pool.acquire()[1], message)
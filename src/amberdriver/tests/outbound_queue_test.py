@@ -0,0 +1,96 @@
+import threading
+
+from amberdriver.common.outbound_queue import OutboundQueue, CONTROL, REPLY, SUBSCRIPTION
+
+
+__author__ = 'paoolo'
+
+import unittest
+
+
+class TakeTestCase(unittest.TestCase):
+    def runTest(self):
+        outbound_queue = OutboundQueue()
+        self.assertEqual(outbound_queue.take(block=False), [])
+
+        outbound_queue.put('s1', SUBSCRIPTION)
+        outbound_queue.put('r1', REPLY)
+        outbound_queue.put('c1', CONTROL)
+        outbound_queue.put('r2', REPLY)
+
+        self.assertEqual(outbound_queue.take(), ['c1', 'r1', 'r2', 's1'])
+        self.assertEqual(outbound_queue.take(block=False), [])
+
+
+class SupersedeTestCase(unittest.TestCase):
+    def runTest(self):
+        outbound_queue = OutboundQueue(reply_size=1, subscription_size=2)
+
+        for frame in ['s1', 's2', 's3', 's4']:
+            outbound_queue.put(frame, SUBSCRIPTION)
+        for frame in ['c1', 'c2', 'c3']:
+            outbound_queue.put(frame, CONTROL)
+
+        self.assertEqual(outbound_queue.take(), ['c1', 'c2', 'c3', 's3'])
+        self.assertEqual(outbound_queue.take(), ['s4'])
+
+        counters = outbound_queue.get_counters()
+        self.assertEqual(counters['subscription'], {'queued': 4, 'superseded': 2, 'dropped': 0})
+        self.assertEqual(counters['control'], {'queued': 3, 'superseded': 0, 'dropped': 0})
+
+
+class PriorityTestCase(unittest.TestCase):
+    def runTest(self):
+        outbound_queue = OutboundQueue()
+        for frame in ['s1', 's2', 's3']:
+            outbound_queue.put(frame, SUBSCRIPTION)
+
+        self.assertEqual(outbound_queue.take(), ['s1'])
+        outbound_queue.put('r1', REPLY)
+        outbound_queue.put('c1', CONTROL)
+        self.assertEqual(outbound_queue.take(), ['c1', 'r1', 's2'])
+        self.assertEqual(outbound_queue.take(), ['s3'])
+
+
+class ReplyNeverDroppedTestCase(unittest.TestCase):
+    def runTest(self):
+        outbound_queue = OutboundQueue(reply_size=2)
+        outbound_queue.put('r1', REPLY)
+        outbound_queue.put('r2', REPLY)
+
+        put_done = threading.Event()
+
+        def put():
+            outbound_queue.put('r3', REPLY)
+            put_done.set()
+
+        thread = threading.Thread(target=put)
+        thread.start()
+        self.assertFalse(put_done.wait(0.1))
+
+        self.assertEqual(outbound_queue.take(), ['r1', 'r2'])
+        thread.join()
+        self.assertEqual(outbound_queue.take(), ['r3'])
+        self.assertEqual(outbound_queue.get_counters()['reply']['superseded'], 0)
+
+
+class ReplyDroppedWithoutBlockingTestCase(unittest.TestCase):
+    def runTest(self):
+        outbound_queue = OutboundQueue(reply_size=1)
+        self.assertTrue(outbound_queue.put('r1', REPLY, block=False))
+        self.assertFalse(outbound_queue.put('r2', REPLY, block=False))
+
+        self.assertEqual(outbound_queue.take(), ['r1'])
+        self.assertEqual(outbound_queue.get_counters()['reply'], {'queued': 1, 'superseded': 0, 'dropped': 1})
+
+
+class CloseTestCase(unittest.TestCase):
+    def runTest(self):
+        outbound_queue = OutboundQueue()
+        outbound_queue.put('r1', REPLY)
+        outbound_queue.close()
+        outbound_queue.put('r2', REPLY)
+
+        self.assertEqual(outbound_queue.take(), ['r1'])
+        self.assertEqual(outbound_queue.take(), [])
+        self.assertEqual(outbound_queue.get_counters()['reply']['dropped'], 1)
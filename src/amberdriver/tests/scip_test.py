@@ -0,0 +1,86 @@
+from amberdriver.hokuyo import scip
+
+
+__author__ = 'paoolo'
+
+import unittest
+
+
+def encode_line(data):
+    return data + chr(scip.checksum(bytearray(data))) + '\n'
+
+
+class ChecksumTestCase(unittest.TestCase):
+    def runTest(self):
+        self.assertEqual(chr(scip.checksum(bytearray('00'))), 'P')
+        self.assertEqual(chr(scip.checksum(bytearray('99'))), 'b')
+
+
+class ParseResponsesTestCase(unittest.TestCase):
+    def runTest(self):
+        parser = scip.ScipParser()
+        responses = 'BM\n' + encode_line('00') + '\n' + \
+                    'GD0044004601\n' + encode_line('00') + encode_line('0000') + encode_line('0a00b00c') + '\n'
+
+        # fed in chunks of any size
+        for i in xrange(0, len(responses), 5):
+            parser.feed(responses[i:i + 5])
+
+        self.assertEqual(parser.next_response(), ('BM', '00', []))
+        self.assertEqual(parser.next_response(), ('GD0044004601', '00', ['0000', '0a00b00c']))
+        self.assertIsNone(parser.next_response())
+        self.assertEqual(parser.get_pending_size(), 0)
+
+
+class InvalidSumTestCase(unittest.TestCase):
+    def runTest(self):
+        parser = scip.ScipParser()
+        valid = 'GD0044004601\n' + encode_line('00') + encode_line('0a00b00c') + '\n'
+        invalid = valid.replace('0a00b00c', '0a00b00d')
+
+        parser.feed(invalid + valid[:20])
+        self.assertIsNone(parser.next_response())
+        self.assertEqual(parser.get_invalid_count(), 1)
+        self.assertEqual(parser.get_pending_size(), 20)
+
+        # parsing continues with the next response
+        parser.feed(valid[20:])
+        self.assertEqual(parser.next_response(), ('GD0044004601', '00', ['0a00b00c']))
+
+        parser.feed(valid[:20])
+        parser.reset()
+        self.assertEqual(parser.get_pending_size(), 0)
+
+
+class ResyncTestCase(unittest.TestCase):
+    def runTest(self):
+        parser = scip.ScipParser()
+        parser.feed('GD0044004601\n' + encode_line('00') + '0a00')
+
+        # the rest of response is skipped, the next one read ahead with it is kept
+        parser.resync()
+        self.assertTrue(parser.is_resyncing())
+        parser.feed('b00c\n')
+        self.assertTrue(parser.is_resyncing())
+        parser.feed('\nBM\n' + encode_line('00') + '\n')
+        self.assertFalse(parser.is_resyncing())
+
+        self.assertEqual(parser.next_response(), ('BM', '00', []))
+        self.assertEqual(parser.get_skipped_count(), len('GD0044004601\n' + encode_line('00') + '0a00b00c\n\n'))
+
+
+class ResyncBetweenResponsesTestCase(unittest.TestCase):
+    def runTest(self):
+        parser = scip.ScipParser()
+        parser.feed('BM\n' + encode_line('00') + '\n')
+
+        # nothing to skip, when no response is being parsed
+        parser.resync()
+        self.assertFalse(parser.is_resyncing())
+        self.assertEqual(parser.next_response(), ('BM', '00', []))
+
+        # unless response was read without parser
+        parser.resync(skip_response=True)
+        parser.feed('1111\n\nBM\n' + encode_line('00') + '\n')
+        self.assertEqual(parser.next_response(), ('BM', '00', []))
+        self.assertEqual(parser.get_skipped_count(), len('1111\n\n'))
@@ -31,6 +31,40 @@ class ReadTestCase(SerialPortTestCase):
         self.mocked_serial_port.read.assert_called_once_with(size)
 
 
+class BufferedReadTestCase(SerialPortTestCase):
+    def setUp(self):
+        super(BufferedReadTestCase, self).setUp()
+        self.chunks = ['VV\n00P\nVEND:', 'Hokuyo;[\n\n', 'BM\n00P\n\n']
+        self.mocked_serial_port.inWaiting = mock.Mock(side_effect=lambda: len(self.chunks[0]) if self.chunks else 0)
+        self.mocked_serial_port.read = mock.Mock(side_effect=lambda size: self.chunks.pop(0) if self.chunks else '')
+
+
+class ReadExactTestCase(BufferedReadTestCase):
+    def runTest(self):
+        self.assertEqual(self.port.read_exact(3), 'VV\n')
+        self.assertEqual(self.mocked_serial_port.read.call_count, 1)
+        self.assertEqual(self.port.read_exact(4), '00P\n')
+        self.assertEqual(self.mocked_serial_port.read.call_count, 1)
+
+        # bytes already in buffer are read first by every kind of read
+        self.assertEqual(self.port.read(2), 'VE')
+        self.assertEqual(self.port.read_byte(), ord('N'))
+
+        self.assertEqual(self.port.read_exact(100), 'D:Hokuyo;[\n\nBM\n00P\n\n')
+        self.assertEqual(self.port.read_exact(1), '')
+
+
+class ReadUntilTestCase(BufferedReadTestCase):
+    def runTest(self):
+        self.assertEqual(self.port.read_until('\n', 100), 'VV\n')
+        self.assertEqual(self.port.read_until('\n\n', 100), '00P\nVEND:Hokuyo;[\n\n')
+        self.assertEqual(self.mocked_serial_port.read.call_count, 2)
+
+        self.assertEqual(self.port.read_until('\n', 2), 'BM')
+        self.assertEqual(self.port.read_until('\n\n', 100), '\n00P\n\n')
+        self.assertEqual(self.port.read_until('\n', 100), '')
+
+
 class WriteTestCase(SerialPortTestCase):
     def runTest(self):
         char = mock.Mock()
@@ -213,3 +247,57 @@ class WriteSignedLongTestCase(SerialPortTestCase):
         checksum += (value & 0xFF) + ((value >> 8) & 0xFF) + ((value >> 16) & 0xFF) + ((value >> 24) & 0xFF)
         assert self.port.get_checksum() == checksum
 
+
+class PacketTestCase(unittest.TestCase):
+    def setUp(self):
+        self.packet = serial_port.Packet([('address', 'byte'), ('speed', 'slong'), ('current', 'sword')])
+        self.data = struct.pack('>B', 128) + struct.pack('>l', -1000) + struct.pack('>h', 300)
+
+    def runTest(self):
+        self.assertEqual(self.packet.get_size(), 7)
+
+
+class PackPacketTestCase(PacketTestCase):
+    def runTest(self):
+        self.assertEqual(self.packet.pack({'address': 128, 'speed': -1000, 'current': 300}), self.data)
+
+
+class UnpackPacketTestCase(PacketTestCase):
+    def runTest(self):
+        self.assertEqual(self.packet.unpack(self.data), {'address': 128, 'speed': -1000, 'current': 300})
+
+
+class ReadPacketTestCase(SerialPortTestCase):
+    def runTest(self):
+        packet = serial_port.Packet([('speed', 'slong'), ('status', 'byte')])
+        data = struct.pack('>l', -1000) + struct.pack('>B', 7)
+        self.mocked_serial_port.inWaiting = mock.Mock(return_value=0)
+        self.mocked_serial_port.read = mock.Mock(return_value=data)
+
+        checksum = self.port.get_checksum()
+        self.assertEqual(self.port.read_packet(packet), {'speed': -1000, 'status': 7})
+        self.mocked_serial_port.read.assert_called_once_with(len(data))
+
+        # the same checksum as reading field by field
+        checksum += (-1000 & 0xFF) + ((-1000 >> 8) & 0xFF) + ((-1000 >> 16) & 0xFF) + ((-1000 >> 24) & 0xFF) + 7
+        self.assertEqual(self.port.get_checksum(), checksum)
+
+
+class ReadIncompletePacketTestCase(SerialPortTestCase):
+    def runTest(self):
+        packet = serial_port.Packet([('speed', 'slong'), ('status', 'byte')])
+        self.mocked_serial_port.inWaiting = mock.Mock(return_value=0)
+        self.mocked_serial_port.read = mock.Mock(side_effect=['\x00\x00\x00', ''])
+
+        self.assertIsNone(self.port.read_packet(packet))
+
+
+class WritePacketTestCase(SerialPortTestCase):
+    def runTest(self):
+        packet = serial_port.Packet([('address', 'byte'), ('command', 'byte'), ('speed', 'sword')])
+        self.mocked_serial_port.write = mock.Mock(return_value=4)
+
+        checksum = self.port.get_checksum()
+        self.assertEqual(self.port.write_packet(packet, {'address': 128, 'command': 35, 'speed': -2}), 4)
+        self.mocked_serial_port.write.assert_called_once_with(struct.pack('>BBh', 128, 35, -2))
+        self.assertEqual(self.port.get_checksum(), checksum + 128 + 35 + 0xFF + 0xFE)
@@ -0,0 +1,23 @@
+from amberdriver.common.token_bucket import TokenBucket
+
+
+__author__ = 'paoolo'
+
+import unittest
+
+
+class TryTakeTestCase(unittest.TestCase):
+    def runTest(self):
+        now = [100.0]
+        token_bucket = TokenBucket(2.0, burst=3, clock=lambda: now[0])
+
+        self.assertEqual([token_bucket.try_take() for _ in range(4)], [True, True, True, False])
+
+        now[0] += 0.25
+        self.assertFalse(token_bucket.try_take())
+        now[0] += 0.25
+        self.assertTrue(token_bucket.try_take())
+        self.assertFalse(token_bucket.try_take())
+
+        now[0] += 10.0
+        self.assertEqual([token_bucket.try_take() for _ in range(4)], [True, True, True, False])
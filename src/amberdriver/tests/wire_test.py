@@ -0,0 +1,69 @@
+import array
+
+from amberdriver.common import drivermsg_pb2, wire
+
+
+__author__ = 'paoolo'
+
+import unittest
+
+
+class PeekMessageTestCase(unittest.TestCase):
+    def runTest(self):
+        message = drivermsg_pb2.DriverMsg()
+        message.type = drivermsg_pb2.DriverMsg.PING
+        message.synNum = 1000
+        message.ackNum = 7
+        self.assertEqual(wire.peek_message(message.SerializeToString()), (drivermsg_pb2.DriverMsg.PING, 1000))
+
+        message = drivermsg_pb2.DriverMsg()
+        message.type = drivermsg_pb2.DriverMsg.DATA
+        self.assertEqual(wire.peek_message(message.SerializeToString()), (drivermsg_pb2.DriverMsg.DATA, None))
+
+
+class FindFieldTestCase(unittest.TestCase):
+    def runTest(self):
+        message = drivermsg_pb2.DriverMsg()
+        message.type = drivermsg_pb2.DriverMsg.DATA
+        message.synNum = 1
+        message_data = message.SerializeToString()
+        self.assertEqual(wire.find_field(message_data, set([50])), None)
+
+        message_data += str(wire.encode_tag(50, wire.WIRE_TYPE_LENGTH_DELIMITED) + wire.encode_varint(2)) + 'ab'
+        message_data += str(wire.encode_tag(52, wire.WIRE_TYPE_VARINT) + wire.encode_varint(1))
+        self.assertEqual(wire.find_field(message_data, set([52])), 52)
+        self.assertEqual(wire.find_field(message_data, set([50, 52])), 50)
+
+
+class PeekClientIdsTestCase(unittest.TestCase):
+    def runTest(self):
+        header = drivermsg_pb2.DriverHdr()
+        self.assertEqual(wire.peek_client_ids(header.SerializeToString()), [])
+
+        header.clientIDs.extend([0, 1, 300, -1])
+        self.assertEqual(wire.peek_client_ids(header.SerializeToString()), [0, 1, 300, -1])
+
+
+class EncodeTestCase(unittest.TestCase):
+    def runTest(self):
+        header = drivermsg_pb2.DriverHdr()
+        header.clientIDs.extend([1, 300, -1])
+        self.assertEqual(wire.encode_header([1, 300, -1]), header.SerializeToString())
+        self.assertEqual(wire.encode_header([]), drivermsg_pb2.DriverHdr().SerializeToString())
+
+        message = drivermsg_pb2.DriverMsg()
+        message.type = drivermsg_pb2.DriverMsg.PONG
+        message.ackNum = 12345
+        self.assertEqual(wire.encode_message(drivermsg_pb2.DriverMsg.PONG, ack_num=12345),
+                         message.SerializeToString())
+
+
+class EncodePackedTestCase(unittest.TestCase):
+    def runTest(self):
+        header = drivermsg_pb2.DriverHdr()
+        header.clientIDs.extend([0, 1, 127, 128, 300, 2 ** 31 - 1, -1, -2 ** 31])
+        data = wire.encode_packed_varints(wire.HEADER_CLIENT_IDS_FIELD, header.clientIDs, bytearray())
+        self.assertEqual(bytes(data), header.SerializeToString())
+
+        self.assertEqual(wire.encode_packed_varints(wire.HEADER_CLIENT_IDS_FIELD, [], bytearray()), bytearray())
+        self.assertEqual(wire.encode_packed_doubles(1, array.array('d'), bytearray()), bytearray())
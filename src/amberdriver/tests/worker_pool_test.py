@@ -0,0 +1,30 @@
+import threading
+
+from amberdriver.common.worker_pool import WorkerPool
+
+
+__author__ = 'paoolo'
+
+import unittest
+
+
+class SubmitTestCase(unittest.TestCase):
+    def runTest(self):
+        worker_pool = WorkerPool(3)
+        results = {}
+        done = threading.Semaphore(0)
+
+        def task(key, value):
+            results.setdefault(key, []).append((value, threading.current_thread()))
+            done.release()
+
+        for value in range(10):
+            for key in range(4):
+                worker_pool.submit(key, task, key, value)
+        for _ in range(40):
+            done.acquire()
+        worker_pool.terminate()
+
+        for key in range(4):
+            self.assertEqual([value for value, _ in results[key]], list(range(10)))
+            self.assertEqual(len(set([thread for _, thread in results[key]])), 1)
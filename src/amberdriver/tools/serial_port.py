@@ -3,10 +3,49 @@ import struct
 __author__ = 'paoolo'
 
 
+class Packet(object):
+    """
+    Layout of binary packet, declared once as list of named fields, big-endian like the rest of port.
+    Fields are compiled into one struct, so whole packet is packed or unpacked in one call.
+    """
+
+    FIELD_FORMATS = {'byte': 'B', 'sbyte': 'b', 'word': 'H', 'sword': 'h', 'long': 'L', 'slong': 'l'}
+
+    def __init__(self, fields):
+        """
+        :param fields: list of field name and type, one of FIELD_FORMATS, e.g. [('speed', 'slong')]
+        """
+        self.__names = tuple(name for name, _ in fields)
+        self.__struct = struct.Struct('>' + ''.join(Packet.FIELD_FORMATS[field_type] for _, field_type in fields))
+
+    def get_size(self):
+        return self.__struct.size
+
+    def pack(self, values):
+        """
+        :param values: dict of field name to value
+        :return: binary string
+        """
+        return self.__struct.pack(*[values[name] for name in self.__names])
+
+    def unpack(self, data):
+        """
+        :param data: binary string of packet size
+        :return: dict of field name to value
+        """
+        return dict(zip(self.__names, self.__struct.unpack(data)))
+
+
 class SerialPort(object):
+    """
+    Serial port with internal read buffer. Buffered primitives read everything already received
+    at once, bytes not consumed yet are kept in buffer and returned by the next read of any kind.
+    """
+
     def __init__(self, serial_port):
         self.__port = serial_port
         self.__checksum = 0
+        self.__buffer = bytearray()
 
     def close(self):
         self.__port.close()
@@ -15,7 +54,53 @@ class SerialPort(object):
         return self.__checksum
 
     def read(self, size):
-        return self.__port.read(size)
+        if len(self.__buffer) == 0:
+            return self.__port.read(size)
+        data = self.__take(size)
+        if len(data) < size:
+            data += self.__port.read(size - len(data))
+        return data
+
+    def read_exact(self, size):
+        """
+        Read given number of bytes, reading everything already received at once.
+
+        :param size: number of bytes
+        :return: binary string, shorter than `size` only if nothing more is received until timeout
+        """
+        while len(self.__buffer) < size:
+            if not self.__fill(size - len(self.__buffer)):
+                break
+        return self.__take(size)
+
+    def read_until(self, terminator, max_len):
+        """
+        Read bytes up to terminator, reading everything already received at once.
+
+        :param terminator: binary string ending data, e.g. line feed
+        :param max_len: maximal number of bytes to read, if terminator does not come
+        :return: binary string ended with terminator, or shorter on timeout, or `max_len` bytes long
+        """
+        end = self.__buffer.find(terminator)
+        while end < 0 and len(self.__buffer) < max_len:
+            # terminator may be split between reads
+            start = max(len(self.__buffer) - len(terminator) + 1, 0)
+            if not self.__fill(1):
+                break
+            end = self.__buffer.find(terminator, start)
+        if end < 0:
+            return self.__take(max_len)
+        return self.__take(min(end + len(terminator), max_len))
+
+    def __fill(self, size):
+        data = self.__port.read(max(self.__port.inWaiting(), size))
+        self.__buffer += data
+        return len(data) > 0
+
+    def __take(self, size):
+        data = str(self.__buffer[:size])
+        del self.__buffer[:size]
+        return data
 
     def write(self, char):
         self.__port.write(char)
@@ -27,7 +112,7 @@ class SerialPort(object):
         self.__port.write(chr(command))
 
     def read_byte(self):
-        res = self.__port.read(1)
+        res = self.read(1)
         if len(res) > 0:
             val = struct.unpack('>B', res)
             self.__checksum += val[0] & 0xFF
@@ -35,7 +120,7 @@ class SerialPort(object):
         return None
 
     def read_sbyte(self):
-        res = self.__port.read(1)
+        res = self.read(1)
         if len(res) > 0:
             val = struct.unpack('>b', res)
             self.__checksum += val[0] & 0xFF
@@ -43,7 +128,7 @@ class SerialPort(object):
         return None
 
     def read_word(self):
-        res = self.__port.read(2)
+        res = self.read(2)
         if len(res) > 0:
             val = struct.unpack('>H', res)
             self.__checksum += val[0] & 0xFF
@@ -52,7 +137,7 @@ class SerialPort(object):
         return None
 
     def read_sword(self):
-        res = self.__port.read(2)
+        res = self.read(2)
         if len(res) > 0:
             val = struct.unpack('>h', res)
             self.__checksum += val[0] & 0xFF
@@ -61,7 +146,7 @@ class SerialPort(object):
         return None
 
     def read_long(self):
-        res = self.__port.read(4)
+        res = self.read(4)
         if len(res) > 0:
             val = struct.unpack('>L', res)
             self.__checksum += val[0] & 0xFF
@@ -72,7 +157,7 @@ class SerialPort(object):
         return None
 
     def read_slong(self):
-        res = self.__port.read(4)
+        res = self.read(4)
         if len(res) > 0:
             val = struct.unpack('>l', res)
             self.__checksum += val[0] & 0xFF
@@ -82,6 +167,31 @@ class SerialPort(object):
             return val[0]
         return None
 
+    def read_packet(self, packet):
+        """
+        Read all fields of packet at once. Checksum is updated with every byte of packet.
+
+        :param packet: layout of packet
+        :return: dict of field name to value, None if packet is not received completely until timeout
+        """
+        data = self.read_exact(packet.get_size())
+        if len(data) < packet.get_size():
+            return None
+        self.__checksum += sum(bytearray(data))
+        return packet.unpack(data)
+
+    def write_packet(self, packet, values):
+        """
+        Write all fields of packet at once. Checksum is updated with every byte of packet.
+
+        :param packet: layout of packet
+        :param values: dict of field name to value
+        :return: result of write
+        """
+        data = packet.pack(values)
+        self.__checksum += sum(bytearray(data))
+        return self.__port.write(data)
+
     def write_byte(self, val):
         self.__checksum += val & 0xFF
         return self.__port.write(struct.pack('>B', val))